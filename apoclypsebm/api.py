@@ -0,0 +1,292 @@
+"""
+cgminer/bfgminer compatible API socket.
+
+Requests are either JSON objects like {"command": "summary", "parameter": ""}
+or the plain "command|parameter" form, answered in the same format and then
+the connection is closed. Replies are built from a snapshot of attributes
+read without taking the switch lock, so polling never stalls mining.
+"""
+from json import dumps, loads
+from socketserver import StreamRequestHandler, TCPServer
+from threading import Thread
+from time import monotonic, time
+
+from apoclypsebm import metrics
+from apoclypsebm.log import say_exception, say_line
+from apoclypsebm.version import VERSION
+
+API_VERSION = '3.7'
+
+# cgminer status codes, where we have an equivalent.
+MSG_INVALID_COMMAND = 14
+MSG_MISSING_ID = 15
+MSG_INVALID_ID = 16
+MSG_PRIVILEGED = 45
+MSG_INVALID_PARAM = 71
+MSG_POOL = 7
+MSG_SUMMARY = 11
+MSG_DEVS = 9
+MSG_STATS = 70
+MSG_VERSION = 22
+MSG_SWITCH_POOL = 27
+MSG_ENABLED = 40
+MSG_DISABLED = 41
+MSG_CONFIGURED = 42
+
+
+class APIError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def status(code, message, success=True):
+    return [{
+        'STATUS': 'S' if success else 'E',
+        'When': int(time()),
+        'Code': code,
+        'Msg': message,
+        'Description': f'apoclypsebm {VERSION}'
+    }]
+
+
+def miner_snapshot(index, miner, now):
+    device = miner.id()
+    elapsed = max(now - getattr(miner, 'start_time', now), 1)
+    return {
+        miner.kind: index,
+        'ID': index,
+        'Name': device,
+        'Enabled': 'Y' if miner.enabled else 'N',
+        'Status': 'Alive' if miner.rate else 'Idle',
+        'Temperature': metrics.TEMPERATURE.value(device),
+        'Fan Speed': metrics.FAN_SPEED.value(device),
+        'Power': metrics.POWER.value(device),
+        'Hashes per Joule': metrics.HASHES_PER_JOULE.value(device),
+        'MHS av': miner.hashes / elapsed / 1000000,
+        'MHS 5s': miner.rate,
+        'Estimated MHS': miner.estimated_rate,
+        'Accepted': miner.share_count[1],
+        'Rejected': miner.share_count[0],
+        'Hardware Errors': metrics.HARDWARE_ERRORS.value(device),
+        'Timeouts': metrics.DEVICE_TIMEOUTS.value(device),
+        'Reinits': metrics.DEVICE_REINITS.value(device),
+        'Stale': metrics.SHARES.sum(device=device, result='stale'),
+        'Frames': getattr(miner, 'frames', None),
+        'Worksize': getattr(miner, 'worksize', None),
+        'Work Queue': miner.work_queue.qsize(),
+    }
+
+
+class API(object):
+    def __init__(self, switch, allow_control=False):
+        self.switch = switch
+        self.allow_control = allow_control
+        self.commands = {
+            'version': self.version,
+            'summary': self.summary,
+            'devs': self.devs,
+            'pools': self.pools,
+            'stats': self.stats,
+            'switchpool': self.switchpool,
+            'enable': self.enable,
+            'disable': self.disable,
+            'gpuenable': self.enable,
+            'gpudisable': self.disable,
+            'pgaenable': self.enable,
+            'pgadisable': self.disable,
+            'gpuframes': self.frames,
+            'gpuworksize': self.worksize,
+        }
+        self.control_commands = {
+            'switchpool', 'enable', 'disable', 'gpuenable', 'gpudisable',
+            'pgaenable', 'pgadisable', 'gpuframes', 'gpuworksize'
+        }
+
+    def execute(self, command, parameter=''):
+        try:
+            if command not in self.commands:
+                raise APIError(MSG_INVALID_COMMAND, 'Invalid command')
+            if command in self.control_commands and not self.allow_control:
+                raise APIError(MSG_PRIVILEGED,
+                               'Access denied to %s command' % command)
+            return self.commands[command](parameter)
+        except APIError as e:
+            return {'STATUS': status(e.code, str(e), False)}
+
+    def miners(self):
+        return list(self.switch.miners)
+
+    def miner(self, parameter):
+        if parameter == '':
+            raise APIError(MSG_MISSING_ID, 'Missing device id parameter')
+        try:
+            return self.miners()[int(parameter)]
+        except (ValueError, IndexError):
+            raise APIError(MSG_INVALID_ID,
+                           'Invalid device id %s' % parameter)
+
+    def version(self, parameter):
+        return {
+            'STATUS': status(MSG_VERSION, 'apoclypsebm versions'),
+            'VERSION': [{'Miner': f'apoclypsebm {VERSION}',
+                         'API': API_VERSION}]
+        }
+
+    def summary(self, parameter):
+        now = monotonic()
+        miners = [miner_snapshot(i, m, now)
+                  for i, m in enumerate(self.miners())]
+        elapsed = max(now - self.switch.started, 1)
+        return {
+            'STATUS': status(MSG_SUMMARY, 'Summary'),
+            'SUMMARY': [{
+                'Elapsed': int(elapsed),
+                'MHS av': sum(m['MHS av'] for m in miners),
+                'MHS 5s': sum(m['MHS 5s'] for m in miners),
+                'Estimated MHS': sum(m['Estimated MHS'] for m in miners),
+                'Accepted': sum(m['Accepted'] for m in miners),
+                'Rejected': sum(m['Rejected'] for m in miners),
+                'Hardware Errors': sum(m['Hardware Errors'] for m in miners),
+                'Stale': sum(m['Stale'] for m in miners),
+            }]
+        }
+
+    def devs(self, parameter):
+        now = monotonic()
+        return {
+            'STATUS': status(MSG_DEVS, '%d Device(s)' % len(self.miners())),
+            'DEVS': [miner_snapshot(i, m, now)
+                     for i, m in enumerate(self.miners())]
+        }
+
+    def pools(self, parameter):
+        pools = []
+        current = self.switch.server_index
+        for i, server in enumerate(list(self.switch.servers)):
+            source = getattr(server, 'source', None)
+            pools.append({
+                'POOL': i,
+                'URL': f'{server.proto}://{server.host}',
+                'Name': server.name,
+                'Status': 'Alive' if i == current else 'Standby',
+                'Priority': i,
+                'User': server.user,
+                'Stratum Active': (
+                    server.proto == 'stratum' and i == current
+                ),
+                'Accepted': metrics.SHARES.sum(
+                    pool=server.name, result='accepted'),
+                'Rejected': metrics.SHARES.sum(
+                    pool=server.name, result='rejected'),
+                'Stale': metrics.SHARES.sum(pool=server.name, result='stale'),
+                'Result Queue': source.result_queue.qsize() if source else 0,
+            })
+        return {'STATUS': status(MSG_POOL, '%d Pool(s)' % len(pools)),
+                'POOLS': pools}
+
+    def stats(self, parameter):
+        stats = []
+        now = monotonic()
+        for i, miner in enumerate(self.miners()):
+            device = miner.id()
+            verification = metrics.VERIFICATION_SECONDS.labels(device)
+            stats.append({
+                'STATS': i,
+                'ID': device,
+                'Elapsed': int(now - self.switch.started),
+                'Launch Size': metrics.LAUNCH_SIZE.value(device),
+                'Verifications': verification.count(),
+                'Verification p50': verification.quantile(.5),
+                'Verification p99': verification.quantile(.99),
+                'Work Queue': miner.work_queue.qsize(),
+            })
+        return {'STATUS': status(MSG_STATS, 'apoclypsebm stats'),
+                'STATS': stats}
+
+    def switchpool(self, parameter):
+        try:
+            self.switch.switch_server(int(parameter))
+        except (ValueError, IndexError):
+            raise APIError(MSG_INVALID_ID, 'Invalid pool id %s' % parameter)
+        return {'STATUS': status(MSG_SWITCH_POOL,
+                                 'Switching to pool %s' % parameter)}
+
+    def enable(self, parameter):
+        miner = self.miner(parameter)
+        miner.set_enabled(True)
+        return {'STATUS': status(MSG_ENABLED, '%s enabled' % miner.id())}
+
+    def disable(self, parameter):
+        miner = self.miner(parameter)
+        miner.set_enabled(False)
+        return {'STATUS': status(MSG_DISABLED, '%s disabled' % miner.id())}
+
+    def configure_miner(self, parameter, setting):
+        index, _, value = parameter.partition(',')
+        miner = self.miner(index)
+        try:
+            value = int(value)
+            if value <= 0:
+                raise ValueError(value)
+            miner.configure(**{setting: value})
+        except ValueError:
+            raise APIError(MSG_INVALID_PARAM, 'Invalid %s' % setting)
+        except NotImplementedError as e:
+            raise APIError(MSG_INVALID_PARAM, str(e))
+        return {'STATUS': status(
+            MSG_CONFIGURED, '%s %s set to %d' % (miner.id(), setting, value))}
+
+    def frames(self, parameter):
+        return self.configure_miner(parameter, 'frames')
+
+    def worksize(self, parameter):
+        return self.configure_miner(parameter, 'worksize')
+
+
+def plain_response(response):
+    sections = []
+    for name, entries in response.items():
+        for entry in entries:
+            fields = ','.join(f'{key}={value}' for key, value in entry.items())
+            sections.append(fields if name == 'STATUS' else
+                            f'{name},{fields}')
+    return '|'.join(sections) + '|'
+
+
+class APIHandler(StreamRequestHandler):
+    def handle(self):
+        request = self.request.recv(8192).strip(b'\x00 \r\n').decode(
+            'utf-8', 'replace')
+        api = self.server.api
+        try:
+            if request.startswith('{'):
+                message = loads(request)
+                response = api.execute(
+                    str(message.get('command', '')),
+                    str(message.get('parameter', '')))
+                if 'id' in message:
+                    response['id'] = message['id']
+                reply = dumps(response)
+            else:
+                command, _, parameter = request.partition('|')
+                reply = plain_response(api.execute(command, parameter))
+        except ValueError:
+            reply = dumps(
+                {'STATUS': status(MSG_INVALID_COMMAND, 'Invalid JSON', False)})
+        except Exception:
+            say_exception('API error:')
+            return
+        self.wfile.write(reply.encode('utf-8') + b'\x00')
+
+
+class APIServer(TCPServer):
+    allow_reuse_address = True
+
+
+def start_server(switch, host, port, allow_control=False):
+    server = APIServer((host, port), APIHandler)
+    server.api = API(switch, allow_control)
+    Thread(target=server.serve_forever, daemon=True).start()
+    say_line('API listening on %s:%d', server.server_address[:2])
+    return server
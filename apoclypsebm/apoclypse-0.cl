@@ -3,8 +3,19 @@
 
 // 2011-07-11: further modified by Diapolo and still public-domain
 
-#ifdef VECTORS
+// Work items hash LANES nonces each, 1 << LANE_BITS of them
+#if defined(VECTORS8)
+	typedef uint8 u;
+	#define LANE_BITS 3
+	#define LANES (u)(0, 1, 2, 3, 4, 5, 6, 7)
+#elif defined(VECTORS4)
+	typedef uint4 u;
+	#define LANE_BITS 2
+	#define LANES (u)(0, 1, 2, 3)
+#elif defined(VECTORS)
 	typedef uint2 u;
+	#define LANE_BITS 1
+	#define LANES (u)(0, 1)
 #else
 	typedef uint u;
 #endif
@@ -67,29 +78,79 @@ __constant ulong L = 0x198c7e2a2;
 // SHA round without W calc
 #define sharound(n) { Vals[(131 - n) & 7] += t1(n); Vals[(135 - n) & 7] = t1(n) + s0(n) + ma(n); }
 
+#ifdef NTIME_ROLL
+	// The result flag moves past the ntime offsets written next to the nonces
+	#define FLAG (OUTPUT_SIZE * 2)
+
+	#define bswap(x) (rotate((x) & 0x00FF00FFU, 24U) | (rotate((x), 8U) & 0x00FF00FFU))
+	#define S0(x) (rotate(x, 30U) ^ rotate(x, 19U) ^ rotate(x, 10U))
+	#define S1(x) (rotate(x, 26U) ^ rotate(x, 21U) ^ rotate(x, 7U))
+	#define sigma0(x) (rotate(x, 25U) ^ rotate(x, 14U) ^ ((x) >> 3U))
+	// Scalar SHA round on a, b, c, d, e, f, g, h
+	#define hostround(x, k) { \
+		uint t = h + S1(e) + bitselect(g, f, e) + (k) + (x); \
+		h = g; g = f; f = e; e = d + t; d = c; c = b; b = a; \
+		a = t + S0(b) + bitselect(b, c, d ^ b); }
+#else
+	#define FLAG OUTPUT_SIZE
+#endif
+
 __kernel __attribute__((reqd_work_group_size(WORK_GROUP_SIZE, 1, 1))) void search(	const uint state0, const uint state1, const uint state2, const uint state3,
 						const uint state4, const uint state5, const uint state6, const uint state7,
+#ifdef NTIME_ROLL
+						const uint merkle_end, const uint ntime, const uint nonces_per_time,
+						const uint unused0, const uint unused1, const uint unused2,
+#else
 						const uint B1, const uint C1, const uint D1,
 						const uint F1, const uint G1, const uint H1,
+#endif
 						const uint base,
 						const uint W2,
+#ifdef NTIME_ROLL
+						const uint unused3, const uint unused4,
+						const uint unused5, const uint unused6,
+#else
 						const uint W16, const uint W17,
 						const uint PreVal4, const uint T1,
+#endif
 						__global uint * output)
 {
 	u W[124];
 	u Vals[8];
 
+#ifdef NTIME_ROLL
+	// The high part of the global ID selects how many seconds ntime is
+	// rolled, the low part the nonce. What the host precalculates for one
+	// ntime is derived here, from the first three rounds on.
+	uint offset = get_global_id(0) / nonces_per_time;
+	uint position = get_global_id(0) - offset * nonces_per_time;
+	uint W1 = bswap(bswap(ntime) + offset);
+
+	uint a = state0, b = state1, c = state2, d = state3;
+	uint e = state4, f = state5, g = state6, h = state7;
+	hostround(merkle_end, K[0]);
+	hostround(W1, K[1]);
+	hostround(W2, K[2]);
+	uint B1 = e, C1 = f, D1 = g, F1 = a, G1 = b, H1 = c;
+
+	uint W16 = merkle_end + sigma0(W1);
+	uint W17 = W1 + sigma0(W2) + 0x01100000U;
+	uint PreVal4 = state4 + S1(B1) + bitselect(D1, C1, B1) + K[3];
+	uint T1 = S0(F1) + bitselect(F1, G1, H1 ^ F1);
+#else
+	uint position = get_global_id(0);
+#endif
+
 	Vals[1] = B1;
 	Vals[2] = C1;
 	Vals[5] = F1;
 	Vals[6] = G1;
 	
 	W[2] = W2;
-#ifdef VECTORS
-        Vals[4] = (W[3] = (u)((base + get_global_id(0)) << 1) + (u)(0, 1)) + PreVal4;
+#ifdef LANE_BITS
+        Vals[4] = (W[3] = (u)((base + position) << LANE_BITS) + LANES) + PreVal4;
 #else
-        Vals[4] = (W[3] = base + get_global_id(0)) + PreVal4;
+        Vals[4] = (W[3] = base + position) + PreVal4;
 #endif
 	// used in: P2(19) == 285220864 (0x11002000), P4(20)
 	W[4] = 0x80000000U;
@@ -372,20 +433,23 @@ __kernel __attribute__((reqd_work_group_size(WORK_GROUP_SIZE, 1, 1))) void searc
 	// Round 124
 	Vals[7] += Vals[3] + P4(124) + P3(124) + P2(124) + P1(124) + s1(124) + ch(124);
 	
-#ifdef VECTORS
-	if(Vals[7].x == -H[7])
-	{	
-		output[OUTPUT_SIZE] = output[(W[3].x >> 2) & OUTPUT_MASK] = W[3].x;
-		
-	}
-	if(Vals[7].y == -H[7])
-	{
-		output[OUTPUT_SIZE] = output[(W[3].y >> 2) & OUTPUT_MASK] =  W[3].y;
-	}
+#ifdef NTIME_ROLL
+	#define found(nonce) { \
+		output[OUTPUT_SIZE + ((nonce >> 2) & OUTPUT_MASK)] = offset; \
+		output[FLAG] = output[(nonce >> 2) & OUTPUT_MASK] = nonce; }
+#else
+	#define found(nonce) { output[FLAG] = output[(nonce >> 2) & OUTPUT_MASK] = nonce; }
+#endif
+
+	#define check(lane) if(Vals[7]lane == -H[7]) { found(W[3]lane); }
+#if defined(VECTORS8)
+	check(.s0) check(.s1) check(.s2) check(.s3)
+	check(.s4) check(.s5) check(.s6) check(.s7)
+#elif defined(VECTORS4)
+	check(.x) check(.y) check(.z) check(.w)
+#elif defined(VECTORS)
+	check(.x) check(.y)
 #else
-	if(Vals[7] == -H[7])
-	{
-		output[OUTPUT_SIZE] = output[(W[3] >> 2) & OUTPUT_MASK] = W[3];
-	}
+	check()
 #endif
 }
\ No newline at end of file
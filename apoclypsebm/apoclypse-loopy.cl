@@ -3,8 +3,19 @@
 
 // 2011-07-11: further modified by Diapolo and still public-domain
 
-#ifdef VECTORS
+// Work items hash LANES nonces each, 1 << LANE_BITS of them
+#if defined(VECTORS8)
+  typedef uint8 u;
+  #define LANE_BITS 3
+  #define LANES (u)(0, 1, 2, 3, 4, 5, 6, 7)
+#elif defined(VECTORS4)
+  typedef uint4 u;
+  #define LANE_BITS 2
+  #define LANES (u)(0, 1, 2, 3)
+#elif defined(VECTORS)
   typedef uint2 u;
+  #define LANE_BITS 1
+  #define LANES (u)(0, 1)
 #else
   typedef uint u;
 #endif
@@ -88,8 +99,8 @@ __kernel  __attribute__((reqd_work_group_size(WORK_GROUP_SIZE, 1, 1))) void sear
   Vals[6] = G1;
 
   W[2] = W2;
-#ifdef VECTORS
-        Vals[4] = (W[3] = (u)((base + get_global_id(0)) << 1) + (u)(0, 1)) + PreVal4;
+#ifdef LANE_BITS
+        Vals[4] = (W[3] = (u)((base + get_global_id(0)) << LANE_BITS) + LANES) + PreVal4;
 #else
         Vals[4] = (W[3] = base + get_global_id(0)) + PreVal4;
 #endif
@@ -217,20 +228,16 @@ __kernel  __attribute__((reqd_work_group_size(WORK_GROUP_SIZE, 1, 1))) void sear
   // Round 124
   Vals[7] += Vals[3] + P4(124) + P3(124) + P2(124) + P1(124) + s1(124) + ch(124);
 
-#ifdef VECTORS
-  if(Vals[7].x == -H[7])
-  {
-    output[OUTPUT_SIZE] = output[(W[3].x >> 2) & OUTPUT_MASK] = W[3].x;
-
-  }
-  if(Vals[7].y == -H[7])
-  {
-    output[OUTPUT_SIZE] = output[(W[3].y >> 2) & OUTPUT_MASK] =  W[3].y;
-  }
+  #define check(lane) if(Vals[7]lane == -H[7]) { \
+    output[OUTPUT_SIZE] = output[(W[3]lane >> 2) & OUTPUT_MASK] = W[3]lane; }
+#if defined(VECTORS8)
+  check(.s0) check(.s1) check(.s2) check(.s3)
+  check(.s4) check(.s5) check(.s6) check(.s7)
+#elif defined(VECTORS4)
+  check(.x) check(.y) check(.z) check(.w)
+#elif defined(VECTORS)
+  check(.x) check(.y)
 #else
-  if(Vals[7] == -H[7])
-  {
-    output[OUTPUT_SIZE] = output[(W[3] >> 2) & OUTPUT_MASK] = W[3];
-  }
+  check()
 #endif
 }
\ No newline at end of file
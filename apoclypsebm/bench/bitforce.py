@@ -0,0 +1,239 @@
+"""
+A BitFORCE SHA256 device simulated on a pseudo terminal.
+
+It speaks enough of the BitFORCE serial protocol for BFLMiner: ZGX
+identifies the device, ZDX followed by the midstate and the last header
+words starts a job, ZFX reports BUSY until the job's time is up and then
+the nonces found, ZLX reports the temperature. With queue set it also
+takes jobs in bulk: ZWX followed by a count byte and the jobs queues them,
+ZOX reports every job finished since the last ZOX, ZQX empties the queue.
+Jobs don't hash 2^32 nonces,
+they find shares of share_bits zero bits like virtual devices, so the
+switch has to be told through verify_mask. The search starts at a random
+nonce, so a job sent again within the same second, which jobs this short
+make common, doesn't just produce duplicates.
+
+Besides job and response timing it keeps how long the device sat idle
+between jobs, which is what the host side costs a real device.
+"""
+import os
+import random
+import tty
+from collections import deque
+from struct import unpack
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+from apoclypsebm.sha256 import hash
+from apoclypsebm.util import Object, bytereverse, uint32
+
+IDENTITY = b'>>>ID: BitFORCE SHA256 Version 1.0>>>\n'
+JOB_SIZE = 60
+# Midstate and the last three header words.
+QUEUED_JOB_SIZE = 44
+QUEUE_SIZE = 40
+
+
+class BitForceSimulator(object):
+    """
+    :param job_time: seconds a job takes, 2^32 nonces on the real device
+    :param response_delay: seconds the device takes to answer a command
+    :param share_bits: zero bits the nonces reported need
+    :param shares: nonces found per job
+    :param temperature: reported by ZLX, in degrees Celsius
+    :param queue: understand the queue commands, like newer firmware
+    :param bulk_queue: take jobs with ZWX as above, else only ZQX and ZOX
+        are understood, like firmware queueing jobs some other way
+    """
+
+    def __init__(self, job_time=0.2, response_delay=0.001, share_bits=4,
+                 shares=1, temperature=45.0, queue=True, bulk_queue=True):
+        self.job_time = job_time
+        self.response_delay = response_delay
+        self.verify_mask = bytereverse(uint32(0xFFFFFFFF << (32 - share_bits)))
+        self.shares = shares
+        self.temperature = temperature
+        self.queue = queue
+        self.bulk_queue = bulk_queue
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.lock = Lock()
+        self.job = None
+        self.job_started = None
+        self.nonces = None
+        self.queued = deque()
+        self.finished = []
+        self.jobs = 0
+        self.idle_time = 0
+        self.should_stop = False
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.should_stop = True
+
+    def utilization(self, duration):
+        """Share of duration spent on jobs."""
+        return max(1 - self.idle_time / duration, 0) if duration else 0
+
+    def respond(self, response):
+        sleep(self.response_delay)
+        os.write(self.master, response)
+
+    def run(self):
+        buffer = b''
+        expecting = None
+        while not self.should_stop:
+            try:
+                buffer += os.read(self.master, 4096)
+            except OSError:
+                sleep(0.01)
+                continue
+            while True:
+                if expecting == b'ZDX':
+                    if len(buffer) < JOB_SIZE:
+                        break
+                    self.start_job(buffer[8:52])
+                    buffer = buffer[JOB_SIZE:]
+                    expecting = None
+                    self.respond(b'OK\n')
+                    continue
+                if expecting == b'ZWX':
+                    if not buffer or len(buffer) < 1 + buffer[0] * QUEUED_JOB_SIZE:
+                        break
+                    count = buffer[0]
+                    jobs = [buffer[1 + i * QUEUED_JOB_SIZE:1 + (i + 1) * QUEUED_JOB_SIZE]
+                            for i in range(count)]
+                    buffer = buffer[1 + count * QUEUED_JOB_SIZE:]
+                    expecting = None
+                    self.respond(self.queue_jobs(jobs))
+                    continue
+                if len(buffer) < 3:
+                    break
+                command, buffer = buffer[:3], buffer[3:]
+                if command == b'ZGX':
+                    self.respond(IDENTITY)
+                elif command == b'ZDX':
+                    if self.busy():
+                        self.respond(b'BUSY\n')
+                    else:
+                        expecting = command
+                        self.respond(b'OK\n')
+                elif command == b'ZFX':
+                    self.respond(self.result())
+                elif command == b'ZLX':
+                    self.respond(b'Temperature (celcius): %.1f\n' % self.temperature)
+                elif command == b'ZWX' and self.queue and self.bulk_queue:
+                    expecting = command
+                    self.respond(b'OK\n')
+                elif command == b'ZOX' and self.queue:
+                    self.respond(self.queue_results())
+                elif command == b'ZQX' and self.queue:
+                    self.respond(self.flush())
+                else:
+                    # Out of step, drop what came with it.
+                    buffer = b''
+                    self.respond(b'ERR:UNKNOWN COMMAND\n')
+
+    def busy(self):
+        self.advance(monotonic())
+        return bool(self.queued) or (
+            self.job is not None and monotonic() - self.job.started < self.job_time)
+
+    def new_job(self, data):
+        job = Object()
+        job.data = data
+        job.words = unpack('<8I3I', data)
+        job.started = None
+        job.nonces = None
+        self.jobs += 1
+        # Found while the job runs, not on the host's time.
+        Thread(target=self.find_nonces, args=(job,), daemon=True).start()
+        return job
+
+    def begin(self, job, now):
+        """Starts job on an idle device."""
+        if self.job_started is not None:
+            # The device went idle when the last job's time was up, however
+            # late the host came with the next one.
+            self.idle_time += max(now - self.job_started - self.job_time, 0)
+        job.started = self.job_started = now
+
+    def start_job(self, data):
+        self.job = self.new_job(data)
+        self.begin(self.job, monotonic())
+
+    def find_nonces(self, job):
+        state, (merkle_end, time, difficulty) = job.words[:8], job.words[8:]
+        found = []
+        nonce = random.getrandbits(32)
+        while len(found) < self.shares:
+            nonce = uint32(nonce + 1)
+            if not hash(state, merkle_end, time, difficulty, nonce)[7] & self.verify_mask:
+                found.append(nonce)
+        with self.lock:
+            job.nonces = found
+
+    def result(self):
+        with self.lock:
+            job = self.job
+            if job is None:
+                return b'IDLE\n'
+            if monotonic() - job.started < self.job_time or job.nonces is None:
+                return b'BUSY\n'
+            self.job = None
+            if not job.nonces:
+                return b'NO-NONCE\n'
+            return b'NONCE-FOUND:%s\n' % b','.join(
+                b'%08x' % nonce for nonce in job.nonces)
+
+    def advance(self, now):
+        """Moves queued jobs whose time is up to the finished list."""
+        with self.lock:
+            while self.queued and self.queued[0].nonces is not None and (
+                    now - self.queued[0].started >= self.job_time):
+                job = self.queued.popleft()
+                self.finished.append(job)
+                if self.queued:
+                    self.queued[0].started = job.started + self.job_time
+                    self.job_started = self.queued[0].started
+
+    def queue_jobs(self, jobs):
+        now = monotonic()
+        self.advance(now)
+        if self.job is not None and now - self.job.started < self.job_time:
+            return b'BUSY\n'
+        if len(self.queued) + len(jobs) > QUEUE_SIZE:
+            return b'ERR:QUEUE FULL\n'
+        for data in jobs:
+            job = self.new_job(data)
+            with self.lock:
+                if not self.queued:
+                    self.begin(job, now)
+                self.queued.append(job)
+        return b'OK:QUEUED %d\n' % len(jobs)
+
+    def queue_results(self):
+        self.advance(monotonic())
+        with self.lock:
+            finished, self.finished = self.finished, []
+        lines = [b'COUNT:%d\n' % len(finished)]
+        for job in finished:
+            lines.append(b'%s,%s,%d%s\n' % (
+                job.data[:32].hex().encode(), job.data[32:].hex().encode(),
+                len(job.nonces), b''.join(b',%08x' % nonce for nonce in job.nonces)))
+        lines.append(b'OK\n')
+        return b''.join(lines)
+
+    def flush(self):
+        with self.lock:
+            flushed = len(self.queued)
+            self.queued.clear()
+            if flushed:
+                # Idle from now on.
+                self.job_started = monotonic() - self.job_time
+        return b'OK:FLUSHED %d\n' % flushed
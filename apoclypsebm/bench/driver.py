@@ -0,0 +1,320 @@
+"""
+End-to-end benchmark of the host side of mining.
+
+Runs the real Switch and work sources against one of the mock servers on
+localhost, fed by virtual devices that emit shares at a fixed rate, then
+reports job and share throughput, stale ratio and latency percentiles.
+With --bitforce, simulated BitFORCE devices on pseudo terminals mine too and
+the report shows how busy the host kept them.
+"""
+import sys
+from json import dumps
+from optparse import OptionParser
+from threading import Thread
+from time import monotonic, sleep
+
+from apoclypsebm import metrics
+from apoclypsebm.bench.bitforce import BitForceSimulator
+from apoclypsebm.bench.servers import (MockBitcoind, MockGetworkServer,
+                                       MockStratumPool)
+from apoclypsebm.mining import virtual
+from apoclypsebm.trace import Tracer
+
+# Only used to build coinbase transactions for the mock bitcoind.
+BENCH_ADDRESS = 'bc1qf2277gpv3hlewlqq2cuvf77qz5xcjzr7njf3s9'
+
+class BenchTracer(Tracer):
+    """Keeps every stage latency for exact percentiles."""
+
+    def __init__(self):
+        super().__init__()
+        self.latencies = {}
+
+    def record(self, trace, outcome):
+        super().record(trace, outcome)
+        for stage, latency in trace.latencies():
+            self.latencies.setdefault(stage, []).append(latency)
+
+    def block_restarted(self, pool, seconds):
+        super().block_restarted(pool, seconds)
+        self.latencies.setdefault('block restart', []).append(seconds)
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+parser = OptionParser(usage='usage: %prog [OPTION]...')
+parser.add_option('--source', default='stratum',
+                  choices=('stratum', 'getwork', 'gbt'),
+                  help='work source to benchmark: stratum, getwork or gbt, default=stratum')
+parser.add_option('--duration', default=30, type='float',
+                  help='seconds to run for, default=30')
+parser.add_option('--miners', default=1, type='int',
+                  help='number of virtual devices, default=1')
+parser.add_option('--mode', default='cpu', choices=virtual.MODES,
+                  help="virtual device mode, 'cpu' or 'replay', default=cpu")
+parser.add_option('--share-rate', dest='share_rate', default=50, type='float',
+                  help='shares per second per virtual device, default=50')
+parser.add_option('--share-bits', dest='share_bits', default=8, type='int',
+                  help='zero bits virtual shares need, default=8')
+parser.add_option('--notify-rate', dest='notify_rate', default=1, type='float',
+                  help='stratum notifies per second, default=1')
+parser.add_option('--block-interval', dest='block_interval', default=30,
+                  type='float', help='seconds between new blocks, default=30')
+parser.add_option('--difficulty', default=1, type='float',
+                  help='stratum share difficulty, default=1')
+parser.add_option('--difficulty-interval', dest='difficulty_interval',
+                  default=0, type='float',
+                  help='seconds between stratum difficulty changes, default=never')
+parser.add_option('--reconnect-interval', dest='reconnect_interval',
+                  default=0, type='float',
+                  help='seconds between the pool dropping connections, default=never')
+parser.add_option('--no-resume', dest='resume', action='store_false',
+                  default=True,
+                  help='have the mock stratum pool start a new session on '
+                       'every reconnect')
+parser.add_option('--merkle-branches', dest='merkle_branches', default=12,
+                  type='int', help='stratum merkle branch length, default=12')
+parser.add_option('--transactions', default=2000, type='int',
+                  help='transactions per block template, default=2000')
+parser.add_option('--transaction-size', dest='transaction_size', default=400,
+                  type='int', help='bytes per template transaction, default=400')
+parser.add_option('--template-refresh', dest='template_refresh', default=10,
+                  type='float',
+                  help='seconds between template updates on the same block, default=10')
+parser.add_option('--submit-coinbase', dest='submit_coinbase',
+                  action='store_true',
+                  help='have the mock bitcoind take blocks of just the header '
+                       'and coinbase (BIP 23 submit/coinbase)')
+parser.add_option('--block-notify', dest='block_notify', action='store_true',
+                  help='have the mock bitcoind publish new blocks over ZMQ '
+                       'and the miner subscribe')
+parser.add_option('--long-poll-delay', dest='long_poll_delay', default=0,
+                  type='float',
+                  help='seconds the mock bitcoind answers long polls after a '
+                       'new block, default=0')
+parser.add_option('--race-nodes', dest='race_nodes', default=0, type='int',
+                  help='more mock bitcoinds on the same chain for the miner '
+                       'to race, default=0')
+parser.add_option('--race-lag', dest='race_lag', default=0, type='float',
+                  help='seconds the raced mock bitcoinds see new blocks late, '
+                       'default=0')
+parser.add_option('--opencl', default='',
+                  help='comma separated OpenCL device IDs to mine on as well, '
+                       'e.g. a CPU device, default=none')
+parser.add_option('--bitforce', default=0, type='int',
+                  help='number of simulated BitFORCE devices, default=0')
+parser.add_option('--bitforce-job-time', dest='bitforce_job_time',
+                  default=0.2, type='float',
+                  help='seconds a simulated BitFORCE job takes, default=0.2')
+parser.add_option('--bitforce-delay', dest='bitforce_delay', default=0.001,
+                  type='float',
+                  help='seconds a simulated BitFORCE device takes to answer, default=0.001')
+parser.add_option('--bitforce-single', dest='bitforce_single',
+                  action='store_true',
+                  help='simulate BitFORCE firmware without a job queue')
+parser.add_option('--miner-option', dest='miner_options', action='append',
+                  default=[], help='extra apoclypse option, may be repeated')
+parser.add_option('--json', action='store_true',
+                  help='print the report as JSON')
+
+
+def start_server(options):
+    if options.source == 'stratum':
+        server = MockStratumPool(
+            notify_rate=options.notify_rate, difficulty=options.difficulty,
+            difficulty_interval=options.difficulty_interval,
+            block_interval=options.block_interval,
+            reconnect_interval=options.reconnect_interval,
+            resume=options.resume,
+            merkle_branches=options.merkle_branches)
+        url = 'stratum://bench:x@%s'
+    elif options.source == 'getwork':
+        server = MockGetworkServer(block_interval=options.block_interval)
+        url = 'getwork+http://bench:x@%s'
+    else:
+        server = MockBitcoind(
+            block_interval=options.block_interval,
+            refresh_interval=options.template_refresh,
+            transactions=options.transactions,
+            transaction_size=options.transaction_size,
+            submit_coinbase=options.submit_coinbase,
+            notify=options.block_notify,
+            long_poll_delay=options.long_poll_delay)
+        url = 'http://bench:x@%s'
+    server.start()
+    return server, url % server.address
+
+
+def start_race_nodes(options, server):
+    nodes = []
+    for _ in range(options.race_nodes):
+        nodes.append(MockBitcoind(
+            refresh_interval=options.template_refresh,
+            transactions=options.transactions,
+            transaction_size=options.transaction_size,
+            chain=server.chain, lag=options.race_lag).start())
+    return nodes
+
+
+def run(options):
+    from apoclypsebm.command import in_processes, parse_options
+    from apoclypsebm.switch import Switch
+
+    server, url = start_server(options)
+    nodes = start_race_nodes(options, server) if options.source == 'gbt' else []
+    devices = ['-d', options.opencl] if options.opencl else ['--no-ocl']
+    simulators = [BitForceSimulator(options.bitforce_job_time,
+                                    options.bitforce_delay,
+                                    queue=not options.bitforce_single)
+                  for _ in range(options.bitforce)]
+    if simulators:
+        devices += ['--bfl-port', ','.join(s.port for s in simulators)]
+    else:
+        devices.append('--no-bfl')
+    if getattr(server, 'publisher', None):
+        devices += ['--block-notify', server.publisher.address]
+    if nodes:
+        devices += ['--race-node', ','.join(
+            'http://bench:x@%s' % node.address for node in nodes)]
+    miner_options = parse_options(
+        ['-q', '--address', BENCH_ADDRESS] + devices + [
+         '--virtual', str(options.miners), '--virtual-mode', options.mode,
+         '--virtual-rate', str(options.share_rate),
+         '--virtual-bits', str(options.share_bits)]
+        + options.miner_options + [url])
+    switch = Switch(miner_options, 'utf-8')
+    switch.tracer = BenchTracer()
+    if options.opencl:
+        from apoclypsebm.mining import opencl
+        for miner in in_processes('opencl', opencl.initialize(miner_options),
+                                  miner_options):
+            switch.add_miner(miner)
+    if simulators:
+        from apoclypsebm.mining import bfl
+        miners = bfl.initialize(miner_options)
+        for miner, simulator in zip(miners, simulators):
+            miner.verify_mask = simulator.verify_mask
+            simulator.start()
+        for miner in in_processes('bfl', miners, miner_options):
+            switch.add_miner(miner)
+    for miner in in_processes('virtual', virtual.initialize(miner_options),
+                              miner_options):
+        switch.add_miner(miner)
+
+    started = monotonic()
+    for miner in switch.miners:
+        miner.start()
+    Thread(target=switch.loop, daemon=True).start()
+    try:
+        sleep(options.duration)
+    finally:
+        for miner in switch.miners:
+            miner.stop()
+        switch.stop()
+        server.stop()
+        for node in nodes:
+            node.stop()
+        for simulator in simulators:
+            simulator.stop()
+    return report(options, server, switch, monotonic() - started, simulators,
+                  nodes)
+
+
+def report(options, server, switch, duration, simulators=(), nodes=()):
+    stats = server.stats
+    found = metrics.SHARES.sum(result='found')
+    # Client side stales include results dropped before verification.
+    stale = stats.stale + metrics.SHARES.sum(result='stale')
+    submitted = stats.accepted + stats.duplicate + stats.invalid + stale
+    latencies = {'job age at pool': stats.job_ages}
+    latencies.update(switch.tracer.latencies)
+    return {
+        'source': options.source,
+        'duration': duration,
+        'miners': options.miners,
+        'mode': options.mode,
+        'jobs': stats.jobs,
+        'jobs_per_second': stats.jobs / duration,
+        'jobs_consumed': sum(getattr(miner, 'jobs', 0)
+                             for miner in switch.miners),
+        'shares_found': found,
+        'shares_per_second': stats.accepted / duration,
+        'accepted': stats.accepted,
+        'stale': stale,
+        'duplicate': stats.duplicate,
+        'invalid': stats.invalid,
+        'stale_ratio': stale / submitted if submitted else 0,
+        'connections': stats.connections,
+        'resumed': stats.resumed,
+        'block_bytes': (server.submitted_bytes / server.submitted_blocks
+                        if getattr(server, 'submitted_blocks', 0) else 0),
+        'hash_rate_mhs': {miner.id(): miner.hashes / duration / 1000000
+                          for miner in switch.miners if miner.hashes},
+        'nodes': [{'address': node.address,
+                   'blocks': node.submitted_blocks,
+                   'template_lag_p50': metrics.TEMPLATE_LAG_SECONDS.labels(
+                       node.address).quantile(.5),
+                   'submit_p50': metrics.SUBMIT_SECONDS.labels(
+                       node.address).quantile(.5)}
+                  for node in ([server] + list(nodes) if nodes else ())],
+        'bitforce': [{'port': simulator.port, 'jobs': simulator.jobs,
+                      'utilization': simulator.utilization(duration)}
+                     for simulator in simulators],
+        'latency': {
+            stage: {'p50': percentile(values, .5),
+                    'p90': percentile(values, .9),
+                    'p99': percentile(values, .99),
+                    'count': len(values)}
+            for stage, values in latencies.items()
+        }
+    }
+
+
+def print_report(result):
+    print('\n%s for %.1fs with %d %s miner(s), %d connection(s), %d resumed' % (
+        result['source'], result['duration'], result['miners'], result['mode'],
+        result['connections'], result['resumed']))
+    print('jobs:    %d sent (%.2f/s), %d consumed by miners' % (
+        result['jobs'], result['jobs_per_second'], result['jobs_consumed']))
+    print('shares:  %d found, %d accepted (%.1f/s), %d stale (%.2f%%), '
+          '%d duplicate, %d invalid' % (
+              result['shares_found'], result['accepted'],
+              result['shares_per_second'], result['stale'],
+              result['stale_ratio'] * 100, result['duplicate'],
+              result['invalid']))
+    if result['block_bytes']:
+        print('blocks:  %d bytes submitted per block' % result['block_bytes'])
+    for device, rate in result['hash_rate_mhs'].items():
+        print('hashing: %.3f MH/s on %s' % (rate, device))
+    for node in result['nodes']:
+        print('node:    %d blocks, template lag p50 <= %.1f ms, submit p50 <= '
+              '%.1f ms on %s' % (node['blocks'], node['template_lag_p50'] * 1000,
+                                 node['submit_p50'] * 1000, node['address']))
+    for simulator in result['bitforce']:
+        print('bitforce: %d jobs, %.1f%% busy on %s' % (
+            simulator['jobs'], simulator['utilization'] * 100,
+            simulator['port']))
+    print('latency (ms)         p50        p90        p99      count')
+    for stage, latency in result['latency'].items():
+        print('  %-16s %9.2f  %9.2f  %9.2f  %9d' % (
+            stage, latency['p50'] * 1000, latency['p90'] * 1000,
+            latency['p99'] * 1000, latency['count']))
+
+
+def main(args=None):
+    options, _ = parser.parse_args(args)
+    result = run(options)
+    if options.json:
+        print(dumps(result))
+    else:
+        print_report(result)
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,619 @@
+"""
+In-process stand-ins for a stratum pool, a getwork server and a bitcoind
+getblocktemplate/submitblock/longpoll endpoint with its ZMQ block
+notifications.
+
+They don't validate proof of work, they only produce job churn and account
+for what the miner sends back: accepted, stale and duplicate submissions and
+how old the job was when a share for it arrived.
+"""
+import os
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from struct import pack
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep, time
+
+from apoclypsebm import zmtp
+from apoclypsebm.util import chunks
+
+DIFF1_TARGET = ('00000000ffff0000000000000000000000000000000000000000000000000000')
+NBITS = '1d00ffff'
+
+
+def double_sha256(data):
+    return sha256(sha256(data).digest()).digest()
+
+
+def word_swap(data):
+    return b''.join(word[::-1] for word in chunks(data, 4))
+
+
+class Stats(object):
+    """Submission accounting shared by the mock servers."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = monotonic()
+        self.jobs = 0
+        self.accepted = 0
+        self.stale = 0
+        self.duplicate = 0
+        self.invalid = 0
+        self.job_ages = []
+        self.connections = 0
+        self.resumed = 0
+
+    def job(self):
+        with self.lock:
+            self.jobs += 1
+
+    def submission(self, outcome, job_age=None):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if job_age is not None:
+                self.job_ages.append(job_age)
+
+
+class Chain(object):
+    """Current block the mocks are building on, advanced by a timer."""
+
+    def __init__(self, block_interval):
+        self.block_interval = block_interval
+        self.changed = Condition()
+        self.height = 700000
+        self.new_block()
+
+    def new_block(self):
+        with self.changed:
+            self.height += 1
+            self.prevhash = os.urandom(32)
+            self.block_found = monotonic()
+            self.changed.notify_all()
+
+    def wait(self, prevhash, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.prevhash != prevhash, timeout)
+
+
+class TCPServer(ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class HTTPServer(ThreadingHTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class MockServer(object):
+    """Base for the mocks: owns the server thread and the churn thread.
+
+    :param chain: another mock's chain to follow rather than advancing one
+        of its own, lag seconds behind
+    """
+
+    def __init__(self, block_interval=30, refresh_interval=1.0, chain=None,
+                 lag=0):
+        self.stats = Stats()
+        self.chain = chain or Chain(block_interval)
+        self.leader = chain is None
+        self.lag = lag
+        self.refresh_interval = refresh_interval
+        self.should_stop = False
+        self.server = None
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server.server_address[:2]
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        Thread(target=self.churn_thread, daemon=True).start()
+        if not self.leader:
+            Thread(target=self.follow_thread, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.should_stop = True
+        self.server.shutdown()
+        self.server.server_close()
+
+    def churn_thread(self):
+        last_block = monotonic()
+        while not self.should_stop:
+            sleep(self.refresh_interval)
+            now = monotonic()
+            if self.leader and self.chain.block_interval and (
+                    now - last_block >= self.chain.block_interval):
+                last_block = now
+                self.chain.new_block()
+                self.refresh(clean=True)
+            else:
+                self.refresh(clean=False)
+
+    def follow_thread(self):
+        prevhash = self.chain.prevhash
+        while not self.should_stop:
+            self.chain.wait(prevhash, 1)
+            if self.chain.prevhash != prevhash:
+                prevhash = self.chain.prevhash
+                sleep(self.lag)
+                self.refresh(clean=True)
+
+    def refresh(self, clean):
+        pass
+
+
+class StratumHandler(StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.send_lock = Lock()
+        self.pool = self.server.pool
+        self.extranonce1 = os.urandom(4).hex()
+        # Jobs notified before the session started aren't known to it.
+        self.first_job = self.pool.job_counter
+        self.submitted = set()
+        self.version_mask = 0
+
+    def send(self, message):
+        data = (dumps(message) + '\n').encode('utf-8')
+        with self.send_lock:
+            try:
+                self.wfile.write(data)
+            except OSError:
+                # Dropped, handle() finds out.
+                pass
+
+    def handle(self):
+        self.pool.stats.connections += 1
+        self.pool.add_client(self)
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                message = loads(line)
+                reply = self.pool.handle_message(self, message)
+                if reply is not None:
+                    self.send({'id': message.get('id'), 'result': reply[0],
+                               'error': reply[1]})
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.pool.remove_client(self)
+
+
+class MockStratumPool(MockServer):
+    """
+    :param notify_rate: mining.notify messages per second
+    :param difficulty: share difficulty, alternates with twice its value
+        every difficulty_interval seconds if that is set
+    :param block_interval: seconds between new prevhashes, sent with
+        clean_jobs set
+    :param reconnect_interval: seconds between dropping every connection
+    :param merkle_branches: length of the merkle branch, 12 is roughly a
+        4000 transaction block
+    :param version_mask: block version bits miners may roll, offered to
+        those that ask with mining.configure
+    :param resume: let miners resume their session, extranonce1 and jobs, by
+        subscribing with its id
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, notify_rate=1.0,
+                 difficulty=1, difficulty_interval=0, block_interval=30,
+                 reconnect_interval=0, merkle_branches=12,
+                 extranonce2_size=4, version_mask=0x1FFFE000, resume=True):
+        super().__init__(block_interval, 1.0 / notify_rate)
+        self.difficulty = self.base_difficulty = difficulty
+        self.difficulty_interval = difficulty_interval
+        self.reconnect_interval = reconnect_interval
+        self.merkle_branches = merkle_branches
+        self.extranonce2_size = extranonce2_size
+        self.version_mask = version_mask
+        self.resume = resume
+        self.sessions = {}
+        self.clients = set()
+        self.clients_lock = Lock()
+        self.jobs = {}
+        self.job_counter = 0
+        self.current_job = None
+        self.server = TCPServer((host, port), StratumHandler)
+        self.server.pool = self
+        self.refresh(clean=True)
+
+    def start(self):
+        super().start()
+        if self.difficulty_interval:
+            Thread(target=self.difficulty_thread, daemon=True).start()
+        if self.reconnect_interval:
+            Thread(target=self.reconnect_thread, daemon=True).start()
+        return self
+
+    def add_client(self, client):
+        with self.clients_lock:
+            self.clients.add(client)
+
+    def remove_client(self, client):
+        with self.clients_lock:
+            self.clients.discard(client)
+
+    def broadcast(self, message):
+        with self.clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            if getattr(client, 'authorized', False):
+                client.send(message)
+
+    def refresh(self, clean):
+        self.job_counter += 1
+        job_id = '%x' % self.job_counter
+        job = [
+            job_id,
+            word_swap(self.chain.prevhash).hex(),
+            # coinbase1 and coinbase2 around the extranonces
+            os.urandom(42).hex(),
+            os.urandom(60).hex(),
+            [os.urandom(32).hex() for _ in range(self.merkle_branches)],
+            '20000000',
+            NBITS,
+            '%08x' % int(time()),
+            clean
+        ]
+        if clean:
+            self.jobs.clear()
+        self.jobs[job_id] = monotonic()
+        self.current_job = job
+        self.stats.job()
+        self.broadcast({'id': None, 'method': 'mining.notify', 'params': job})
+
+    def difficulty_thread(self):
+        while not self.should_stop:
+            sleep(self.difficulty_interval)
+            if self.difficulty == self.base_difficulty:
+                self.difficulty = self.base_difficulty * 2
+            else:
+                self.difficulty = self.base_difficulty
+            self.broadcast({'id': None, 'method': 'mining.set_difficulty',
+                            'params': [self.difficulty]})
+
+    def reconnect_thread(self):
+        while not self.should_stop:
+            sleep(self.reconnect_interval)
+            with self.clients_lock:
+                clients = list(self.clients)
+            for client in clients:
+                try:
+                    client.connection.shutdown(2)
+                except OSError:
+                    pass
+
+    def handle_message(self, client, message):
+        method = message.get('method')
+        params = message.get('params') or []
+        if method == 'mining.subscribe':
+            session = self.resume and len(params) > 1 and self.sessions.get(params[1])
+            if session:
+                client.extranonce1, client.first_job = session
+                self.stats.resumed += 1
+            self.sessions[client.extranonce1] = (client.extranonce1,
+                                                 client.first_job)
+            return [[['mining.notify', client.extranonce1]],
+                    client.extranonce1, self.extranonce2_size], None
+        elif method == 'mining.extranonce.subscribe':
+            return True, None
+        elif method == 'mining.configure':
+            if 'version-rolling' not in params[0]:
+                return {}, None
+            client.version_mask = self.version_mask & int(
+                params[1].get('version-rolling.mask', 'ffffffff'), 16)
+            return {'version-rolling': True,
+                    'version-rolling.mask': '%08x' % client.version_mask}, None
+        elif method == 'mining.authorize':
+            client.authorized = True
+            # Replies go out before the first job, like real pools.
+            Thread(target=self.welcome, args=(client,), daemon=True).start()
+            return True, None
+        elif method == 'mining.submit':
+            return self.submit(client, params)
+        return None, [20, 'Unsupported method', None]
+
+    def welcome(self, client):
+        sleep(0.01)
+        client.send({'id': None, 'method': 'mining.set_difficulty',
+                     'params': [self.difficulty]})
+        client.send({'id': None, 'method': 'mining.notify',
+                     'params': self.current_job})
+
+    def submit(self, client, params):
+        job_id = params[1]
+        received = self.jobs.get(job_id)
+        if received is None or int(job_id, 16) < client.first_job:
+            self.stats.submission('stale')
+            return False, [21, 'Job not found', None]
+        if len(params[2]) != self.extranonce2_size * 2:
+            self.stats.submission('invalid')
+            return False, [20, 'Wrong extranonce2 size', None]
+        if len(params) > 5 and int(params[5], 16) & ~client.version_mask:
+            self.stats.submission('invalid')
+            return False, [20, 'Version bits outside the mask', None]
+        key = tuple(params[1:])
+        if key in client.submitted:
+            self.stats.submission('duplicate')
+            return False, [22, 'Duplicate share', None]
+        client.submitted.add(key)
+        self.stats.submission('accepted', monotonic() - received)
+        return True, None
+
+
+class JSONRPCHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format_, *args):
+        pass
+
+    def reply(self, result, headers=None):
+        body = dumps({'result': result, 'error': None, 'id': 'json'}).encode(
+            'utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.mock.handle_get(self)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = loads(self.rfile.read(length))
+        self.server.mock.handle_rpc(self, request.get('method'),
+                                    request.get('params') or [])
+
+
+class MockHTTPServer(MockServer):
+    def __init__(self, host, port, block_interval, refresh_interval,
+                 chain=None, lag=0):
+        super().__init__(block_interval, refresh_interval, chain, lag)
+        self.server = HTTPServer((host, port), JSONRPCHandler)
+        self.server.mock = self
+
+    def handle_get(self, handler):
+        handler.send_error(404)
+
+
+class MockGetworkServer(MockHTTPServer):
+    """getwork with X-Long-Polling and X-Roll-NTime."""
+
+    def __init__(self, host='127.0.0.1', port=0, block_interval=30,
+                 long_poll_timeout=60):
+        super().__init__(host, port, block_interval, 1.0)
+        self.long_poll_timeout = long_poll_timeout
+        self.headers = {'X-Long-Polling': '/lp', 'X-Roll-NTime': 'expire=120'}
+        self.issued = {}
+
+    def work(self):
+        merkle_root = os.urandom(32)
+        header = b''.join((pack('<I', 0x20000000), self.chain.prevhash,
+                           merkle_root, pack('<I', int(time())),
+                           bytes.fromhex(NBITS)[::-1], pack('<I', 0)))
+        self.issued[merkle_root] = monotonic()
+        self.stats.job()
+        padding = bytes.fromhex('80' + '00' * 39 + '80020000')
+        return {
+            'data': (word_swap(header) + word_swap(padding)).hex(),
+            'target': bytes.fromhex(DIFF1_TARGET)[::-1].hex()
+        }
+
+    def handle_get(self, handler):
+        if handler.path != '/lp':
+            handler.send_error(404)
+            return
+        self.chain.wait(self.chain.prevhash, self.long_poll_timeout)
+        handler.reply(self.work(), self.headers)
+
+    def handle_rpc(self, handler, method, params):
+        if method != 'getwork':
+            handler.send_error(404)
+        elif not params:
+            handler.reply(self.work(), self.headers)
+        else:
+            header = word_swap(bytes.fromhex(params[0])[:80])
+            issued = self.issued.get(header[36:68])
+            if header[4:36] != self.chain.prevhash or issued is None:
+                self.stats.submission('stale')
+                handler.reply(False, self.headers)
+            else:
+                self.stats.submission('accepted', monotonic() - issued)
+                handler.reply(True, self.headers)
+
+
+class BlockPublisherHandler(StreamRequestHandler):
+    def handle(self):
+        self.topics = set()
+        self.send_lock = Lock()
+        self.connection = zmtp.Connection(self.request)
+        try:
+            self.connection.handshake(b'PUB', as_server=True)
+            self.server.publisher.add(self)
+            while True:
+                subscription, = self.connection.read_message()
+                if subscription[:1] == b'\x01':
+                    self.topics.add(subscription[1:])
+                else:
+                    self.topics.discard(subscription[1:])
+        except (OSError, ValueError, zmtp.ProtocolError):
+            pass
+        finally:
+            self.server.publisher.remove(self)
+
+    def publish(self, frames):
+        if any(frames[0].startswith(topic) for topic in self.topics):
+            try:
+                with self.send_lock:
+                    self.connection.send_message(frames)
+            except OSError:
+                pass
+
+
+class MockBlockPublisher(object):
+    """A ZMQ PUB endpoint sending what bitcoind -zmqpubhashblock does."""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = TCPServer((host, port), BlockPublisherHandler)
+        self.server.publisher = self
+        self.subscribers = set()
+        self.lock = Lock()
+        self.sequence = 0
+
+    @property
+    def address(self):
+        return 'tcp://%s:%d' % self.server.server_address[:2]
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add(self, subscriber):
+        with self.lock:
+            self.subscribers.add(subscriber)
+
+    def remove(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, topic, body):
+        with self.lock:
+            subscribers = list(self.subscribers)
+            frames = [topic, body, pack('<I', self.sequence)]
+            self.sequence += 1
+        for subscriber in subscribers:
+            subscriber.publish(frames)
+
+
+class MockBitcoind(MockHTTPServer):
+    """
+    getblocktemplate with longpoll, plus submitblock.
+
+    :param transactions: transactions in every template
+    :param transaction_size: bytes of each transaction
+    :param refresh_interval: seconds between template changes on the same
+        block, which answer long polls like a mempool update would
+    :param submit_coinbase: advertise BIP 23 submit/coinbase and workid, so
+        blocks come as the header and coinbase only
+    :param notify: publish new block hashes like -zmqpubhashblock, on
+        publisher.address
+    :param long_poll_delay: seconds long polls are answered after a new
+        block, as a node busy validating it would
+    :param chain: another mock bitcoind's chain, seen lag seconds late, as
+        a second node would
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, block_interval=30,
+                 refresh_interval=10, transactions=2000, transaction_size=400,
+                 long_poll_timeout=60, submit_coinbase=False, notify=False,
+                 long_poll_delay=0, chain=None, lag=0):
+        super().__init__(host, port, block_interval, refresh_interval, chain,
+                         lag)
+        self.submit_coinbase = submit_coinbase
+        self.publisher = MockBlockPublisher(host) if notify else None
+        self.long_poll_delay = long_poll_delay
+        self.transaction_count = transactions
+        self.transaction_size = transaction_size
+        self.long_poll_timeout = long_poll_timeout
+        self.template_changed = Condition()
+        self.submitted_blocks = 0
+        self.submitted_bytes = 0
+        self.refresh(clean=True)
+
+    def make_transaction(self):
+        data = os.urandom(self.transaction_size)
+        txid = double_sha256(data)[::-1].hex()
+        return {'data': data.hex(), 'txid': txid, 'hash': txid, 'fee': 1000,
+                'sigops': 4, 'weight': self.transaction_size * 4,
+                'depends': []}
+
+    def start(self):
+        if self.publisher:
+            self.publisher.start()
+        return super().start()
+
+    def stop(self):
+        super().stop()
+        if self.publisher:
+            self.publisher.stop()
+
+    def refresh(self, clean):
+        if clean:
+            self.prevhash, self.height = self.chain.prevhash, self.chain.height
+        if clean and hasattr(self, 'template_id'):
+            if self.publisher:
+                self.publisher.publish(b'hashblock', self.prevhash[::-1])
+            sleep(self.long_poll_delay)
+        if clean or not hasattr(self, 'transactions'):
+            self.transactions = [self.make_transaction()
+                                 for _ in range(self.transaction_count)]
+        else:
+            # Mempool churn: a tenth of the template is replaced.
+            replace = max(self.transaction_count // 10, 1)
+            self.transactions = self.transactions[replace:] + [
+                self.make_transaction() for _ in range(replace)]
+        with self.template_changed:
+            self.template_id = os.urandom(8).hex()
+            self.template_time = monotonic()
+            self.template_changed.notify_all()
+
+    def template(self):
+        self.stats.job()
+        template = {
+            'version': 0x20000000,
+            'rules': ['segwit'],
+            'previousblockhash': self.prevhash[::-1].hex(),
+            'transactions': self.transactions,
+            'coinbasevalue': 625000000,
+            'longpollid': self.template_id,
+            'target': DIFF1_TARGET,
+            'mintime': int(time()) - 600,
+            'mutable': ['time', 'transactions', 'prevblock'],
+            'noncerange': '00000000ffffffff',
+            'curtime': int(time()),
+            'bits': NBITS,
+            'height': self.height,
+            'default_witness_commitment':
+                '6a24aa21a9ed' + os.urandom(32).hex(),
+        }
+        if self.submit_coinbase:
+            template['mutable'].append('submit/coinbase')
+            template['workid'] = self.template_id
+        return template
+
+    def handle_rpc(self, handler, method, params):
+        if method == 'getblocktemplate':
+            param = params[0] if params else {}
+            long_poll_id = param.get('longpollid')
+            if long_poll_id:
+                with self.template_changed:
+                    self.template_changed.wait_for(
+                        lambda: self.template_id != long_poll_id,
+                        self.long_poll_timeout)
+            handler.reply(self.template())
+        elif method == 'submitblock':
+            block = bytes.fromhex(params[0])
+            self.submitted_blocks += 1
+            self.submitted_bytes += len(block)
+            if block[4:36] != self.prevhash:
+                self.stats.submission('stale')
+                handler.reply('stale-prevblk')
+            else:
+                self.stats.submission(
+                    'accepted', monotonic() - self.template_time)
+                handler.reply(None)
+        else:
+            handler.send_error(404)
@@ -16,9 +16,11 @@ class LongPollingSocket(socket.socket):
     Socket wrapper to enable socket.TCP_NODELAY and KEEPALIVE
     """
 
-    def __init__(self, family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0):
-        super(LongPollingSocket, self).__init__(family, type, proto)
-        if type == socket.SOCK_STREAM:
+    def __init__(self, family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0,
+                 fileno=None):
+        super(LongPollingSocket, self).__init__(family, type, proto, fileno)
+        if type == socket.SOCK_STREAM and family in (socket.AF_INET,
+                                                     socket.AF_INET6):
             self.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         self.settimeout(20)
@@ -38,8 +40,22 @@ parser.add_option('--proxy', dest='proxy', default='',
                   help='specify as [[socks4|socks5|http://]user:pass@]host:port (default proto is socks5)')
 parser.add_option('--no-ocl', dest='no_ocl', action='store_true', help="don't use OpenCL")
 parser.add_option('--no-bfl', dest='no_bfl', action='store_true', help="don't use Butterfly Labs")
+parser.add_option('--bfl-port', dest='bfl_port', default=[],
+                  help='comma separated serial ports of BitFORCE devices, skips searching for them')
+parser.add_option('--no-bfl-queue', dest='no_bfl_queue', action='store_true',
+                  help="send BitFORCE devices one job at a time even if their firmware can queue jobs")
+parser.add_option('--bfl-cache', dest='bfl_cache',
+                  help='file remembering the ports BitFORCE devices were found on, so they are attached at once on the next start while other ports are searched in the background')
+parser.add_option('--probe-timeout', dest='probe_timeout', default=0.5, type='float',
+                  help='seconds a serial port gets to answer when searching for devices, all ports are searched at once, default=0.5')
 parser.add_option('--stratum-proxies', dest='stratum_proxies', action='store_true',
                   help="search for and use stratum proxies in subnet")
+parser.add_option('--version-rolling', dest='version_rolling', default=0, type='int',
+                  help='block versions to mine from each stratum merkle root where the pool allows rolling version bits (BIP 310), default=0 (off)')
+parser.add_option('--block-notify', dest='block_notify', default='',
+                  help='ZMQ endpoint publishing new block hashes, e.g. tcp://127.0.0.1:28332 for bitcoind -zmqpubhashblock, to fetch a getblocktemplate as soon as a block is found. Long polling is still used as a fallback.')
+parser.add_option('--race-node', dest='race_nodes', default=[],
+                  help='comma separated getblocktemplate URLs of more nodes to race for work on new blocks, found blocks are submitted to all of them')
 parser.add_option('-d', '--device', dest='device', default=[],
                   help='comma separated device IDs, by default will use all (for OpenCL - only GPU devices)')
 parser.add_option('-a', '--address', dest='address',
@@ -57,12 +73,23 @@ group.add_option('-t', '--tolerance', dest='tolerance', default=2,
 group.add_option('-b', '--failback', dest='failback', default=60,
                  help='attempt to fail back to the primary pool after N seconds, default 60', type='int')
 group.add_option('--cutoff-temp', dest='cutoff_temp', default=[],
-                 help='AMD GPUs, BFL only. For GPUs requires github.com/mjmvisser/adl3. Comma separated temperatures at'
-                      ' which to skip kernel execution, in C, default=95')
+                 help='AMD GPUs, BFL and GPUs with Linux hwmon sensors only. For AMD GPUs without hwmon requires'
+                      ' github.com/mjmvisser/adl3. Comma separated temperatures at which to skip kernel execution,'
+                      ' in C, default=95')
 group.add_option('--cutoff-interval', dest='cutoff_interval', default=[],
                  help='how long to not execute calculations if CUTOFF_TEMP is reached, in seconds, default=0.01')
+group.add_option('--target-temp', dest='target_temp', default=[],
+                 help='GPUs only. Comma separated temperatures above which kernel execution is throttled in'
+                      ' proportion, reaching a stop at CUTOFF_TEMP, in C, default=10 below CUTOFF_TEMP')
+group.add_option('--target-power', dest='target_power', default=[],
+                 help='GPUs with Linux hwmon sensors only. Comma separated power draws to throttle kernel'
+                      ' execution to, in watts, default=0 (no limit)')
+group.add_option('--no-hwmon', dest='no_hwmon', action='store_true',
+                 help="don't read GPU sensors from Linux hwmon")
 group.add_option('--no-server-failbacks', dest='nsf', action='store_true',
                  help='disable using failback hosts provided by server')
+group.add_option('--device-processes', dest='device_processes', default=0, type='int',
+                 help='run devices in worker processes, N devices per process, default=0 runs them as threads')
 parser.add_option_group(group)
 
 group = OptionGroup(parser,
@@ -81,16 +108,71 @@ group.add_option('-f', '--frames', dest='frames', default=[],
                  help='will try to bring single kernel execution to 1/frames seconds, default=30, increase this for'
                       ' less desktop lag')
 group.add_option('-s', '--sleep', dest='frame_sleep', default=[], help='sleep per frame in seconds, default 0')
-group.add_option('--vv', dest='vectors', default=[], help='Specifies size of SIMD vectors per selected device. Only size 0 (no vectors) and 2 supported for now. Comma separated for each device. e.g. 0,2,2')
+group.add_option('--vv', dest='vectors', default=[], help='Specifies size of SIMD vectors per selected device: 0 (no vectors), 2, 4 or 8. Comma separated for each device. e.g. 0,2,4. Defaults to 0 for GPUs and to the preferred width for CPUs')
 group.add_option('-v', '--vectors', dest='old_vectors', action='store_true', help='Use 2-item vectors for all devices.')
+group.add_option('--ntime-roll', dest='ntime_roll', default=[],
+                 help='apoclypse-0 kernel only. Number of ntime values each launch searches, rolled on the device'
+                      ' where the source allows rolling, default=1 rolls ntime on the host once per second')
+group.add_option('--launch-sizes', dest='launch_sizes',
+                 help='file remembering the launch size each device settled on, so the next run starts there')
+group.add_option('--ocl-cpu', dest='ocl_cpu', action='store_true',
+                 help='also use CPU OpenCL devices when no devices are specified')
+group.add_option('--scheduler', dest='scheduler', action='store_true',
+                 help='drive all OpenCL devices from one thread instead of a thread per device')
 parser.add_option_group(group)
 
+group = OptionGroup(parser, "Virtual Device Options",
+                    "Virtual devices emit synthetic shares for real jobs to load test "
+                    "share verification and submission without hardware.")
+group.add_option('--virtual', dest='virtual', default=0, type='int',
+                 help='number of virtual devices to add, default=0')
+group.add_option('--virtual-mode', dest='virtual_mode', default='cpu',
+                 choices=('cpu', 'replay'),
+                 help="'cpu' searches for every share, 'replay' resubmits a set of nonces found once per job, default=cpu")
+group.add_option('--virtual-rate', dest='virtual_rate', default=100, type='float',
+                 help='shares per second per virtual device, default=100')
+group.add_option('--virtual-bits', dest='virtual_bits', default=8, type='int',
+                 help='zero bits a virtual share needs, 0 skips hashing entirely, default=8')
+parser.add_option_group(group)
 
-def main():
-    options, options.servers = parser.parse_args()
+group = OptionGroup(parser, "Stratum Proxy Options",
+                    "Serve the upstream stratum session to other miners, "
+                    "each mining its own part of the extranonce2 space.")
+group.add_option('--proxy-port', dest='proxy_port', default=0, type='int',
+                 help='port to accept stratum miners on, default=0 (off)')
+group.add_option('--proxy-host', dest='proxy_host', default='0.0.0.0',
+                 help='address to accept stratum miners on, default=0.0.0.0')
+parser.add_option_group(group)
+
+group = OptionGroup(parser, "Monitoring Options")
+group.add_option('--metrics-port', dest='metrics_port', default=0, type='int',
+                 help='serve Prometheus metrics over HTTP on this port, disabled by default')
+group.add_option('--metrics-host', dest='metrics_host', default='127.0.0.1',
+                 help='address to bind the metrics server to, default=127.0.0.1')
+group.add_option('--log-json', dest='log_json',
+                 help="also write log messages as JSON lines to this file, '-' for stdout only")
+group.add_option('--trace-file', dest='trace_file',
+                 help='append sampled share lifecycle traces to this file as JSON lines')
+group.add_option('--trace-sample', dest='trace_sample', default=0.01, type='float',
+                 help='fraction of shares written to the trace file, default=0.01')
+group.add_option('--api-listen', dest='api_listen', action='store_true',
+                 help='serve the cgminer compatible JSON API')
+group.add_option('--api-port', dest='api_port', default=4028, type='int',
+                 help='port for the API, default=4028')
+group.add_option('--api-network', dest='api_network', action='store_true',
+                 help='accept API connections from any address instead of only localhost')
+group.add_option('--api-control', dest='api_control', action='store_true',
+                 help='allow API commands that switch pools and change or disable devices')
+parser.add_option_group(group)
+
+
+def parse_options(args=None):
+    options, options.servers = parser.parse_args(args)
 
     log.verbose = options.verbose
     log.quiet = options.quiet
+    if options.log_json:
+        log.log_json(options.log_json)
 
     options.rate = max(options.rate, 60) if options.verbose else max(options.rate, 0.1)
 
@@ -99,9 +181,28 @@ def main():
     options.max_update_time = 60
 
     options.device = tokenize(options.device, 'device', [])
+    options.bfl_port = tokenize(options.bfl_port, 'bfl_port', [], str)
+    options.race_nodes = tokenize(options.race_nodes, 'race_node', [], str)
 
     options.cutoff_temp = tokenize(options.cutoff_temp, 'cutoff_temp', [95], float)
     options.cutoff_interval = tokenize(options.cutoff_interval, 'cutoff_interval', [0.01], float)
+    options.target_temp = tokenize(options.target_temp, 'target_temp', [], float)
+    options.target_power = tokenize(options.target_power, 'target_power', [0], float)
+
+    if not 0 <= options.virtual_bits <= 32:
+        parser.error('--virtual-bits must be between 0 and 32')
+    return options
+
+
+def in_processes(backend, miners, options):
+    if not options.device_processes or not miners:
+        return miners
+    from apoclypsebm.mining import process
+    return process.initialize(backend, miners, options)
+
+
+def main():
+    options = parse_options()
 
     options_encoding = sys.stdin.encoding
 
@@ -109,18 +210,39 @@ def main():
     try:
         switch = Switch(options, options_encoding)
 
+        if options.metrics_port:
+            from apoclypsebm import metrics
+            metrics.start_server(options.metrics_host, options.metrics_port)
+
         if not options.no_ocl:
             from apoclypsebm.mining import opencl
 
-            for miner in opencl.initialize(options):
+            for miner in in_processes('opencl', opencl.initialize(options), options):
                 switch.add_miner(miner)
 
         if not options.no_bfl:
             from apoclypsebm.mining import bfl
 
-            for miner in bfl.initialize(options):
+            for miner in in_processes('bfl', bfl.initialize(options), options):
                 switch.add_miner(miner)
 
+        if options.virtual:
+            from apoclypsebm.mining import virtual
+
+            for miner in in_processes('virtual', virtual.initialize(options), options):
+                switch.add_miner(miner)
+
+        if options.proxy_port:
+            from apoclypsebm import proxy
+            switch.stratum_proxy = proxy.StratumProxy(
+                options.proxy_host, options.proxy_port).start()
+
+        if options.api_listen:
+            from apoclypsebm import api
+            api.start_server(
+                switch, '0.0.0.0' if options.api_network else '127.0.0.1',
+                options.api_port, options.api_control)
+
         if not switch.servers:
             print('\nAt least one server is required\n')
         elif not switch.miners:
@@ -128,6 +250,8 @@ def main():
         else:
             for miner in switch.miners:
                 miner.start()
+            if not options.no_bfl:
+                bfl.watch(switch, options)
             switch.loop()
     except KeyboardInterrupt:
         print('\nbye')
@@ -140,6 +264,7 @@ def main():
         if not options.no_ocl:
             opencl.shutdown()
     sleep(1.1)
+    log.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+"""
+Temperature, fan and power readings from Linux hwmon, and throttling on them.
+
+GPU drivers such as amdgpu publish their sensors as a hwmon directory under
+the PCI device, reachable from /sys/class/drm/cardN/device/hwmon and from
+/sys/class/hwmon. One sampler thread reads every watched device once a
+second, publishes the readings as metrics and works out how much of the
+time each device may compute to hold its temperature and power targets.
+"""
+import os
+from collections import deque
+from glob import glob
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+from apoclypsebm import metrics
+from apoclypsebm.log import say_exception
+
+SYSFS_ROOT = '/sys'
+SAMPLE_INTERVAL = 1
+# Hashes per joule are measured over this many seconds.
+EFFICIENCY_WINDOW = 60
+# A device held to a power target never drops below this duty cycle, so
+# there is always some load to measure.
+MIN_POWER_DUTY = 0.05
+
+
+class Sensor(object):
+    """The hwmon directory of one device."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self, name, scale=1):
+        try:
+            with open(os.path.join(self.path, name)) as value:
+                return int(value.read()) / scale
+        except (OSError, ValueError):
+            return None
+
+    def temperature(self):
+        """In degrees Celsius."""
+        return self.read('temp1_input', 1000)
+
+    def fan(self):
+        """In RPM."""
+        return self.read('fan1_input')
+
+    def power(self):
+        """In watts, averaged by the driver where it can."""
+        power = self.read('power1_average', 1000000)
+        if power is None:
+            power = self.read('power1_input', 1000000)
+        return power
+
+
+def find_sensor(pci_address, root=SYSFS_ROOT):
+    """Returns the Sensor of the PCI device at pci_address, None if it has
+    none."""
+    if not pci_address:
+        return None
+    pci_address = pci_address.lower()
+    paths = sorted(glob(os.path.join(root, 'class/drm/card*/device/hwmon/hwmon*')))
+    paths += sorted(glob(os.path.join(root, 'class/hwmon/hwmon*')))
+    for path in paths:
+        device = os.path.realpath(os.path.join(path, 'device'))
+        if os.path.basename(device).lower() == pci_address:
+            return Sensor(path)
+    return None
+
+
+class Throttle(object):
+    """
+    Proportional control of the share of time a device computes. Above
+    target_temp the duty cycle falls linearly to nothing at limit_temp. With
+    a power target the duty cycle is scaled by target over measured power,
+    which settles where the device draws the target.
+    """
+
+    def __init__(self, target_temp, limit_temp, target_power=0):
+        self.target_temp = target_temp
+        self.limit_temp = limit_temp
+        self.target_power = target_power
+        self.power_duty = 1.0
+
+    def update(self, temperature, power=None):
+        """Returns the duty cycle for the latest readings, 0 to 1."""
+        duty = 1.0
+        if temperature is not None and temperature > self.target_temp:
+            if temperature >= self.limit_temp:
+                duty = 0.0
+            else:
+                duty = ((self.limit_temp - temperature)
+                        / (self.limit_temp - self.target_temp))
+        if self.target_power and power:
+            self.power_duty = min(max(
+                self.power_duty * self.target_power / power,
+                MIN_POWER_DUTY), 1.0)
+            duty = min(duty, self.power_duty)
+        return duty
+
+
+class Watch(object):
+    def __init__(self, miner, sensor, throttle):
+        self.miner = miner
+        self.sensor = sensor
+        self.throttle = throttle
+        self.energy = 0
+        self.last_sample = None
+        self.history = deque()
+
+
+class Sampler(object):
+    """Reads the sensors of every watched device from one thread."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.watches = []
+        self.lock = Lock()
+        self.thread = None
+
+    def watch(self, miner, sensor, throttle):
+        """Sets miner.temperature and miner.duty from sensor readings."""
+        with self.lock:
+            self.watches.append(Watch(miner, sensor, throttle))
+            if not self.thread:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.sample(monotonic())
+            except Exception:
+                say_exception('hwmon sampler error:')
+            sleep(self.interval)
+
+    def sample(self, now):
+        with self.lock:
+            watches = list(self.watches)
+        for watch in watches:
+            miner, sensor = watch.miner, watch.sensor
+            device = miner.id()
+            temperature = sensor.temperature()
+            fan = sensor.fan()
+            power = sensor.power()
+
+            if temperature is not None:
+                miner.temperature = temperature
+                metrics.TEMPERATURE.labels(device).set(temperature)
+            if fan is not None:
+                metrics.FAN_SPEED.labels(device).set(fan)
+            miner.duty = watch.throttle.update(temperature, power)
+            metrics.DUTY_CYCLE.labels(device).set(miner.duty)
+
+            if power is None:
+                continue
+            metrics.POWER.labels(device).set(power)
+            if watch.last_sample is not None:
+                watch.energy += power * (now - watch.last_sample)
+            watch.last_sample = now
+            watch.history.append((now, miner.hashes, watch.energy))
+            while watch.history[0][0] < now - EFFICIENCY_WINDOW:
+                watch.history.popleft()
+            _, hashes, energy = watch.history[0]
+            if watch.energy > energy:
+                metrics.HASHES_PER_JOULE.labels(device).set(
+                    (miner.hashes - hashes) / (watch.energy - energy))
+
+
+SAMPLER = Sampler()
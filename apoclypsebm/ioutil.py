@@ -1,43 +1,132 @@
-from apoclypsebm.detect import LINUX, WINDOWS
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from fnmatch import fnmatch
 from glob import glob
+from threading import Lock
+
+from apoclypsebm.detect import LINUX, WINDOWS
+from apoclypsebm.log import say_exception
+
+# Seconds a port gets to answer a probe.
+PROBE_TIMEOUT = 0.5
+
+
+def probe(check, ports, timeout=PROBE_TIMEOUT):
+    """Runs check on every port at once and returns the ports it passed, in
+    order. A check still running after timeout, plus a second to open the
+    port, counts as failed."""
+    if not ports:
+        return []
+    pool = ThreadPoolExecutor(len(ports), 'probe')
+    futures = [pool.submit(check, port) for port in ports]
+    wait(futures, timeout + 1)
+    pool.shutdown(wait=False)
+    return [port for port, future in zip(ports, futures)
+            if future.done() and not future.exception() and future.result()]
 
 
-def find_udev(check, product_id):
+def find_udev(check, product_id, timeout=PROBE_TIMEOUT):
     ports = []
     if LINUX:
         try:
             import pyudev
 
             context = pyudev.Context()
-            for device in context.list_devices(subsystem='tty',
-                                               ID_MODEL=product_id):
-                if check(device.device_node):
-                    ports.append(device.device_node)
+            ports = [device.device_node for device in
+                     context.list_devices(subsystem='tty', ID_MODEL=product_id)]
         except ImportError:
             pass
-    return ports
+    return probe(check, ports, timeout)
 
 
-def find_serial_by_id(check, product_id):
+def find_serial_by_id(check, product_id, timeout=PROBE_TIMEOUT):
     ports = []
     if LINUX:
-        for port in glob('/dev/serial/by-id/*' + product_id + '*'):
-            if check(port):
-                ports.append(port)
-    return ports
+        ports = sorted(glob('/dev/serial/by-id/*' + product_id + '*'))
+    return probe(check, ports, timeout)
 
 
-def find_com_ports(check):
-    ports = []
+def find_com_ports(check, timeout=PROBE_TIMEOUT):
     if WINDOWS:
         from serial.tools import list_ports
-        com_ports = [p[0] for p in list_ports.comports()]
-        com_ports.sort()
-        for port in com_ports:
-            if check(port, False):
-                ports.append(port)
-    else:
-        for port in glob('/dev/ttyUSB*'):
-            if check(port):
+        com_ports = sorted(p[0] for p in list_ports.comports())
+        return probe(lambda port: check(port, False), com_ports, timeout)
+    return probe(check, sorted(glob('/dev/ttyUSB*')), timeout)
+
+
+def stable_path(port):
+    """The /dev/serial/by-id link to port if it has one, which stays the same
+    when devices are plugged in a different order."""
+    if LINUX and not port.startswith('/dev/serial/by-id/'):
+        device = os.path.realpath(port)
+        for link in sorted(glob('/dev/serial/by-id/*')):
+            if os.path.realpath(link) == device:
+                return link
+    return port
+
+
+def monitor_udev(product_id, callback):
+    """Calls callback with the device node of every tty whose ID_MODEL
+    matches product_id that is plugged in from now on. Needs pyudev."""
+    if not LINUX:
+        return None
+    try:
+        import pyudev
+    except ImportError:
+        return None
+
+    def event(device):
+        if device.action == 'add' and fnmatch(device.get('ID_MODEL', ''),
+                                              product_id):
+            try:
+                callback(device.device_node)
+            except Exception:
+                say_exception('hotplug error:')
+
+    monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+    monitor.filter_by('tty')
+    observer = pyudev.MonitorObserver(monitor, callback=event,
+                                      name='udev monitor', daemon=True)
+    observer.start()
+    return observer
+
+
+class PortCache(object):
+    """Ports devices were found on, by stable path, in a JSON file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as ports:
+                return json.load(ports)
+        except (OSError, ValueError):
+            return []
+
+    def known(self):
+        """The cached ports that still exist."""
+        with self.lock:
+            return [port for port in self.load() if os.path.exists(port)]
+
+    def add(self, port):
+        self.update(stable_path(port), True)
+
+    def remove(self, port):
+        self.update(stable_path(port), False)
+
+    def update(self, port, present):
+        with self.lock:
+            ports = self.load()
+            if (port in ports) == present:
+                return
+            if present:
                 ports.append(port)
-    return ports
+            else:
+                ports.remove(port)
+            temporary = f'{self.path}.{os.getpid()}'
+            with open(temporary, 'w') as out:
+                json.dump(ports, out, indent=1)
+            os.replace(temporary, self.path)
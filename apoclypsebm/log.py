@@ -1,7 +1,20 @@
-from datetime import datetime
-from threading import RLock
+"""
+Console and structured logging.
+
+Callers only append a record to a deque, which is atomic and never blocks.
+A writer thread formats the records, coalesces repeats, rate limits noisy
+messages and writes each batch with a single flush, so a slow terminal or
+pipe can't stall the mining threads. Outside of verbose mode the status line
+is redrawn at a fixed rate rather than on every rate update.
+"""
+import atexit
 import sys
 import traceback
+from collections import deque
+from datetime import datetime
+from json import dumps
+from threading import Event, RLock, Thread
+from time import monotonic, time
 
 quiet = False
 verbose = False
@@ -10,30 +23,223 @@ lock = RLock()
 
 TIME_FORMAT = '%d/%m/%Y %H:%M:%S'
 
+# Seconds between writer passes and status line redraws.
+WRITE_INTERVAL = 0.1
+# Seconds between status records in the JSON log.
+JSON_STATUS_INTERVAL = 1
+# Messages sharing a format string allowed per RATE_LIMIT_WINDOW seconds.
+RATE_LIMIT = 20
+RATE_LIMIT_WINDOW = 1
+MAX_PENDING = 100000
+
+# NOTICE lines are never rate limited.
+LINE, STATUS, RAW, NOTICE = range(4)
+
+pending = deque(maxlen=MAX_PENDING)
+json_file = None
+text_output = True
 
-def say(format_, args=(), say_quiet=False):
+writer = None
+wake = Event()
+
+
+def say(format_, args=(), say_quiet=False, limit=True):
     if quiet and not say_quiet: return
-    with lock:
-        p = format_ % args
-        if verbose:
-            print('%s %s,' % (server, datetime.now().strftime(TIME_FORMAT)), p)
-        else:
-            sys.stdout.write('\r%s\r%s %s' % (' '*80, server, p))
-        sys.stdout.flush()
+    pending.append((LINE if limit else NOTICE, time(), server, format_, args))
+    ensure_writer()
 
 
-def say_line(format_, args=()):
-    if not verbose:
-        format_ = '%s, %s\n' % (datetime.now().strftime(TIME_FORMAT), format_)
-    say(format_, args)
+def say_line(format_, args=(), limit=True):
+    """Logs format_ % args. Lines with limit False, such as found blocks,
+    are never suppressed however many lines share their format."""
+    say(format_, args, limit=limit)
 
 
 def say_exception(message=''):
     type_, value, tb = sys.exc_info()
     say_line(message + ' %s', str(value))
     if verbose:
-        traceback.print_exception(type_, value, tb)
+        pending.append((RAW, time(), server,
+                        ''.join(traceback.format_exception(type_, value, tb)),
+                        ()))
 
 
 def say_quiet(format_, args=()):
-    say(format_, args, True)
+    if verbose:
+        say(format_, args, True)
+    else:
+        # Only the latest status matters, the writer redraws it on its own.
+        pending.append((STATUS, time(), server, format_, args))
+        ensure_writer()
+
+
+def log_json(path):
+    """Writes structured records as JSON lines to path, '-' for stdout."""
+    global json_file, text_output
+    if path == '-':
+        json_file = sys.stdout
+        text_output = False
+    else:
+        json_file = open(path, 'a')
+
+
+def ensure_writer():
+    global writer
+    if writer is None:
+        with lock:
+            if writer is None:
+                writer = Writer()
+                writer.start()
+
+
+def flush():
+    """Blocks until every record logged so far has been written."""
+    if writer:
+        writer.drain()
+
+
+class Writer(Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.status = None
+        self.status_drawn = None
+        self.last_json_status = 0
+        self.last_text = None
+        self.repeats = 0
+        self.window_start = monotonic()
+        self.window_counts = {}
+        self.suppressed = {}
+        self.drained = Event()
+
+    def run(self):
+        while True:
+            wake.wait(WRITE_INTERVAL)
+            wake.clear()
+            self.write_batch()
+
+    def drain(self):
+        self.drained.clear()
+        wake.set()
+        self.drained.wait(1)
+
+    def write_batch(self):
+        with lock:
+            self.write_pending()
+        self.drained.set()
+
+    def write_pending(self):
+        text = []
+        records = []
+        popleft = pending.popleft
+        now = monotonic()
+        if now - self.window_start >= RATE_LIMIT_WINDOW:
+            self.end_window(text, records)
+            self.window_start = now
+        try:
+            while True:
+                self.handle(popleft(), text, records)
+        except IndexError:
+            pass
+
+        if text_output:
+            self.write_text(text)
+        if json_file and records:
+            json_file.write(''.join(dumps(r) + '\n' for r in records))
+            json_file.flush()
+
+    def handle(self, record, text, records):
+        kind, timestamp, server_, format_, args = record
+        if kind == STATUS:
+            self.status = record
+            if json_file and timestamp - self.last_json_status >= JSON_STATUS_INTERVAL:
+                self.last_json_status = timestamp
+                records.append(self.json_record('status', record))
+            return
+        if kind in (LINE, NOTICE):
+            if kind == LINE:
+                count = self.window_counts.get(format_, 0) + 1
+                self.window_counts[format_] = count
+                if count > RATE_LIMIT:
+                    self.suppressed[format_] = (
+                        self.suppressed.get(format_, 0) + 1)
+                    return
+            message = self.format(format_, args)
+            if message == self.last_text:
+                self.repeats += 1
+                return
+            self.flush_repeats(text, records, timestamp, server_)
+            self.last_text = message
+        else:
+            message = format_
+        text.append(self.text_line(timestamp, server_, message, kind))
+        if json_file:
+            records.append(self.json_record(
+                'traceback' if kind == RAW else 'line', record, message))
+
+    def end_window(self, text, records):
+        for format_, count in self.suppressed.items():
+            message = 'suppressed %d more messages like "%s"' % (
+                count, format_)
+            text.append(self.text_line(time(), server, message, LINE))
+            if json_file:
+                records.append(self.json_record(
+                    'suppressed', (LINE, time(), server, format_, ()), message,
+                    count=count))
+        self.suppressed = {}
+        self.window_counts = {}
+        self.flush_repeats(text, records, time(), server)
+
+    def flush_repeats(self, text, records, timestamp, server_):
+        if self.repeats:
+            message = 'last message repeated %d times' % self.repeats
+            text.append(self.text_line(timestamp, server_, message, LINE))
+            if json_file:
+                records.append(self.json_record(
+                    'repeated', (LINE, timestamp, server_, self.last_text, ()),
+                    message, count=self.repeats))
+            self.repeats = 0
+            self.last_text = None
+
+    def format(self, format_, args):
+        try:
+            return format_ % args
+        except (TypeError, ValueError):
+            return '%s %r' % (format_, args)
+
+    def text_line(self, timestamp, server_, message, kind):
+        if kind == RAW:
+            return message
+        when = datetime.fromtimestamp(timestamp).strftime(TIME_FORMAT)
+        return '%s %s, %s\n' % (server_, when, message)
+
+    def json_record(self, type_, record, message=None, **extra):
+        kind, timestamp, server_, format_, args = record
+        json_record = {
+            'time': datetime.fromtimestamp(timestamp).isoformat(),
+            'type': type_,
+            'server': server_,
+            'message': message or self.format(format_, args),
+            'format': format_,
+        }
+        json_record.update(extra)
+        return json_record
+
+    def write_text(self, text):
+        status = None
+        if self.status is not None and not verbose:
+            kind, timestamp, server_, format_, args = self.status
+            status = '%s %s' % (server_, self.format(format_, args))
+        if not text and status == self.status_drawn:
+            return
+        out = ''.join(text)
+        if not verbose:
+            out = '\r%s\r%s%s' % (' ' * 80, out, status or '')
+            self.status_drawn = status
+        sys.stdout.write(out)
+        sys.stdout.flush()
+
+
+@atexit.register
+def shutdown():
+    if writer:
+        writer.write_batch()
@@ -0,0 +1,316 @@
+"""
+Process-wide mining metrics, exposed in the Prometheus text format.
+
+Counters and histograms keep one shard per recording thread, so the mining,
+source and asyncore threads never take a lock to update them. Shards are only
+summed when the metrics endpoint is scraped.
+"""
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, get_ident
+
+from apoclypsebm.log import say_line
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+                   2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter(object):
+    def __init__(self):
+        self._shards = {}
+
+    def inc(self, amount=1):
+        shard = self._shards.get(get_ident())
+        if shard is None:
+            shard = self._shards[get_ident()] = [0]
+        shard[0] += amount
+
+    def value(self):
+        return sum(shard[0] for shard in list(self._shards.values()))
+
+    def samples(self, name, labels):
+        yield name, labels, self.value()
+
+
+class Gauge(object):
+    def __init__(self):
+        self._value = 0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        """Evaluate function at scrape time instead of storing a value."""
+        self._function = function
+
+    def value(self):
+        if self._function:
+            try:
+                return self._function()
+            except Exception:
+                return float('nan')
+        return self._value
+
+    def samples(self, name, labels):
+        yield name, labels, self.value()
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._shards = {}
+
+    def observe(self, value):
+        shard = self._shards.get(get_ident())
+        if shard is None:
+            # bucket counts, then +Inf, then sum
+            shard = self._shards[get_ident()] = [0] * (len(self.buckets) + 2)
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def totals(self):
+        totals = [0] * (len(self.buckets) + 2)
+        for shard in list(self._shards.values()):
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+    def count(self):
+        return sum(self.totals()[:-1])
+
+    def quantile(self, q):
+        """Estimates the q-quantile as the upper bound of its bucket."""
+        totals = self.totals()
+        count = sum(totals[:-1])
+        if not count:
+            return 0
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, totals):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self, name, labels):
+        totals = self.totals()
+        cumulative = 0
+        for bound, count in zip(self.buckets, totals):
+            cumulative += count
+            yield name + '_bucket', labels + (('le', repr(float(bound))),), \
+                cumulative
+        cumulative += totals[-2]
+        yield name + '_bucket', labels + (('le', '+Inf'),), cumulative
+        yield name + '_count', labels, cumulative
+        yield name + '_sum', labels, totals[-1]
+
+
+class Family(object):
+    """A named metric with a fixed set of label names."""
+
+    def __init__(self, kind, name, help_, labelnames=(), **kwargs):
+        self.kind = kind
+        self.name = name
+        self.help = help_
+        self.labelnames = tuple(labelnames)
+        self.kwargs = kwargs
+        self.children = {}
+        self.lock = Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self.children[values] = METRIC_TYPES[self.kind](
+                        **self.kwargs)
+        return child
+
+    def value(self, *values):
+        """Current value of a child without creating it, 0 if missing."""
+        child = self.children.get(values)
+        return child.value() if child else 0
+
+    def sum(self, **match):
+        """Sums counter or gauge children whose labels include match."""
+        total = 0
+        for values, child in list(self.children.items()):
+            labels = dict(zip(self.labelnames, values))
+            if all(labels.get(k) == v for k, v in match.items()):
+                total += child.value()
+        return total
+
+    def remove(self, *values):
+        with self.lock:
+            self.children.pop(values, None)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self.children.items()):
+            labels = tuple(zip(self.labelnames, values))
+            for name, sample_labels, value in child.samples(self.name, labels):
+                lines.append(f'{name}{format_labels(sample_labels)} '
+                             f'{format_value(value)}')
+        return lines
+
+
+METRIC_TYPES = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+class Registry(object):
+    def __init__(self):
+        self.families = []
+
+    def add(self, family):
+        self.families.append(family)
+        return family
+
+    def counter(self, name, help_, labelnames=()):
+        return self.add(Family('counter', name, help_, labelnames))
+
+    def gauge(self, name, help_, labelnames=()):
+        return self.add(Family('gauge', name, help_, labelnames))
+
+    def histogram(self, name, help_, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.add(
+            Family('histogram', name, help_, labelnames, buckets=buckets))
+
+    def expose(self):
+        lines = []
+        for family in self.families:
+            lines.extend(family.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HASH_RATE = REGISTRY.gauge(
+    'apoclypse_hash_rate_mhs', 'Hash rate measured on the device in MH/s.',
+    ('device',))
+ESTIMATED_RATE = REGISTRY.gauge(
+    'apoclypse_estimated_rate_mhs',
+    'Hash rate estimated from accepted shares in MH/s.', ('device',))
+SHARES = REGISTRY.counter(
+    'apoclypse_shares_total',
+    'Shares by outcome: found, accepted, rejected or stale.',
+    ('device', 'pool', 'result'))
+HARDWARE_ERRORS = REGISTRY.counter(
+    'apoclypse_hardware_errors_total', 'Results that failed verification.',
+    ('device',))
+DEVICE_TIMEOUTS = REGISTRY.counter(
+    'apoclypse_device_timeouts_total',
+    'Requests to a device that went unanswered.', ('device',))
+DEVICE_REINITS = REGISTRY.counter(
+    'apoclypse_device_reinits_total',
+    'Times a device had to be initialized again.', ('device',))
+VERIFICATION_SECONDS = REGISTRY.histogram(
+    'apoclypse_verification_seconds',
+    'Time spent verifying the nonces of one result.', ('device',))
+WORK_FETCH_SECONDS = REGISTRY.histogram(
+    'apoclypse_work_fetch_seconds', 'Latency of fetching new work.',
+    ('pool',))
+SUBMIT_SECONDS = REGISTRY.histogram(
+    'apoclypse_submit_seconds',
+    'Latency from submitting a share to the pool answering.', ('pool',))
+LAUNCH_SIZE = REGISTRY.gauge(
+    'apoclypse_kernel_launch_size', 'Global work size of kernel launches.',
+    ('device',))
+LAUNCH_SECONDS = REGISTRY.histogram(
+    'apoclypse_launch_seconds',
+    'Wall time from enqueueing a kernel launch to its output being read back.',
+    ('device',))
+KERNEL_SECONDS = REGISTRY.histogram(
+    'apoclypse_kernel_seconds',
+    'Time the device spent executing a kernel launch.', ('device',))
+TEMPERATURE = REGISTRY.gauge(
+    'apoclypse_temperature_celsius', 'Last device temperature reading.',
+    ('device',))
+FAN_SPEED = REGISTRY.gauge(
+    'apoclypse_fan_speed_rpm', 'Last device fan speed reading.', ('device',))
+POWER = REGISTRY.gauge(
+    'apoclypse_power_watts', 'Last device power draw reading.', ('device',))
+DUTY_CYCLE = REGISTRY.gauge(
+    'apoclypse_duty_cycle',
+    'Share of the time a device may compute under its temperature and power '
+    'targets.', ('device',))
+HASHES_PER_JOULE = REGISTRY.gauge(
+    'apoclypse_hashes_per_joule',
+    'Hashes computed per joule drawn over the last minute.', ('device',))
+WORK_QUEUE_DEPTH = REGISTRY.gauge(
+    'apoclypse_work_queue_depth', 'Jobs waiting for a miner.', ('device',))
+SUPERSEDED_JOBS = REGISTRY.counter(
+    'apoclypse_superseded_jobs_total',
+    'Jobs replaced by a newer one before their miner took them.', ('device',))
+RESULT_QUEUE_DEPTH = REGISTRY.gauge(
+    'apoclypse_result_queue_depth', 'Results waiting to be submitted.',
+    ('pool',))
+BLOCK_SUBMIT_SECONDS = REGISTRY.histogram(
+    'apoclypse_block_submit_seconds',
+    'Time from a block being found to the node answering its submission.',
+    ('pool',))
+BLOCK_NOTIFY_SECONDS = REGISTRY.histogram(
+    'apoclypse_block_notify_seconds',
+    'Time from a new block notification to work on it being queued.',
+    ('pool',))
+TEMPLATE_LAG_SECONDS = REGISTRY.histogram(
+    'apoclypse_template_lag_seconds',
+    'Time from the first raced node serving a template on a new block to '
+    'this node serving one.', ('pool',))
+PROXY_CLIENTS = REGISTRY.gauge(
+    'apoclypse_proxy_clients', 'Miners connected to the stratum proxy.')
+TEMPLATE_STORE_BYTES = REGISTRY.gauge(
+    'apoclypse_template_store_bytes',
+    'Bytes of raw transactions kept for the templates jobs are built on.')
+STRATUM_SESSIONS = REGISTRY.counter(
+    'apoclypse_stratum_sessions_total',
+    'Stratum sessions subscribed, new or resumed.', ('pool', 'result'))
+BLOCK_RESTART_SECONDS = REGISTRY.histogram(
+    'apoclypse_block_restart_seconds',
+    'Time from the first job on a new block arriving to the first hash found '
+    'on it.', ('pool',))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format_, *args):
+        pass
+
+
+def start_server(host, port, registry=REGISTRY):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    Thread(target=server.serve_forever, daemon=True).start()
+    say_line('Serving metrics on http://%s:%d/metrics',
+             server.server_address[:2])
+    return server
@@ -1,18 +1,100 @@
-from queue import Queue
-from threading import Thread
+from queue import Empty
+from struct import unpack
+from threading import Condition, Thread
 from time import monotonic
 
+from apoclypsebm import metrics
+from apoclypsebm.sha256 import STATE, sha256
+
+
+def prepare(job):
+    """Computes the midstate Switch.decode leaves for whoever takes a job."""
+    if job and job.state is None:
+        job.state = sha256(STATE, list(unpack('<16I', job.header[:64])) + [0] * 48)
+    return job
+
+
+class JobMailbox(object):
+    """
+    Holds the newest job for a miner. A job that wasn't taken before the next
+    one arrived is replaced and counted as superseded, and only the job that
+    is taken gets prepared. generation counts the jobs put in, so mining
+    loops can tell a newer job is waiting without taking a lock. stale is set
+    by clear() until the next job is taken: the job last taken must be
+    abandoned. on_put, if set, is called after every put, for miners that
+    wait for jobs on something other than the mailbox.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.on_put = None
+        self.condition = Condition()
+        self.job = None
+        self.generation = self.taken = 0
+        self.superseded = 0
+        self.stale = False
+
+    def put(self, job):
+        with self.condition:
+            if self.taken != self.generation:
+                self.supersede()
+            self.job = job
+            self.generation += 1
+            self.condition.notify()
+        if self.on_put:
+            self.on_put()
+
+    def get(self, block=True, timeout=None, prepared=True):
+        with self.condition:
+            if block:
+                self.condition.wait_for(self.waiting, timeout)
+            if not self.waiting():
+                raise Empty
+            job, self.job = self.job, None
+            self.taken = self.generation
+            self.stale = False
+        return prepare(job) if prepared else job
+
+    def clear(self):
+        with self.condition:
+            if self.taken != self.generation:
+                self.supersede()
+            self.job = None
+            self.taken = self.generation
+            self.stale = True
+
+    def supersede(self):
+        self.superseded += 1
+        metrics.SUPERSEDED_JOBS.labels(self.device()).inc()
+
+    def waiting(self):
+        return self.taken != self.generation
+
+    def empty(self):
+        return self.taken == self.generation
+
+    def qsize(self):
+        return 0 if self.empty() else 1
+
 
 class Miner(object):
+    # Device class name used by the cgminer-compatible API.
+    kind = 'PGA'
+    # Bits of the last hash word that must be zero for a result to pass
+    # verification. Real devices only report difficulty 1 hashes.
+    verify_mask = 0xFFFFFFFF
+
     def __init__(self, device_idx, options):
         self.device_idx = device_idx
         self.options = options
 
         self.update_time_counter = 1
         self.share_count = [0, 0]
-        self.work_queue = Queue()
+        self.hashes = 0
+        self.work_queue = JobMailbox(self.id)
 
         self.update = True
+        self.enabled = True
 
         self.accept_hist = []
         self.rate = self.estimated_rate = 0
@@ -27,7 +109,20 @@ class Miner(object):
             print('\n%s' % message)
         self.should_stop = True
 
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        if not enabled:
+            self.rate = 0
+
+    def restart(self):
+        """Drops the waiting job and abandons the current one for a new block."""
+        self.work_queue.clear()
+
+    def configure(self, frames=None, worksize=None):
+        raise NotImplementedError(f'{self.id()} has no launch settings')
+
     def update_rate(self, now, iterations, t, targetQ, rate_divisor=1000):
+        self.hashes += iterations * (1000 / rate_divisor)
         self.rate = (iterations / t) / rate_divisor
         self.rate /= 1000
         if self.accept_hist:
@@ -42,4 +137,6 @@ class Miner(object):
             int(now - self.start_time), self.options.estimate) / 1000
         self.estimated_rate = float(self.estimated_rate) / 1000
 
+        metrics.HASH_RATE.labels(self.id()).set(self.rate)
+        metrics.ESTIMATED_RATE.labels(self.id()).set(self.estimated_rate)
         self.switch.status_updated(self)
@@ -1,23 +1,48 @@
+import os
 from binascii import unhexlify
 from queue import Empty
 from struct import error, pack, unpack
 from sys import maxsize
-from time import sleep, time
+from threading import Lock, Thread
+from time import monotonic, time
 
 import serial
 from serial.serialutil import SerialException
 
-from apoclypsebm.ioutil import find_com_ports, find_serial_by_id, find_udev
+from apoclypsebm import metrics
+from apoclypsebm.ioutil import (PortCache, find_com_ports, find_serial_by_id,
+                                find_udev, monitor_udev)
 from apoclypsebm.log import say_exception, say_line
 from apoclypsebm.mining.base import Miner
+from apoclypsebm.serialio import ENGINE, Port, Request, Sleep
 from apoclypsebm.util import Object, bytereverse, uint32
 
+UDEV_MODEL = 'BitFORCE*SHA256'
+BY_ID_NAME = 'BitFORCE_SHA256'
+
 CHECK_INTERVAL = 0.01
+# Seconds a job's time may be rolled past what it came with.
+MAX_TIME_ROLL = 55
+# Jobs kept in the queue of firmware that has one, and how often finished
+# ones are collected.
+QUEUE_DEPTH = 4
+QUEUE_POLL_INTERVAL = 0.1
+# Queueing attempts rejected in a row before going back to single jobs.
+QUEUE_FAILURES = 3
+# Seconds between temperature readings, taken while the device is busy
+# hashing so they never hold up a job.
+SAMPLE_INTERVAL = 5
+
+
+# Device indexes of the ports attached so far, by real path.
+attached = {}
+attached_lock = Lock()
 
 
-def open_device(port):
+def open_device(port, timeout=1):
     return serial.Serial(port, 115200, serial.EIGHTBITS, serial.PARITY_NONE,
-                         serial.STOPBITS_ONE, 1, False, False, 5, False, None)
+                         serial.STOPBITS_ONE, timeout, False, False, 5, False,
+                         None)
 
 
 def is_good_init(response):
@@ -37,10 +62,10 @@ def request(device, message):
         return device.readline()
 
 
-def check(port, likely=True):
+def check(port, likely=True, timeout=1):
     result = False
     try:
-        device = open_device(port)
+        device = open_device(port, timeout)
         response = init_device(device)
         device.close()
         result = is_good_init(response)
@@ -54,10 +79,41 @@ def check(port, likely=True):
     return result
 
 
+def find_ports(options, exclude=()):
+    """Probes every candidate port at once, except those in exclude."""
+    timeout = options.probe_timeout
+
+    def check_port(port, likely=True):
+        return (os.path.realpath(port) not in exclude
+                and check(port, likely, timeout))
+
+    return (find_udev(check_port, UDEV_MODEL, timeout)
+            or find_serial_by_id(check_port, BY_ID_NAME, timeout)
+            or find_com_ports(check_port, timeout))
+
+
+def port_cache(options):
+    if options.bfl_cache and not options.bfl_port:
+        return PortCache(options.bfl_cache)
+    return None
+
+
 def initialize(options):
-    ports = find_udev(check, 'BitFORCE*SHA256') or find_serial_by_id(check,
-                                                                     'BitFORCE_SHA256') or find_com_ports(
-        check)
+    cache = port_cache(options)
+    # Worker processes get the ports the coordinating process found.
+    ports = options.bfl_port or getattr(options, 'bfl_found', None)
+    if not ports and cache:
+        ports = cache.known()
+        options.bfl_searched = not ports
+    if not ports:
+        ports = find_ports(options)
+        if cache:
+            for port in ports:
+                cache.add(port)
+    options.bfl_found = ports
+    with attached_lock:
+        for i, port in enumerate(ports):
+            attached[os.path.realpath(port)] = i
 
     if not options.device and ports:
         print('\nBFL devices on ports:\n')
@@ -78,10 +134,60 @@ def initialize(options):
             min(i, len(options.cutoff_temp) - 1)]
         miners[i].cutoff_interval = options.cutoff_interval[
             min(i, len(options.cutoff_interval) - 1)]
+        miners[i].cache = cache
     return miners
 
 
+def watch(switch, options):
+    """
+    Adds BitFORCE devices that weren't attached by initialize to switch: when
+    initialize went by the cache, the other ports are searched in the
+    background, and with pyudev devices plugged in later are picked up.
+    Devices added here run in this process.
+    """
+    if options.bfl_port:
+        return
+    cache = port_cache(options)
+
+    def attach(port, probed=False):
+        path = os.path.realpath(port)
+        with attached_lock:
+            if path in attached:
+                return
+        if not probed and not check(port, timeout=options.probe_timeout):
+            return
+        with attached_lock:
+            if path in attached:
+                return
+            index = attached[path] = len(attached)
+        if cache:
+            cache.add(port)
+        if options.device and index not in options.device:
+            return
+        miner = BFLMiner(index, port, options)
+        miner.cutoff_temp = options.cutoff_temp[
+            min(index, len(options.cutoff_temp) - 1)]
+        miner.cutoff_interval = options.cutoff_interval[
+            min(index, len(options.cutoff_interval) - 1)]
+        miner.cache = cache
+        say_line('Found BitFORCE on %s, mining on it as %s', (port, miner.id()))
+        switch.add_miner(miner)
+        miner.start()
+
+    def search():
+        with attached_lock:
+            exclude = set(attached)
+        for port in find_ports(options, exclude):
+            attach(port, True)
+
+    if not getattr(options, 'bfl_searched', True):
+        Thread(target=search, name='BitFORCE search', daemon=True).start()
+    monitor_udev(UDEV_MODEL, attach)
+
+
 class BFLMiner(Miner):
+    kind = 'PGA'
+
     def __init__(self, device_idx, port, options):
         super(BFLMiner, self).__init__(device_idx, options)
         self.port = port
@@ -90,19 +196,41 @@ class BFLMiner(Miner):
         self.check_interval = CHECK_INTERVAL
         self.last_job = None
         self.min_interval = maxsize
+        self.temperature = None
+        self.next_sample = 0
+        self.inits = 0
+        self.cache = None
+        self.serial_port = Port(port, self.session, self.device_name)
+        self.work_queue.on_put = self.serial_port.wake
 
     def id(self):
         return self.device_name
 
+    def start(self):
+        self.should_stop = False
+        self.start_time = monotonic()
+        ENGINE.add(self.serial_port)
+
     def is_ok(self, response):
         return response and response == b'OK\n'
 
+    def ask(self, message, **kwargs):
+        response = yield Request(message, **kwargs)
+        if response is None:
+            metrics.DEVICE_TIMEOUTS.labels(self.id()).inc()
+        return response
+
+    def too_hot(self):
+        return self.temperature is not None and self.temperature >= self.cutoff_temp
+
+    def sample_due(self):
+        return monotonic() >= self.next_sample
+
     def put_job(self):
-        if self.busy: return
+        if self.busy or not self.job: return
 
-        temperature = self.get_temperature()
-        if temperature < self.cutoff_temp:
-            response = request(self.device, b'ZDX')
+        if not self.too_hot():
+            response = yield from self.ask(b'ZDX')
             if self.is_ok(response):
                 if self.switch.update_time:
                     self.job.time = bytereverse(
@@ -110,28 +238,17 @@ class BFLMiner(Miner):
                 data = b''.join([pack('<8I', *self.job.state),
                                  pack('<3I', self.job.merkle_end, self.job.time,
                                       self.job.difficulty)])
-                response = request(self.device,
-                                   b''.join([b'>>>>>>>>', data, b'>>>>>>>>']))
+                response = yield from self.ask(
+                    b''.join([b'>>>>>>>>', data, b'>>>>>>>>']))
                 if self.is_ok(response):
                     self.busy = True
-                    self.job_started = time()
-
-                    self.last_job = Object()
-                    self.last_job.header = self.job.header
-                    self.last_job.merkle_end = self.job.merkle_end
-                    self.last_job.time = self.job.time
-                    self.last_job.difficulty = self.job.difficulty
-                    self.last_job.target = self.job.target
-                    self.last_job.state = self.job.state
-                    self.last_job.job_id = self.job.job_id
-                    self.last_job.extranonce2 = self.job.extranonce2
-                    self.last_job.server = self.job.server
-                    self.last_job.miner = self
+                    self.job_started = monotonic()
+                    self.last_job = self.snapshot(self.job)
 
                     self.check_interval = CHECK_INTERVAL
                     if not self.switch.update_time or bytereverse(
                             self.job.time) - bytereverse(
-                            self.job.original_time) > 55:
+                            self.job.original_time) > MAX_TIME_ROLL:
                         self.update = True
                         self.job = None
                 else:
@@ -143,19 +260,44 @@ class BFLMiner(Miner):
         else:
             say_line('%s: temperature exceeds cutoff, waiting...', self.id())
 
-    def get_temperature(self):
-        response = request(self.device, b'ZLX')
-        if len(response) < 23 or response[0] != b'T' or response[-1:] != b'\n':
+    def snapshot(self, job):
+        """The job as sent, kept for its results."""
+        sent = Object()
+        sent.header = job.header
+        sent.merkle_end = job.merkle_end
+        sent.time = job.time
+        sent.difficulty = job.difficulty
+        sent.target = job.target
+        sent.state = job.state
+        sent.job_id = job.job_id
+        sent.extranonce2 = job.extranonce2
+        sent.template = job.template
+        sent.server = job.server
+        sent.miner = self
+        sent.received = job.received
+        return sent
+
+    def sample(self):
+        """Reads the temperature job dispatch goes by until the next
+        sample."""
+        self.next_sample = monotonic() + SAMPLE_INTERVAL
+        response = yield from self.ask(b'ZLX')
+        try:
+            if response[:1] != b'T' or response[-1:] != b'\n':
+                raise ValueError
+            self.temperature = float(response[23:-1])
+        except (TypeError, ValueError):
             say_line('%s: bad response for temperature: %s',
                      (self.id(), response))
-            return 0
-        return float(response[23:-1])
+            return
+        metrics.TEMPERATURE.labels(self.id()).set(self.temperature)
 
     def check_result(self):
-        response = request(self.device, b'ZFX')
+        response = yield from self.ask(b'ZFX')
+        if response is None: return None
         if response.startswith(b'B'): return False
         if response == b'NO-NONCE\n': return response
-        if response[:12] != 'NONCE-FOUND:' or response[-1:] != '\n':
+        if response[:12] != b'NONCE-FOUND:' or response[-1:] != b'\n':
             say_line('%s: bad response checking result: %s',
                      (self.id(), response))
             return None
@@ -169,78 +311,227 @@ class BFLMiner(Miner):
             except error:
                 pass
 
-    def mining_thread(self):
-        say_line('started BFL miner on %s', (self.id()))
-
-        while not self.should_stop:
+    def take_job(self):
+        if self.work_queue.stale:
+            # Single job mode has no abort, a running job is finished and
+            # its results dropped by the switch.
+            self.job = None
+        if (not self.job) or (not self.work_queue.empty()):
             try:
-                self.device = open_device(self.port)
-                response = init_device(self.device)
-                if not is_good_init(response):
-                    say_line(
-                        'Failed to initialize %s (response: %s), retrying...',
-                        (self.id(), response))
-                    self.device.close()
-                    self.device = None
-                    sleep(1)
+                job = self.work_queue.get(False)
+            except Empty:
+                return
+            self.job = job
+            if job:
+                self.targetQ = job.targetQ
+                job.original_time = job.time
+                job.time_delta = uint32(int(time())) - bytereverse(job.time)
+
+    def session(self):
+        """Drives the device for the serial engine, from a fresh connection."""
+        while not self.should_stop:
+            self.inits += 1
+            if self.inits > 1:
+                metrics.DEVICE_REINITS.labels(self.id()).inc()
+            response = yield from self.ask(b'ZGX')
+            if is_good_init(response):
+                if self.cache:
+                    self.cache.add(self.port)
+                break
+            say_line('Failed to initialize %s (response: %s), retrying...',
+                     (self.id(), response))
+            if self.cache:
+                # Found again by the next search if it comes back.
+                self.cache.remove(self.port)
+            yield Sleep(1)
+        else:
+            return
+
+        queue = False
+        if not self.options.no_bfl_queue:
+            # Firmware without a queue doesn't know ZQX.
+            response = yield from self.ask(b'ZQX')
+            queue = bool(response and response.startswith(b'OK'))
+        say_line('started BFL miner on %s (%s)',
+                 (self.id(), 'queue' if queue else 'single job'))
+        yield from self.sample()
+        if queue:
+            yield from self.queue_session()
+        else:
+            yield from self.job_session()
+
+    def job_session(self, job=None):
+        """One job at a time with ZDX, polling ZFX for its result, starting
+        with job if given."""
+        last_rated = monotonic()
+        iterations = 0
+        self.job = job
+        self.busy = False
+        while not self.should_stop:
+            self.take_job()
+            if self.sample_due() and (
+                    self.busy or not self.job or self.too_hot()):
+                yield from self.sample()
+            if not self.busy:
+                if not (self.job and self.enabled):
+                    yield Sleep(1, wake=True)
                     continue
-
-                last_rated = time()
+                yield from self.put_job()
+                if self.busy and self.min_interval != maxsize:
+                    # Nothing to collect before the quickest job seen ends.
+                    yield Sleep(self.min_interval - (CHECK_INTERVAL * 2))
+                elif self.too_hot():
+                    yield Sleep(max(self.next_sample - monotonic(),
+                                    CHECK_INTERVAL))
+                else:
+                    yield Sleep(self.check_interval)
+                continue
+
+            result = yield from self.check_result()
+            if not result:
+                if result is None:
+                    self.check_interval = min(self.check_interval * 2, 1)
+                yield Sleep(self.check_interval)
+                continue
+
+            now = monotonic()
+            self.busy = False
+            r = self.last_job
+            self.min_interval = min(self.min_interval, now - self.job_started)
+
+            iterations += 4294967296
+            t = now - last_rated
+            if t > self.options.rate:
+                self.update_rate(now, iterations, t, self.targetQ)
+                last_rated = now
                 iterations = 0
 
-                self.job = None
-                self.busy = False
-                while not self.should_stop:
-                    if (not self.job) or (not self.work_queue.empty()):
-                        try:
-                            self.job = self.work_queue.get(True, 1)
-                        except Empty:
-                            if not self.busy:
-                                continue
-                        else:
-                            if not self.job and not self.busy:
-                                continue
-                            targetQ = self.job.targetQ
-                            self.job.original_time = self.job.time
-                            self.job.time_delta = uint32(
-                                int(time())) - bytereverse(self.job.time)
-
-                    if not self.busy:
-                        self.put_job()
+            if result != b'NO-NONCE\n':
+                r.nonces = result
+                r.found = monotonic()
+                self.switch.put(r)
+
+    def queue_session(self):
+        """
+        Keeps QUEUE_DEPTH jobs queued on the device with ZWX and collects
+        finished ones with ZOX, so the device goes from one job to the next
+        without waiting on the host. Results are matched to their jobs by
+        midstate and data. ZQX drops the queue on a new block. Firmware that
+        keeps rejecting the jobs sent gets them one at a time instead.
+        """
+        last_rated = monotonic()
+        iterations = 0
+        self.job = None
+        in_flight = {}
+        failures = 0
+        while not self.should_stop:
+            if self.work_queue.stale and in_flight:
+                response = yield from self.ask(b'ZQX')
+                if not response or not response.startswith(b'OK'):
+                    say_line('%s: bad response flushing the queue: %s',
+                             (self.id(), response))
+                in_flight.clear()
+            self.take_job()
+            if self.sample_due():
+                yield from self.sample()
+
+            if self.job and self.enabled and len(in_flight) < QUEUE_DEPTH:
+                if not self.too_hot():
+                    job = self.job
+                    jobs = []
+                    while self.job and len(in_flight) + len(jobs) < QUEUE_DEPTH:
+                        jobs.append(self.next_queued_job())
+                    if (yield from self.queue_jobs(jobs, in_flight)):
+                        failures = 0
                     else:
-                        result = self.check_result()
-                        if result:
-                            now = time()
-
-                            self.busy = False
-                            r = self.last_job
-                            job_duration = now - self.job_started
-                            self.put_job()
-
-                            self.min_interval = min(self.min_interval,
-                                                    job_duration)
-
-                            iterations += 4294967296
-                            t = now - last_rated
-                            if t > self.options.rate:
-                                self.update_rate(now, iterations, t, targetQ)
-                                last_rated = now
-                                iterations = 0
-
-                            if result != b'NO-NONCE\n':
-                                r.nonces = result
-                                self.switch.put(r)
-
-                            sleep(self.min_interval - (CHECK_INTERVAL * 2))
-                        else:
-                            if result is None:
-                                self.check_interval = min(
-                                    self.check_interval * 2, 1)
-
-                    sleep(self.check_interval)
-            except Exception:
-                say_exception()
-                if self.device:
-                    self.device.close()
-                    self.device = None
-                sleep(1)
+                        failures += 1
+                        # Still to be mined, here or as a single job.
+                        self.job = self.job or job
+                    if failures >= QUEUE_FAILURES:
+                        say_line('%s: queued jobs rejected, sending single '
+                                 'jobs', self.id())
+                        yield from self.ask(b'ZQX')
+                        yield from self.job_session(self.job)
+                        return
+                else:
+                    say_line('%s: temperature exceeds cutoff, waiting...',
+                             self.id())
+
+            if in_flight:
+                response = yield from self.ask(b'ZOX', end=b'OK\n')
+                finished = self.queue_results(response, in_flight)
+                now = monotonic()
+                iterations += finished * 4294967296
+                t = now - last_rated
+                if t > self.options.rate:
+                    self.update_rate(now, iterations, t, self.targetQ)
+                    last_rated = now
+                    iterations = 0
+                if finished:
+                    continue
+            yield Sleep(QUEUE_POLL_INTERVAL if in_flight else 1, wake=True)
+
+    def next_queued_job(self):
+        """
+        The current job with its time rolled a second past the last one
+        queued, so queued jobs differ. Lets go of the job once its time can't
+        be rolled any further.
+        """
+        job = self.job
+        if self.switch.update_time:
+            now = uint32(int(time())) - job.time_delta
+            rolled = getattr(job, 'rolled', bytereverse(job.original_time) - 1)
+            job.rolled = max(now, rolled + 1)
+            job.time = bytereverse(job.rolled)
+        sent = self.snapshot(job)
+        if not self.switch.update_time or bytereverse(job.time) - bytereverse(
+                job.original_time) >= MAX_TIME_ROLL:
+            self.update = True
+            self.job = None
+        return sent
+
+    def queue_jobs(self, jobs, in_flight):
+        """Queues jobs on the device, returns whether it took them."""
+        response = yield from self.ask(b'ZWX')
+        if not self.is_ok(response):
+            say_line('%s: bad response when queueing jobs (ZWX): %s',
+                     (self.id(), response))
+            return False
+        data = [pack('<8I3I', *job.state, job.merkle_end, job.time,
+                     job.difficulty) for job in jobs]
+        response = yield from self.ask(bytes([len(jobs)]) + b''.join(data))
+        if not response or not response.startswith(b'OK:QUEUED'):
+            say_line('%s: bad response when sending queued jobs: %s',
+                     (self.id(), response))
+            return False
+        for job, key in zip(jobs, data):
+            in_flight[key] = job
+        return True
+
+    def queue_results(self, response, in_flight):
+        """Hands the results in a ZOX response to the switch, returns the
+        number of jobs finished."""
+        lines = response.split(b'\n') if response else []
+        if not lines or not lines[0].startswith(b'COUNT:'):
+            say_line('%s: bad response collecting results: %s',
+                     (self.id(), response))
+            return 0
+        finished = 0
+        for line in lines[1:]:
+            fields = line.split(b',', 3)
+            if len(fields) < 3:
+                continue
+            try:
+                key = unhexlify(fields[0] + fields[1])
+            except ValueError:
+                continue
+            job = in_flight.pop(key, None)
+            if job is None:
+                # Flushed, or from before a reconnect.
+                continue
+            finished += 1
+            if len(fields) == 4 and int(fields[2]):
+                job.nonces = fields[3]
+                job.found = monotonic()
+                self.switch.put(job)
+        return finished
@@ -3,10 +3,11 @@ import sys
 from hashlib import md5
 from queue import Empty
 from struct import error, pack, unpack
-from threading import Lock
-from time import monotonic, sleep
+from threading import Event, Lock, Thread
+from time import monotonic
 
-from apoclypsebm.log import say_line
+from apoclypsebm import hwmon, metrics, pacing
+from apoclypsebm.log import say_exception, say_line
 from apoclypsebm.mining.base import Miner
 from apoclypsebm.sha256 import calculateF, partial
 from apoclypsebm.util import (Object, bytearray_to_uint32, bytereverse,
@@ -75,6 +76,44 @@ else:
     print("\nNot using OpenCL\n")
 
 
+# Longest the scheduler sleeps between checks on running launches, in case
+# the OpenCL implementation can't call back on completion.
+SCHEDULER_POLL_INTERVAL = 0.001
+# How often the scheduler looks for a job for a device that has none.
+SCHEDULER_WORK_INTERVAL = 0.01
+# Kernel defines for each vector width, the nonces a work item hashes.
+VECTOR_DEFINES = {0: '', 1: '', 2: '-D VECTORS', 4: '-D VECTORS4',
+                  8: '-D VECTORS8'}
+# CPU implementations run a work group per core, so the device's maximum is
+# far more than a launch unit should be.
+CPU_WORKSIZE = 64
+# Throttling starts this far below the cutoff temperature unless a target
+# temperature is given.
+THROTTLE_BAND = 10
+
+
+def pci_address(device):
+    """Returns the PCI address of device as sysfs names it, None if the
+    driver doesn't tell."""
+    try:
+        if 'cl_amd_device_attribute_query' in device.extensions:
+            topology = device.topology_amd
+            return (f'0000:{topology.bus:02x}:{topology.device:02x}'
+                    f'.{topology.function:x}')
+        if 'cl_nv_device_attribute_query' in device.extensions:
+            slot = device.pci_slot_id_nv
+            return f'0000:{device.pci_bus_id_nv:02x}:{slot >> 3:02x}.{slot & 7:x}'
+    except (AttributeError, cl.Error):
+        pass
+    return None
+
+
+def preferred_vector_width(device):
+    """Returns the widest supported vector width the device prefers."""
+    preferred = device.preferred_vector_width_int
+    return max(width for width in VECTOR_DEFINES if width <= max(preferred, 0))
+
+
 def shutdown():
     if ADL:
         ADL_Main_Control_Destroy()
@@ -88,8 +127,14 @@ def initialize(options):
     options.worksize = tokenize(options.worksize, 'worksize')
     options.frames = tokenize(options.frames, 'frames', (30,))
     options.frame_sleep = tokenize(options.frame_sleep, 'frame_sleep', cast=float)
-    options.vectors = (True,) if options.old_vectors else tokenize(
-        options.vectors, 'vectors', (False,), bool)
+    options.vectors = (2,) if options.old_vectors else tokenize(
+        options.vectors, 'vectors', (None,))
+    for width in options.vectors:
+        if width is not None and width not in VECTOR_DEFINES:
+            print(f'Unsupported vector size {width}, use one of '
+                  f'{", ".join(map(str, sorted(VECTOR_DEFINES)))}\n')
+            sys.exit()
+    options.ntime_roll = tokenize(options.ntime_roll, 'ntime_roll', [1])
 
     platforms = cl.get_platforms()
 
@@ -116,7 +161,9 @@ def initialize(options):
         OpenCLMiner(i, options)
         for i in range(len(devices))
         if ((not options.device
-             and devices[i].type == cl.device_type.GPU)
+             and (devices[i].type == cl.device_type.GPU
+                  or (options.ocl_cpu
+                      and devices[i].type == cl.device_type.CPU)))
              or (i in options.device))
     ]
 
@@ -128,16 +175,121 @@ def initialize(options):
             min(i, len(options.frame_sleep) - 1)
         ]
         miner.vectors = options.vectors[min(i, len(options.vectors) - 1)]
+        if miner.device.type == cl.device_type.CPU:
+            miner.worksize = miner.worksize or CPU_WORKSIZE
+            if miner.vectors is None:
+                miner.vectors = preferred_vector_width(miner.device)
+        miner.vectors = miner.vectors or 0
+        miner.ntime_roll = max(options.ntime_roll[
+            min(i, len(options.ntime_roll) - 1)
+        ], 1)
+        if miner.ntime_roll > 1 and options.kernel != 'apoclypse-0':
+            say_line('%s kernel can\'t roll ntime, rolling on the host',
+                     options.kernel)
+            miner.ntime_roll = 1
         miner.cutoff_temp = options.cutoff_temp[
             min(i, len(options.cutoff_temp) - 1)
         ]
         miner.cutoff_interval = options.cutoff_interval[
             min(i, len(options.cutoff_interval) - 1)
         ]
+        target_temp = options.target_temp[
+            min(i, len(options.target_temp) - 1)
+        ] if options.target_temp else miner.cutoff_temp - THROTTLE_BAND
+        target_power = options.target_power[
+            min(i, len(options.target_power) - 1)
+        ]
+        miner.throttle = hwmon.Throttle(target_temp, miner.cutoff_temp,
+                                        target_power)
+        if not options.no_hwmon and miner.adapter_idx is None:
+            miner.sensor = hwmon.find_sensor(pci_address(miner.device))
+
+    if options.scheduler and miners:
+        scheduler = Scheduler(miners)
+        for miner in miners:
+            miner.scheduler = scheduler
     return miners
 
 
+class Scheduler(object):
+    """
+    Drives every OpenCL device from one thread. Whenever a device's last
+    launch has been read back, its output is handled and its next launch is
+    enqueued, visiting devices round robin so none is favoured.
+    """
+
+    def __init__(self, miners):
+        self.miners = miners
+        self.thread = None
+        self.wake = Event()
+        self.callbacks = True
+
+    def start(self):
+        if not self.thread:
+            self.thread = Thread(target=self.run)
+            self.thread.start()
+
+    def completed(self, status):
+        self.wake.set()
+
+    def run(self):
+        running = {}
+        miners = []
+        for miner in self.miners:
+            try:
+                miner.setup()
+                miners.append(miner)
+            except Exception:
+                say_exception(f'{miner.id()} failed to start:')
+
+        while miners:
+            self.wake.clear()
+            now = monotonic()
+            next_launch = now + 1
+            for miner in list(miners):
+                if miner.should_stop:
+                    miners.remove(miner)
+                    running.pop(miner, None)
+                    continue
+                try:
+                    event = running.get(miner)
+                    if event is not None:
+                        if (event.command_execution_status
+                                != cl.command_execution_status.COMPLETE):
+                            continue
+                        del running[miner]
+                        miner.complete()
+                    if miner.idle_until <= now:
+                        event = miner.launch()
+                        if event is not None:
+                            running[miner] = event
+                            self.notify_on_completion(event)
+                            continue
+                    next_launch = min(next_launch, miner.idle_until)
+                except Exception:
+                    say_exception(f'{miner.id()} stopped:')
+                    miner.should_stop = True
+            # Whoever was served first waits longest next time around.
+            if miners:
+                miners.append(miners.pop(0))
+
+            timeout = next_launch - monotonic()
+            if running and not self.callbacks:
+                timeout = min(timeout, SCHEDULER_POLL_INTERVAL)
+            if timeout > 0:
+                self.wake.wait(timeout)
+
+    def notify_on_completion(self, event):
+        try:
+            event.set_callback(cl.command_execution_status.COMPLETE,
+                               self.completed)
+        except (AttributeError, cl.Error):
+            self.callbacks = False
+
+
 class OpenCLMiner(Miner):
+    kind = 'GPU'
+
     def __init__(self, device_idx, options):
         super(OpenCLMiner, self).__init__(device_idx, options)
         self.output_size = 0x100
@@ -150,7 +302,16 @@ class OpenCLMiner(Miner):
 
         self.worksize = self.frame_sleep = self.rate = self.estimated_rate = 0
         self.execution_local_dims = None
-        self.vectors = False
+        self.vectors = 0
+        self.ntime_roll = self.rolls = 1
+        self.context = None
+        self.kernel_outdated = False
+        self.scheduler = None
+        self.wake = Event()
+        self.sensor = None
+        self.throttle = None
+        self.sizer = None
+        self.duty = 1.0
 
         self.adapter_idx = None
         if (
@@ -167,183 +328,370 @@ class OpenCLMiner(Miner):
         return f'{self.options.platform}:{self.device_idx}:{self.device_name}'
 
     def nonce_generator(self, nonces):
+        if isinstance(nonces, list):
+            # Results rolled on the device come split by ntime already.
+            yield from nonces
+            return
         for i in range(0, len(nonces) - 4, 4):
             nonce = bytearray_to_uint32(nonces[i:i + 4])
             if nonce:
                 yield nonce
 
+    def start(self):
+        if not self.scheduler:
+            super(OpenCLMiner, self).start()
+            return
+        self.should_stop = False
+        self.start_time = monotonic()
+        self.scheduler.start()
+
     def mining_thread(self):
+        self.setup()
+        while not self.should_stop:
+            wait = self.idle_until - monotonic()
+            if wait > 0:
+                self.wake.wait(wait)
+                self.wake.clear()
+            if self.launch(timeout=1) is not None:
+                self.queue.finish()
+                self.complete()
+
+    def setup(self):
         say_line('started OpenCL miner on platform %d, device %d (%s)',
                  (self.options.platform, self.device_idx, self.device_name))
 
-        self.defines, rate_divisor, hashspace = (
-            '-D VECTORS', 500, 0x7FFFFFFF
-        ) if self.vectors else (
-            '', 1000, 0xFFFFFFFF
-        )
+        lanes = max(self.vectors, 1)
+        self.defines = VECTOR_DEFINES[self.vectors]
+        self.rate_divisor = 1000 // lanes
+        self.hashspace = 0xFFFFFFFF // lanes
 
         self.defines += (
             f' -D OUTPUT_SIZE={self.output_size}'
             f' -D OUTPUT_MASK={self.output_size - 1}'
         )
+        output_words = self.output_size + 1
+        if self.ntime_roll > 1:
+            # ntime offsets follow the nonces
+            self.defines += ' -D NTIME_ROLL'
+            output_words += self.output_size
 
         self.load_kernel()
-        frame = 1.0 / max(self.frames, 3)
-        unit = self.worksize * 256
-        global_threads = unit * 10
-
-        queue = cl.CommandQueue(self.context)
+        self.unit = self.worksize * 256 * self.ntime_roll
+        self.launch_sizes = None
+        if self.options.launch_sizes:
+            self.launch_sizes = pacing.launch_sizes(self.options.launch_sizes)
+        self.saved_size = self.launch_sizes and self.launch_sizes.get(
+            self.launch_size_key())
+        self.sizer = pacing.LaunchSizer(self.unit, self.max_launch_size(),
+                                        self.frame_time(), self.saved_size)
+        self.global_threads = self.sizer.size
+        self.launch_size = metrics.LAUNCH_SIZE.labels(self.id())
+        self.launch_size.set(self.global_threads)
+
+        self.queue = cl.CommandQueue(
+            self.context,
+            properties=cl.command_queue_properties.PROFILING_ENABLE)
 
-        last_rated_pace = last_rated = last_n_time = last_temperature = monotonic()
-        base = last_hash_rate = threads_run_pace = threads_run = 0
+        self.last_rated = self.last_n_time = self.last_temperature = monotonic()
+        self.base = self.threads_run = 0
 
-        blank_output = b'\x00' * ((self.output_size + 1) * 4)
-        host_output = bytearray(blank_output)
-        cl_output = cl.Buffer(
+        self.blank_output = b'\x00' * (output_words * 4)
+        self.host_output = bytearray(self.blank_output)
+        self.cl_output = cl.Buffer(
             self.context,
             cl.mem_flags.WRITE_ONLY,
-            size=len(host_output)
+            size=len(self.host_output)
         )
-        cl.enqueue_copy(queue, cl_output, blank_output)
-        self.kernel.set_arg(20, cl_output)
-
-        work = None
-        temperature = 0
-        while True:
-            if self.should_stop:
-                return
-
-            sleep(self.frame_sleep)
-
-            if (not work) or (not self.work_queue.empty()):
-                try:
-                    work = self.work_queue.get(True, 1)
-                except Empty:
-                    continue
-                else:
-                    if not work:
-                        continue
-                    nonces_left = hashspace
-                    state = work.state
-                    f = [0, 0, 0, 0, 0, 0, 0, 0]
-                    state2 = partial(state, work.merkle_end, work.time,
-                                     work.difficulty, f)
-                    calculateF(state, work.merkle_end, work.time,
-                               work.difficulty, f, state2)
-
-                    set_arg = self.kernel.set_arg
-                    set_arg(0, uint32_as_bytes(state[0]))
-                    set_arg(1, uint32_as_bytes(state[1]))
-                    set_arg(2, uint32_as_bytes(state[2]))
-                    set_arg(3, uint32_as_bytes(state[3]))
-                    set_arg(4, uint32_as_bytes(state[4]))
-                    set_arg(5, uint32_as_bytes(state[5]))
-                    set_arg(6, uint32_as_bytes(state[6]))
-                    set_arg(7, uint32_as_bytes(state[7]))
-
-                    set_arg(8, uint32_as_bytes(state2[1]))
-                    set_arg(9, uint32_as_bytes(state2[2]))
-                    set_arg(10, uint32_as_bytes(state2[3]))
-                    set_arg(11, uint32_as_bytes(state2[5]))
-                    set_arg(12, uint32_as_bytes(state2[6]))
-                    set_arg(13, uint32_as_bytes(state2[7]))
-
-                    set_arg(15, uint32_as_bytes(f[0]))
-                    set_arg(16, uint32_as_bytes(f[1]))
-                    set_arg(17, uint32_as_bytes(f[2]))
-                    set_arg(18, uint32_as_bytes(f[3]))
-                    set_arg(19, uint32_as_bytes(f[4]))
-
-            if temperature < self.cutoff_temp:
-                self.kernel.set_arg(14, uint32_as_bytes(base))
-                cl.enqueue_nd_range_kernel(queue, self.kernel,
-                                           (global_threads,), self.execution_local_dims)
-
-                nonces_left -= global_threads
-                threads_run_pace += global_threads
-                threads_run += global_threads
-                base = uint32(base + global_threads)
+        cl.enqueue_copy(self.queue, self.cl_output, self.blank_output)
+        self.kernel.set_arg(20, self.cl_output)
+
+        self.work = None
+        self.temperature = 0
+        self.idle_until = 0
+        self.launched = 0
+        self.kernel_event = None
+        if self.sensor:
+            hwmon.SAMPLER.watch(self, self.sensor, self.throttle)
+
+    def launch(self, timeout=0):
+        """
+        Enqueues the next kernel execution and the read back of its output.
+        Returns the read back's event, or None if there was nothing to run,
+        in which case idle_until says when to try again. Waits up to timeout
+        seconds for a job when there is none.
+        """
+        now = monotonic()
+        self.idle_until = now + self.frame_sleep
+
+        if self.work_queue.stale:
+            self.work = None
+
+        if not self.enabled:
+            self.idle_until = now + 1
+            return None
+
+        if self.kernel_outdated:
+            self.kernel_outdated = False
+            self.load_kernel()
+            self.kernel.set_arg(20, self.cl_output)
+            self.unit = self.worksize * 256 * self.ntime_roll
+            self.saved_size = self.launch_sizes and self.launch_sizes.get(
+                self.launch_size_key())
+            self.sizer.set_limits(self.unit, size=self.saved_size)
+            self.global_threads = self.sizer.size
+            self.launch_size.set(self.global_threads)
+            if self.work:
+                self.set_work_args()
+
+        if (not self.work) or (not self.work_queue.empty()):
+            try:
+                work = self.work_queue.get(timeout > 0, timeout or None)
+            except Empty:
+                work = None
+            if not work:
+                self.idle_until = now + SCHEDULER_WORK_INTERVAL
+                return None
+            self.work = work
+            self.nonces_left = self.hashspace
+            self.state = work.state
+            if self.ntime_roll == 1:
+                self.calculate_time_args()
+            self.set_work_args()
+
+        if self.duty > 0:
+            self.kernel.set_arg(14, uint32_as_bytes(self.base))
+            if self.ntime_roll > 1:
+                self.rolls = self.ntime_window()
+                self.kernel.set_arg(
+                    10, uint32_as_bytes(self.global_threads // self.rolls))
+            nonces = self.global_threads // self.rolls
+            self.launched = monotonic()
+            self.kernel_event = cl.enqueue_nd_range_kernel(
+                self.queue, self.kernel, (self.global_threads,),
+                self.execution_local_dims)
+
+            self.nonces_left -= nonces
+            self.threads_run += self.global_threads
+            self.base = uint32(self.base + nonces)
+        else:
+            self.kernel_event = None
+            self.idle_until = now + self.cutoff_interval
+
+        if self.adapter_idx is not None:
+            t = now - self.last_temperature
+            if self.duty == 0 or t > 1:
+                self.last_temperature = now
+                with adl_lock:
+                    self.temperature = self.get_temperature()
+                self.duty = self.throttle.update(self.temperature)
+                metrics.TEMPERATURE.labels(self.id()).set(self.temperature)
+                metrics.DUTY_CYCLE.labels(self.id()).set(self.duty)
+
+        t = now - self.last_rated
+        if t > self.options.rate:
+            self.update_rate(now, self.threads_run, t, self.work.targetQ,
+                             self.rate_divisor)
+            self.last_rated = now
+            self.threads_run = 0
+
+        event = cl.enqueue_copy(self.queue, self.host_output, self.cl_output,
+                                is_blocking=False)
+        self.queue.flush()
+        return event
+
+    def complete(self):
+        """Handles the output of the last launch once it has been read back."""
+        if self.kernel_event is not None:
+            self.pace(monotonic() - self.launched)
+
+        work = self.work
+        if self.host_output[-1]:
+            if self.ntime_roll > 1:
+                for offset, nonces in self.rolled_nonces().items():
+                    self.switch.put(self.result(
+                        work, nonces,
+                        bytereverse(bytereverse(work.time) + offset)))
             else:
-                threads_run_pace = 0
-                last_rated_pace = monotonic()
-                sleep(self.cutoff_interval)
-
-            now = monotonic()
-            if self.adapter_idx is not None:
-                t = now - last_temperature
-                if temperature >= self.cutoff_temp or t > 1:
-                    last_temperature = now
-                    with adl_lock:
-                        temperature = self.get_temperature()
-
-            t = now - last_rated_pace
-            if t > 1:
-                rate = (threads_run_pace / t) / rate_divisor
-                last_rated_pace = now
-                threads_run_pace = 0
-                r = last_hash_rate / rate
-                if r < 0.9 or r > 1.1:
-                    global_threads = max(
-                        unit * int((rate * frame * rate_divisor) / unit), unit)
-                    last_hash_rate = rate
-
-            t = now - last_rated
-            if t > self.options.rate:
-                self.update_rate(now, threads_run, t, work.targetQ,
-                                 rate_divisor)
-                last_rated = now
-                threads_run = 0
-
-            cl.enqueue_copy(queue, host_output, cl_output)
-            queue.finish()
-
-            if host_output[-1]:
-                result = Object()
-                result.header = work.header
-                result.merkle_end = work.merkle_end
-                result.time = work.time
-                result.difficulty = work.difficulty
-                result.target = work.target
-                result.state = tuple(state)
-                result.nonces = host_output[:]
-                result.job_id = work.job_id
-                result.extranonce2 = work.extranonce2
-                result.transactions = work.transactions
-                result.server = work.server
-                result.miner = self
-                self.switch.put(result)
-                cl.enqueue_copy(queue, cl_output, blank_output)
-
-            if not self.switch.update_time:
-                if nonces_left < 3 * global_threads * self.frames:
-                    self.update = True
-                    nonces_left += 0xFFFFFFFFFFFF
-                elif 0xFFFFFFFFFFF < nonces_left < 0xFFFFFFFFFFFF:
-                    say_line('warning: job finished, %s is idle', self.id())
-                    work = None
-            elif now - last_n_time > 1:
-                work.time = bytereverse(bytereverse(work.time) + 1)
-                state2 = partial(state, work.merkle_end, work.time,
-                                 work.difficulty, f)
-                calculateF(state, work.merkle_end, work.time, work.difficulty,
-                           f, state2)
-                set_arg = self.kernel.set_arg
-                set_arg(8, uint32_as_bytes(state2[1]))
-                set_arg(9, uint32_as_bytes(state2[2]))
-                set_arg(10, uint32_as_bytes(state2[3]))
-                set_arg(11, uint32_as_bytes(state2[5]))
-                set_arg(12, uint32_as_bytes(state2[6]))
-                set_arg(13, uint32_as_bytes(state2[7]))
-                set_arg(15, uint32_as_bytes(f[0]))
-                set_arg(16, uint32_as_bytes(f[1]))
-                set_arg(17, uint32_as_bytes(f[2]))
-                set_arg(18, uint32_as_bytes(f[3]))
-                set_arg(19, uint32_as_bytes(f[4]))
-                last_n_time = now
-                self.update_time_counter += 1
-                if self.update_time_counter >= self.switch.max_update_time:
-                    self.update = True
-                    self.update_time_counter = 1
+                self.switch.put(self.result(work, self.host_output[:],
+                                            work.time))
+            cl.enqueue_copy(self.queue, self.cl_output, self.blank_output)
+
+        now = monotonic()
+        duty = self.duty
+        if self.kernel_event is not None and 0 < duty < 1:
+            # Rest in proportion to the launch just run to hold the duty cycle.
+            idle = (now - self.launched) * (1 - duty) / duty
+            self.idle_until = max(self.idle_until, now + idle)
+        if not self.switch.update_time:
+            if self.nonces_left < 3 * self.global_threads * self.frames:
+                self.update = True
+                self.nonces_left += 0xFFFFFFFFFFFF
+            elif 0xFFFFFFFFFFF < self.nonces_left < 0xFFFFFFFFFFFF:
+                say_line('warning: job finished, %s is idle', self.id())
+                self.work = None
+        elif self.ntime_roll > 1:
+            if self.nonces_left <= 0:
+                # Every nonce of the window has been searched, move past it.
+                self.nonces_left += self.hashspace
+                self.roll_time(work, self.rolls)
+                self.set_roll_args(work)
+        elif now - self.last_n_time > 1:
+            self.roll_time(work, 1)
+            self.calculate_time_args()
+            self.set_time_args(self.state2, self.f)
+            self.last_n_time = now
+
+    def result(self, work, nonces, time):
+        result = Object()
+        result.header = work.header
+        result.merkle_end = work.merkle_end
+        result.time = time
+        result.difficulty = work.difficulty
+        result.target = work.target
+        result.state = tuple(self.state)
+        result.nonces = nonces
+        result.job_id = work.job_id
+        result.extranonce2 = work.extranonce2
+        result.template = work.template
+        result.server = work.server
+        result.miner = self
+        result.received = work.received
+        result.found = monotonic()
+        return result
+
+    def rolled_nonces(self):
+        """Groups the nonces of the last launch by the ntime offset they
+        were found at."""
+        words = unpack(f'<{2 * self.output_size}I',
+                       self.host_output[:8 * self.output_size])
+        found = {}
+        for nonce, offset in zip(words[:self.output_size],
+                                 words[self.output_size:]):
+            if nonce:
+                found.setdefault(offset, []).append(nonce)
+        return found
+
+    def ntime_window(self):
+        """Returns how many ntime values the next launch may search."""
+        if (self.switch.update_time
+                and self.ntime_roll <= self.switch.max_update_time):
+            return self.ntime_roll
+        return 1
+
+    def roll_time(self, work, seconds):
+        work.time = bytereverse(bytereverse(work.time) + seconds)
+        self.update_time_counter += seconds
+        if self.update_time_counter >= self.switch.max_update_time:
+            self.update = True
+            self.update_time_counter = 1
+
+    def pace(self, elapsed):
+        """Sizes the next launch from how long the last one took."""
+        device = self.id()
+        metrics.LAUNCH_SECONDS.labels(device).observe(elapsed)
+        try:
+            profile = self.kernel_event.profile
+            metrics.KERNEL_SECONDS.labels(device).observe(
+                (profile.end - profile.start) / 1e9)
+        except (cl.Error, RuntimeError):
+            pass
+
+        self.global_threads = self.sizer.update(elapsed)
+        self.launch_size.set(self.global_threads)
+        if (self.launch_sizes and self.sizer.settled == pacing.SETTLED_LAUNCHES
+                and self.global_threads != self.saved_size):
+            self.saved_size = self.global_threads
+            self.launch_sizes.set(self.launch_size_key(), self.saved_size)
+
+    def frame_time(self):
+        return 1.0 / max(self.frames, 3)
+
+    def max_launch_size(self):
+        # A launch never covers more than the nonce range of each ntime it
+        # rolls, and global sizes are size_t on the device.
+        return min((self.hashspace + 1) * self.ntime_roll,
+                   2 ** self.device.address_bits - 1)
+
+    def launch_size_key(self):
+        """Names the device and everything that sets its launch time."""
+        return (f'{self.device.platform.name}/{self.device_name}/'
+                f'{pci_address(self.device) or self.device_idx}/'
+                f'{self.options.kernel}{self.defines}'
+                f' -D WORK_GROUP_SIZE={self.worksize}/frames={self.frames}')
+
+    def calculate_time_args(self):
+        work = self.work
+        self.f = [0, 0, 0, 0, 0, 0, 0, 0]
+        self.state2 = partial(self.state, work.merkle_end, work.time,
+                              work.difficulty, self.f)
+        calculateF(self.state, work.merkle_end, work.time,
+                   work.difficulty, self.f, self.state2)
+
+    def set_work_args(self):
+        self.set_state_args(self.state)
+        if self.ntime_roll > 1:
+            self.set_roll_args(self.work)
+        else:
+            self.set_time_args(self.state2, self.f)
+
+    def set_state_args(self, state):
+        set_arg = self.kernel.set_arg
+        set_arg(0, uint32_as_bytes(state[0]))
+        set_arg(1, uint32_as_bytes(state[1]))
+        set_arg(2, uint32_as_bytes(state[2]))
+        set_arg(3, uint32_as_bytes(state[3]))
+        set_arg(4, uint32_as_bytes(state[4]))
+        set_arg(5, uint32_as_bytes(state[5]))
+        set_arg(6, uint32_as_bytes(state[6]))
+        set_arg(7, uint32_as_bytes(state[7]))
+
+    def set_time_args(self, state2, f):
+        set_arg = self.kernel.set_arg
+        set_arg(8, uint32_as_bytes(state2[1]))
+        set_arg(9, uint32_as_bytes(state2[2]))
+        set_arg(10, uint32_as_bytes(state2[3]))
+        set_arg(11, uint32_as_bytes(state2[5]))
+        set_arg(12, uint32_as_bytes(state2[6]))
+        set_arg(13, uint32_as_bytes(state2[7]))
+        set_arg(15, uint32_as_bytes(f[0]))
+        set_arg(16, uint32_as_bytes(f[1]))
+        set_arg(17, uint32_as_bytes(f[2]))
+        set_arg(18, uint32_as_bytes(f[3]))
+        set_arg(19, uint32_as_bytes(f[4]))
+
+    def set_roll_args(self, work):
+        """Sets what the NTIME_ROLL kernel derives the time arguments
+        from. Argument 10 is set with every launch."""
+        set_arg = self.kernel.set_arg
+        set_arg(8, uint32_as_bytes(work.merkle_end))
+        set_arg(9, uint32_as_bytes(work.time))
+        set_arg(15, uint32_as_bytes(work.difficulty))
+        for unused in (11, 12, 13, 16, 17, 18, 19):
+            set_arg(unused, uint32_as_bytes(0))
+
+    def restart(self):
+        """
+        A launch already running can't be preempted, but its results are
+        dropped by the switch and the next launch is for the new block
+        without waiting out frame_sleep.
+        """
+        super(OpenCLMiner, self).restart()
+        self.idle_until = 0
+        if self.scheduler:
+            self.scheduler.wake.set()
+        else:
+            self.wake.set()
+
+    def configure(self, frames=None, worksize=None):
+        """Changes launch settings while mining. A new worksize only rebuilds
+        this device's kernel, on the mining thread."""
+        if frames:
+            self.frames = frames
+            if self.sizer:
+                self.sizer.set_frame_time(self.frame_time())
+        if worksize and worksize != self.worksize:
+            self.worksize = worksize
+            self.kernel_outdated = True
 
     def load_kernel(self):
         max_worksize = self.device.get_info(cl.device_info.MAX_WORK_GROUP_SIZE)
@@ -351,7 +699,7 @@ class OpenCLMiner(Miner):
             self.worksize = max_worksize
             if self.options.verbose:
                 say_line('Set worksize to %s from device info.', self.worksize)
-        self.defines += f' -D WORK_GROUP_SIZE={self.worksize}'
+        defines = self.defines + f' -D WORK_GROUP_SIZE={self.worksize}'
         if self.worksize > max_worksize:
             # Exceeding the max advertised work group size
             # The overriding size will only be configure
@@ -360,19 +708,20 @@ class OpenCLMiner(Miner):
         else:
             self.execution_local_dims = (self.worksize,)
 
-        self.context = cl.Context([self.device], None, None)
+        if not self.context:
+            self.context = cl.Context([self.device], None, None)
         if self.device.extensions.find('cl_amd_media_ops') != -1:
-            self.defines += ' -D BITALIGN'
+            defines += ' -D BITALIGN'
             if self.device_name in ('Cedar', 'Redwood', 'Juniper', 'Cypress',
                                     'Hemlock', 'Caicos', 'Turks', 'Barts',
                                     'Cayman', 'Antilles', 'Wrestler',
                                     'Zacate', 'WinterPark', 'BeaverCreek'):
-                self.defines += ' -D BFI_INT'
+                defines += ' -D BFI_INT'
 
         kernel = pkgutil.get_data('apoclypsebm', f'{self.options.kernel}.cl')
         m = md5(
             f'{self.device.platform.name}{self.device.platform.version}'
-            f'{self.device.name}{self.defines}'.encode('utf-8')
+            f'{self.device.name}{defines}'.encode('utf-8')
         )
         m.update(kernel)
         cache_name = f'{m.hexdigest()}.elf'
@@ -380,13 +729,13 @@ class OpenCLMiner(Miner):
         try:
             with open(cache_name, 'rb') as binary:
                 self.program = cl.Program(self.context, [self.device],
-                                          [binary.read()]).build(self.defines)
+                                          [binary.read()]).build(defines)
         except (IOError, cl.LogicError):
             kernel = kernel.decode('ascii')
-            self.program = cl.Program(self.context, kernel).build(self.defines)
-            if self.defines.find('-D BFI_INT') != -1:
+            self.program = cl.Program(self.context, kernel).build(defines)
+            if defines.find('-D BFI_INT') != -1:
                 patched_binary = self.patch(self.program.binaries[0])
-                self.program = cl.Program(self.context, [self.device], [patched_binary]).build(self.defines)
+                self.program = cl.Program(self.context, [self.device], [patched_binary]).build(defines)
             with open(cache_name, 'wb') as binary:
                 binary.write(self.program.binaries[0])
 
@@ -0,0 +1,325 @@
+"""
+Devices running in worker processes.
+
+With --device-processes N, discovered devices are handed in groups of N to
+worker processes, each with its own interpreter and GIL. Inside a worker
+the usual miner classes run unchanged against a WorkerSwitch. Jobs go out
+and results come back through shared memory rings, and the coordinating
+process keeps a ProcessMiner per device so the switch, API and metrics see
+the same devices they would see with threads. Results are still verified
+by the switch.
+
+A supervisor thread per worker moves messages between the switch and the
+rings and restarts the worker if it dies, backing off when it keeps dying.
+"""
+import io
+import os
+from collections import OrderedDict, deque
+from contextlib import redirect_stdout
+from functools import partial
+from importlib import import_module
+from multiprocessing import get_context
+from queue import Empty
+from threading import Thread
+from time import monotonic, sleep
+
+from apoclypsebm import log, metrics
+from apoclypsebm.log import say_exception, say_line
+from apoclypsebm.mining.base import Miner
+from apoclypsebm.ring import Ring
+from apoclypsebm.util import Object
+
+POLL_INTERVAL = 0.001
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+# A worker that lived this long is considered healthy again.
+STABLE_UPTIME = 60
+# Jobs whose coordinator-only attributes are kept for their results.
+JOB_HISTORY = 256
+RING_SLOTS = 256
+SLOT_SIZE = 8192
+
+# Work attributes that can't or needn't cross to a worker.
+LOCAL_ATTRIBUTES = ('server', 'template')
+
+
+def initialize(backend, miners, options):
+    """Returns stand-ins for miners, which run in groups in worker processes."""
+    per_process = options.device_processes
+    proxies = []
+    for i in range(0, len(miners), per_process):
+        proxies.extend(Worker(backend, miners[i:i + per_process], options).miners)
+    return proxies
+
+
+class ProcessMiner(Miner):
+    """A device running in a worker process, as seen by the switch."""
+
+    def __init__(self, worker, position, miner):
+        super().__init__(miner.device_idx, worker.options)
+        self.worker = worker
+        self.position = position
+        self.name = miner.id()
+        self.kind = miner.kind
+        self.verify_mask = miner.verify_mask
+        self.configurable = type(miner).configure is not Miner.configure
+        self.frames = getattr(miner, 'frames', None)
+        self.worksize = getattr(miner, 'worksize', None)
+        self.jobs = 0
+
+    def id(self):
+        return self.name
+
+    def start(self):
+        self.should_stop = False
+        self.start_time = monotonic()
+        self.worker.start()
+
+    def stop(self, message=None):
+        super().stop(message)
+        self.worker.stop()
+
+    def nonce_generator(self, nonces):
+        # Workers send nonces already extracted from the device's format.
+        return iter(nonces)
+
+    def set_enabled(self, enabled):
+        super().set_enabled(enabled)
+        self.worker.send(('enable', self.position, enabled))
+
+    def restart(self):
+        super().restart()
+        self.worker.send(('restart', self.position))
+
+    def configure(self, frames=None, worksize=None):
+        if not self.configurable:
+            super().configure(frames, worksize)
+        self.frames = frames or self.frames
+        self.worksize = worksize or self.worksize
+        self.worker.send(('configure', self.position,
+                          {'frames': frames, 'worksize': worksize}))
+
+
+class Worker(object):
+    def __init__(self, backend, miners, options):
+        self.backend = backend
+        self.options = options
+        self.device_indexes = [miner.device_idx for miner in miners]
+        self.miners = [ProcessMiner(self, i, miner)
+                       for i, miner in enumerate(miners)]
+        self.name = ','.join(miner.id() for miner in self.miners)
+
+        self.jobs = Ring(RING_SLOTS, SLOT_SIZE)
+        self.results = Ring(RING_SLOTS, SLOT_SIZE)
+        self.outbox = deque()
+        # Latest job of every device, sent again to a restarted worker.
+        self.current_jobs = {}
+        self.history = OrderedDict()
+
+        self.process = None
+        self.started = False
+        self.should_stop = False
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        self.spawn()
+        Thread(target=self.supervise, daemon=True).start()
+
+    def stop(self):
+        self.should_stop = True
+
+    def send(self, message):
+        self.outbox.append(message)
+
+    def spawn(self):
+        self.jobs.reset()
+        self.results.reset()
+        self.process = get_context('spawn').Process(
+            target=worker_main, name=f'apoclypse {self.name}', daemon=True,
+            args=(self.backend, self.device_indexes, self.options, self.jobs,
+                  self.results))
+        self.process.start()
+        self.spawned = monotonic()
+
+    def supervise(self):
+        restart_delay = RESTART_DELAY
+        while not self.should_stop:
+            try:
+                busy = self.forward_jobs()
+                busy = self.collect_results() or busy
+            except Exception:
+                say_exception(f'{self.name} supervisor error:')
+                busy = False
+
+            if not self.process.is_alive():
+                if monotonic() - self.spawned > STABLE_UPTIME:
+                    restart_delay = RESTART_DELAY
+                say_line('%s worker exited with code %s, restarting in %ds',
+                         (self.name, self.process.exitcode, restart_delay))
+                sleep(restart_delay)
+                restart_delay = min(restart_delay * 2, MAX_RESTART_DELAY)
+                self.spawn()
+                self.outbox.extendleft(reversed(list(
+                    self.current_jobs.values())))
+            elif not busy:
+                sleep(POLL_INTERVAL)
+
+        self.jobs.put(('stop',))
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def forward_jobs(self):
+        for miner in self.miners:
+            try:
+                # The worker computes the midstate.
+                work = miner.work_queue.get(False, prepared=False)
+            except Empty:
+                continue
+            miner.jobs += 1
+            self.outbox.append(self.job_message(miner, work))
+
+        busy = False
+        while self.outbox and self.jobs.put(self.outbox[0]):
+            self.outbox.popleft()
+            busy = True
+        return busy
+
+    def job_message(self, miner, work):
+        switch = miner.switch
+        remote = work
+        if work:
+            self.history[bytes(work.header)] = {
+                name: getattr(work, name, None) for name in LOCAL_ATTRIBUTES}
+            while len(self.history) > JOB_HISTORY:
+                self.history.popitem(False)
+            remote = Object()
+            remote.__dict__.update(work.__dict__)
+            for name in LOCAL_ATTRIBUTES:
+                setattr(remote, name, None)
+        message = ('job', miner.position, remote, switch.update_time,
+                   switch.max_update_time)
+        self.current_jobs[miner.position] = message
+        return message
+
+    def collect_results(self):
+        busy = False
+        while True:
+            message = self.results.get()
+            if message is None:
+                return busy
+            busy = True
+            kind, miner = message[0], self.miners[message[1]]
+            if kind == 'result':
+                result = message[2]
+                local = self.history.get(bytes(result.header))
+                if local is None:
+                    continue
+                result.__dict__.update(local)
+                result.miner = miner
+                miner.switch.put(result)
+            elif kind == 'rate':
+                iterations, t, targetQ, rate_divisor, gauges = message[2:]
+                for name, value in gauges.items():
+                    child = getattr(metrics, name).labels(miner.id())
+                    if name in WorkerSwitch.COUNTERS:
+                        # Totals in the worker, which start over with it.
+                        if value > child.value():
+                            child.inc(value - child.value())
+                    else:
+                        child.set(value)
+                miner.update_rate(monotonic(), iterations, t, targetQ,
+                                  rate_divisor)
+
+
+class WorkerSwitch(object):
+    """What miners in a worker process see of the switch."""
+
+    # Device gauges set inside the worker, forwarded with rate updates.
+    GAUGES = ('TEMPERATURE', 'LAUNCH_SIZE', 'FAN_SPEED', 'POWER', 'DUTY_CYCLE',
+              'HASHES_PER_JOULE')
+    # Device counters set inside the worker, forwarded as totals.
+    COUNTERS = ('DEVICE_TIMEOUTS', 'DEVICE_REINITS')
+
+    def __init__(self, options, results):
+        self.options = options
+        self.results = results
+        self.update_time = True
+        self.max_update_time = options.max_update_time
+        self.should_stop = False
+
+    def put(self, result):
+        miner = result.miner
+        result.nonces = list(miner.nonce_generator(result.nonces))
+        result.miner = None
+        message = ('result', miner.position, result)
+        try:
+            while not self.results.put(message):
+                if self.should_stop:
+                    return
+                sleep(POLL_INTERVAL)
+        except ValueError:
+            say_exception(f'{miner.id()} result dropped:')
+        finally:
+            result.miner = miner
+
+    def rate_updated(self, miner, now, iterations, t, targetQ,
+                     rate_divisor=1000):
+        # Kept here too, for hashes per joule.
+        miner.hashes += iterations * (1000 / rate_divisor)
+        gauges = {name: getattr(metrics, name).value(miner.id())
+                  for name in self.GAUGES + self.COUNTERS
+                  if (miner.id(),) in getattr(metrics, name).children}
+        # A full ring only costs this one rate sample.
+        self.results.put(('rate', miner.position, iterations, t, targetQ,
+                          rate_divisor, gauges))
+
+
+def worker_main(backend, device_indexes, options, jobs, results):
+    log.verbose = options.verbose
+    log.quiet = options.quiet
+    parent = os.getppid()
+
+    module = import_module(f'apoclypsebm.mining.{backend}')
+    # Discovery already listed the devices in the coordinating process.
+    with redirect_stdout(io.StringIO()):
+        found = {miner.device_idx: miner for miner in module.initialize(options)}
+    miners = [found[i] for i in device_indexes]
+
+    switch = WorkerSwitch(options, results)
+    for position, miner in enumerate(miners):
+        miner.switch = switch
+        miner.position = position
+        miner.update_rate = partial(switch.rate_updated, miner)
+        miner.start()
+
+    try:
+        while os.getppid() == parent:
+            message = jobs.get()
+            if message is None:
+                sleep(POLL_INTERVAL)
+                continue
+            kind = message[0]
+            if kind == 'stop':
+                break
+            position = message[1]
+            if kind == 'job':
+                work, switch.update_time, switch.max_update_time = message[2:]
+                miners[position].work_queue.put(work)
+            elif kind == 'restart':
+                miners[position].restart()
+            elif kind == 'enable':
+                miners[position].set_enabled(message[2])
+            elif kind == 'configure':
+                miners[position].configure(**message[2])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        switch.should_stop = True
+        for miner in miners:
+            miner.stop()
+        if hasattr(module, 'shutdown'):
+            module.shutdown()
+        log.flush()
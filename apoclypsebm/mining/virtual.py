@@ -0,0 +1,142 @@
+"""
+Virtual devices for load testing the host side of mining.
+
+They take real jobs from the switch and hand back shares at a fixed rate in
+the OpenCL nonce buffer format, so verification, deduplication and
+submission can be profiled without hardware. Shares only need
+--virtual-bits zero bits, which the switch accepts through verify_mask.
+"""
+from hashlib import sha256
+from queue import Empty
+from struct import pack, unpack
+from time import monotonic, sleep
+
+from apoclypsebm.mining.base import Miner
+from apoclypsebm.util import (Object, bytearray_to_uint32, bytereverse, uint32,
+                              uint32_as_bytes)
+
+MODES = ('cpu', 'replay')
+
+OUTPUT_SIZE = 0x100
+# Valid nonces found once per job and then submitted over and over in
+# replay mode.
+REPLAY_NONCES = 1024
+
+
+def initialize(options):
+    return [VirtualMiner(i, options) for i in range(options.virtual)]
+
+
+class VirtualMiner(Miner):
+    """
+    :param mode: 'cpu' searches for a fresh nonce for every share, 'replay'
+        searches for REPLAY_NONCES per job and cycles through them, reaching
+        rates the CPU search can't at the cost of duplicate shares.
+    """
+
+    def __init__(self, device_idx, options):
+        super().__init__(device_idx, options)
+        self.mode = options.virtual_mode
+        self.share_rate = options.virtual_rate
+        self.verify_mask = bytereverse(
+            uint32(0xFFFFFFFF << (32 - options.virtual_bits)))
+        self.jobs = 0
+
+    def id(self):
+        return f'virtual:{self.device_idx}'
+
+    def nonce_generator(self, nonces):
+        for i in range(0, len(nonces) - 4, 4):
+            nonce = bytearray_to_uint32(nonces[i:i + 4])
+            if nonce:
+                yield nonce
+
+    def find_nonces(self, prefix, nonce, count):
+        mask = self.verify_mask
+        if not mask:
+            # Every nonce passes, skip hashing.
+            found = [uint32(n) or 1 for n in range(nonce + 1, nonce + count + 1)]
+            return found, found[-1]
+        found = []
+        while len(found) < count:
+            nonce = uint32(nonce + 1)
+            h = prefix.copy()
+            h.update(pack('>I', nonce))
+            if nonce and not unpack('>I', sha256(h.digest()).digest()[28:])[0] & mask:
+                found.append(nonce)
+        return found, nonce
+
+    def mining_thread(self):
+        work = None
+        last_rated = last_emitted = monotonic()
+        shares = 0
+        interval = min(max(1.0 / self.share_rate, 0.001), 0.1)
+        while not self.should_stop:
+            if self.work_queue.stale:
+                work = None
+            if (not work) or (not self.work_queue.empty()):
+                try:
+                    work = self.work_queue.get(True, 1)
+                except Empty:
+                    continue
+                if not work:
+                    continue
+                self.jobs += 1
+                # The SHA-256 message up to the nonce, which comes last.
+                message = b''.join(
+                    work.header[i:i + 4][::-1] for i in range(0, 64, 4))
+                prefix = sha256(message + pack(
+                    '>3I', work.merkle_end, work.time, work.difficulty))
+                nonce = 0
+                if self.mode == 'replay':
+                    replay, _ = self.find_nonces(prefix, 0, REPLAY_NONCES)
+                    replay_index = 0
+
+            now = monotonic()
+            if not self.enabled:
+                sleep(1)
+                last_emitted = now
+                continue
+
+            due = min(int((now - last_emitted) * self.share_rate), OUTPUT_SIZE)
+            if due:
+                last_emitted += due / self.share_rate
+                if self.mode == 'replay':
+                    found = [replay[(replay_index + i) % len(replay)]
+                             for i in range(due)]
+                    replay_index = (replay_index + due) % len(replay)
+                else:
+                    found, nonce = self.find_nonces(prefix, nonce, due)
+                nonces = bytearray((OUTPUT_SIZE + 1) * 4)
+                for i, n in enumerate(found):
+                    nonces[i * 4:i * 4 + 4] = uint32_as_bytes(n)
+                nonces[-4:] = uint32_as_bytes(1)
+                self.switch.put(self.result(work, nonces))
+                shares += due
+            else:
+                sleep(interval)
+
+            t = now - last_rated
+            if t > self.options.rate:
+                # Each share stands in for a difficulty 1 share's hashes.
+                self.update_rate(now, shares * 2 ** 32, t, work.targetQ)
+                last_rated = now
+                shares = 0
+
+    def result(self, work, nonces):
+        result = Object()
+        result.header = work.header
+        result.merkle_end = work.merkle_end
+        result.time = work.time
+        result.difficulty = work.difficulty
+        result.target = work.target
+        result.state = tuple(work.state)
+        result.nonces = nonces
+        result.job_id = work.job_id
+        result.extranonce2 = work.extranonce2
+        result.template = work.template
+        result.server = work.server
+        result.miner = self
+        result.received = work.received
+        result.found = monotonic()
+        return result
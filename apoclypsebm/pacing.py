@@ -0,0 +1,108 @@
+"""
+Kernel launch sizing.
+
+A launch should take one frame, 1/frames seconds, from being enqueued to its
+output being read back: longer launches make the desktop lag and delay new
+jobs, shorter ones waste time on launch overhead. LaunchSizer measures every
+launch and steers the launch size with a PID loop on the logarithm of the
+measured over the target frame time, which treats doubling and halving the
+same and settles in a few launches because launch time is close to
+proportional to launch size.
+
+Sizes that have settled are kept per device in a JSON file, so the next run
+starts where this one ended instead of ramping up again.
+"""
+import json
+import os
+from math import exp, log
+from threading import Lock
+
+# Gains of the velocity form PID loop.
+KP = 0.2
+KI = 0.5
+KD = 0.05
+# Most a launch size changes in one step, as a factor.
+MAX_STEP = 2
+# A launch within this factor of the frame time counts as on target, and a
+# size that stayed on target this many launches in a row has settled.
+SETTLED_ERROR = 1.1
+SETTLED_LAUNCHES = 30
+
+
+class LaunchSizer(object):
+    def __init__(self, unit, maximum, frame_time, size=None):
+        self.unit = unit
+        self.maximum = maximum
+        self.frame_time = frame_time
+        self.exact = min(max(size or unit * 10, unit), maximum)
+        self.size = self.rounded()
+        self.errors = (0, 0)
+        self.settled = 0
+
+    def rounded(self):
+        return max(self.unit * int(self.exact // self.unit), self.unit)
+
+    def set_limits(self, unit=None, maximum=None, size=None):
+        self.unit = unit or self.unit
+        self.maximum = maximum or self.maximum
+        self.exact = size or self.exact
+        self.exact = min(max(self.exact, self.unit), self.maximum)
+        self.size = self.rounded()
+        self.settled = 0
+
+    def set_frame_time(self, frame_time):
+        self.frame_time = frame_time
+        self.settled = 0
+
+    def update(self, elapsed):
+        """Takes the time a launch of size took, returns the next size."""
+        error = log(self.frame_time / max(elapsed, 1e-6))
+        e1, e2 = self.errors
+        self.errors = (error, e1)
+        step = KP * (error - e1) + KI * error + KD * (error - 2 * e1 + e2)
+        step = min(max(step, -log(MAX_STEP)), log(MAX_STEP))
+        self.exact = min(max(self.exact * exp(step), self.unit), self.maximum)
+        self.size = self.rounded()
+        if abs(error) < log(SETTLED_ERROR):
+            self.settled += 1
+        else:
+            self.settled = 0
+        return self.size
+
+
+class LaunchSizes(object):
+    """Settled launch sizes by device key, in a JSON file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as sizes:
+                return json.load(sizes)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        with self.lock:
+            return self.load().get(key)
+
+    def set(self, key, size):
+        # Devices in other processes may write too, so merge and replace
+        # the file in one step rather than keep a copy.
+        with self.lock:
+            sizes = self.load()
+            sizes[key] = size
+            temporary = f'{self.path}.{os.getpid()}'
+            with open(temporary, 'w') as out:
+                json.dump(sizes, out, indent=1, sort_keys=True)
+            os.replace(temporary, self.path)
+
+
+stores = {}
+
+
+def launch_sizes(path):
+    """Returns the shared LaunchSizes for path."""
+    return stores.setdefault(path, LaunchSizes(path))
@@ -0,0 +1,303 @@
+"""
+A stratum server handing the upstream stratum session on to other miners.
+
+The upstream pool's extranonce2 space is split: the first PREFIX_SIZE bytes
+of every extranonce2 pick a downstream miner, which gets them appended to
+its extranonce1 and mines the rest of extranonce2 itself. Prefix 0 is kept
+for the local devices. Notifies and difficulty changes are passed on to
+every downstream miner, their shares go upstream under the upstream
+worker's name and the answers come back to them. One connection, and one
+job stream, serves a whole farm.
+
+The server runs on asyncio in its own thread. The upstream StratumSource
+calls in from its asyncore thread, which is handed over with
+call_soon_threadsafe.
+"""
+import asyncio
+from collections import OrderedDict, deque
+from json import dumps, loads
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from apoclypsebm import metrics
+from apoclypsebm.log import say_exception, say_line
+
+# Bytes of extranonce2 that tell downstream miners apart, 65535 of them.
+PREFIX_SIZE = 2
+# Bytes of extranonce2 downstream miners need at least.
+MIN_EXTRANONCE2_SIZE = 2
+# Submits waiting for the upstream answer, older ones are forgotten.
+MAX_PENDING = 10000
+
+
+class Downstream(object):
+    """One connected miner."""
+
+    def __init__(self, proxy, reader, writer):
+        self.proxy = proxy
+        self.reader = reader
+        self.writer = writer
+        peer = writer.get_extra_info('peername') or ('?', 0)
+        self.name = 'proxy:%s:%d' % peer[:2]
+        self.prefix = None
+        self.subscribed = False
+        self.extranonce_subscribed = False
+        self.version_mask = 0
+
+    async def run(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    self.handle(loads(line))
+        except (OSError, ValueError):
+            pass
+        except Exception:
+            say_exception(f'{self.name}:')
+        finally:
+            self.proxy.remove(self)
+            self.writer.close()
+
+    def send(self, message):
+        if not self.writer.is_closing():
+            self.writer.write((dumps(message) + '\n').encode('utf-8'))
+
+    def reply(self, message, result, error=None):
+        if message.get('id') is not None:
+            self.send({'id': message['id'], 'result': result, 'error': error})
+
+    def handle(self, message):
+        method = message.get('method')
+        params = message.get('params') or []
+        if method == 'mining.subscribe':
+            self.subscribe(message)
+        elif method == 'mining.authorize':
+            self.reply(message, True)
+        elif method == 'mining.extranonce.subscribe':
+            self.extranonce_subscribed = True
+            self.reply(message, True)
+        elif method == 'mining.configure':
+            result = {}
+            if params and 'version-rolling' in params[0]:
+                requested = params[1].get('version-rolling.mask', 'ffffffff')
+                self.version_mask = self.proxy.version_mask & int(requested, 16)
+                result['version-rolling'] = bool(self.version_mask)
+                result['version-rolling.mask'] = '%08x' % self.version_mask
+            self.reply(message, result)
+        elif method == 'mining.submit':
+            self.submit(message, params)
+        else:
+            self.reply(message, None, [20, 'Unsupported method', None])
+
+    def subscribe(self, message):
+        if self.prefix is None:
+            self.prefix = self.proxy.allocate()
+        if self.prefix is None or not self.proxy.extranonce1:
+            self.reply(message, None, [20, 'Not connected upstream', None])
+            return
+        self.subscribed = True
+        self.reply(message, [[['mining.set_difficulty', self.name],
+                              ['mining.notify', self.name]],
+                             self.extranonce1(), self.extranonce2_size()])
+        if self.proxy.difficulty is not None:
+            self.send({'id': None, 'method': 'mining.set_difficulty',
+                       'params': [self.proxy.difficulty]})
+        if self.proxy.notify_params:
+            self.send({'id': None, 'method': 'mining.notify',
+                       'params': self.proxy.notify_params})
+
+    def extranonce1(self):
+        return self.proxy.extranonce1 + self.proxy.prefix_hex(self.prefix)
+
+    def extranonce2_size(self):
+        return self.proxy.extranonce2_size - PREFIX_SIZE
+
+    def submit(self, message, params):
+        if not self.subscribed or len(params) < 5:
+            self.reply(message, None, [25, 'Not subscribed', None])
+            return
+        if len(params[2]) != self.extranonce2_size() * 2:
+            self.reply(message, None, [20, 'Wrong extranonce2 size', None])
+            return
+        upstream = [None, params[1], self.proxy.prefix_hex(self.prefix) + params[2],
+                    params[3], params[4]] + params[5:6]
+        if not self.proxy.submit(self, message.get('id'), upstream):
+            self.reply(message, None, [20, 'Not connected upstream', None])
+
+
+class StratumProxy(object):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.server = None
+        self.source = None
+        self.clients = set()
+        self.free_prefixes = deque()
+        self.next_prefix = 1
+        self.pending = OrderedDict()
+        self.pending_lock = Lock()
+        self.submit_id = 0
+
+        self.extranonce1 = None
+        self.extranonce2_size = 0
+        self.version_mask = 0
+        self.difficulty = None
+        self.notify_params = None
+
+        metrics.PROXY_CLIENTS.labels().set_function(lambda: len(self.clients))
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server.sockets[0].getsockname()[:2]
+
+    def start(self):
+        """Starts serving and returns once the server is listening."""
+        self.loop = asyncio.new_event_loop()
+        started = Event()
+
+        async def serve():
+            self.server = await asyncio.start_server(
+                self.accept, self.host, self.port)
+            started.set()
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+        Thread(target=self.loop.run_until_complete, args=(serve(),),
+               name='stratum proxy', daemon=True).start()
+        started.wait()
+        say_line('stratum proxy listening on %s', self.address)
+        return self
+
+    def stop(self):
+        self.call(self.close)
+
+    def close(self):
+        self.server.close()
+        for client in list(self.clients):
+            client.writer.close()
+
+    async def accept(self, reader, writer):
+        client = Downstream(self, reader, writer)
+        self.clients.add(client)
+        await client.run()
+
+    def remove(self, client):
+        self.clients.discard(client)
+        if client.prefix is not None:
+            self.free_prefixes.append(client.prefix)
+            client.prefix = None
+
+    def allocate(self):
+        # Fresh prefixes first, a miner taking over a prefix would start
+        # over on shares its last owner found.
+        if self.next_prefix < 256 ** PREFIX_SIZE:
+            self.next_prefix += 1
+            return self.next_prefix - 1
+        if self.free_prefixes:
+            return self.free_prefixes.popleft()
+        return None
+
+    @staticmethod
+    def prefix_hex(prefix):
+        return '%0*x' % (PREFIX_SIZE * 2, prefix)
+
+    def call(self, callback, *args):
+        """Runs callback on the proxy's loop."""
+        if self.loop:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def broadcast(self, message):
+        for client in list(self.clients):
+            if client.subscribed:
+                client.send(message)
+
+    # Called by the upstream StratumSource from its own thread.
+
+    def upstream_subscribed(self, source, extranonce1, extranonce2_size):
+        """Takes over a new upstream session, returns the extranonce and
+        extranonce2 size left for the local devices, or None if there's not
+        enough extranonce2 to share."""
+        if extranonce2_size - PREFIX_SIZE < MIN_EXTRANONCE2_SIZE:
+            say_line('extranonce2 of %d bytes is too short to share',
+                     extranonce2_size)
+            self.call(self.change_extranonce, source, None, 0)
+            return None
+        self.call(self.change_extranonce, source, extranonce1, extranonce2_size)
+        return (extranonce1 + self.prefix_hex(0),
+                extranonce2_size - PREFIX_SIZE)
+
+    def change_extranonce(self, source, extranonce1, extranonce2_size):
+        self.source = source
+        changed = self.extranonce1 is not None and (
+            extranonce1 != self.extranonce1
+            or extranonce2_size != self.extranonce2_size)
+        self.extranonce1 = extranonce1
+        self.extranonce2_size = extranonce2_size
+        if not changed:
+            return
+        self.notify_params = None
+        for client in list(self.clients):
+            if not client.subscribed:
+                continue
+            if extranonce1 and client.extranonce_subscribed:
+                client.send({'id': None, 'method': 'mining.set_extranonce',
+                             'params': [client.extranonce1(),
+                                        client.extranonce2_size()]})
+            else:
+                # It has to subscribe again to learn its extranonce.
+                client.writer.close()
+
+    def upstream_notify(self, params):
+        self.call(self.notify, params)
+
+    def notify(self, params):
+        self.notify_params = params
+        self.broadcast({'id': None, 'method': 'mining.notify', 'params': params})
+
+    def upstream_difficulty(self, difficulty):
+        self.call(self.set_difficulty, difficulty)
+
+    def set_difficulty(self, difficulty):
+        self.difficulty = difficulty
+        self.broadcast({'id': None, 'method': 'mining.set_difficulty',
+                        'params': [difficulty]})
+
+    def upstream_version_mask(self, mask):
+        self.version_mask = mask
+
+    def upstream_response(self, message):
+        """Passes the answer to a downstream submit back, True if it was
+        one."""
+        with self.pending_lock:
+            pending = self.pending.pop(message.get('id'), None)
+        if pending is None:
+            return False
+        client, client_id, submitted = pending
+        accepted = bool(message.get('result'))
+        metrics.SHARES.labels(client.name, self.source.server().name,
+                              'accepted' if accepted else 'rejected').inc()
+        metrics.SUBMIT_SECONDS.labels(self.source.server().name).observe(
+            monotonic() - submitted)
+        self.call(client.reply, {'id': client_id}, message.get('result'),
+                  message.get('error'))
+        return True
+
+    def submit(self, client, client_id, params):
+        source = self.source
+        if source is None or not source.handler:
+            return False
+        with self.pending_lock:
+            self.submit_id += 1
+            upstream_id = 'p%d' % self.submit_id
+            self.pending[upstream_id] = (client, client_id, monotonic())
+            while len(self.pending) > MAX_PENDING:
+                self.pending.popitem(False)
+        params[0] = source.server().user
+        with source.send_lock:
+            return source.send_message(
+                {'id': upstream_id, 'method': 'mining.submit', 'params': params})
@@ -0,0 +1,64 @@
+"""
+Single producer, single consumer message ring in shared memory.
+
+The ring lives in a multiprocessing RawArray handed to the worker process
+when it is started. Neither side takes a lock: the producer only ever
+advances the tail and the consumer the head, each after its slot has been
+written or read, so a message is never visible before it is complete.
+"""
+from multiprocessing import RawArray
+from pickle import HIGHEST_PROTOCOL, dumps, loads
+from struct import Struct
+
+INDEX = Struct('<Q')
+LENGTH = Struct('<I')
+HEAD, TAIL = 0, 8
+HEADER_SIZE = 16
+
+
+class Ring(object):
+    def __init__(self, slots=64, slot_size=4096):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.buffer = RawArray('B', HEADER_SIZE + slots * slot_size)
+
+    def index(self, offset):
+        return INDEX.unpack_from(self.buffer, offset)[0]
+
+    def empty(self):
+        return self.index(HEAD) == self.index(TAIL)
+
+    def full(self):
+        return self.index(TAIL) - self.index(HEAD) >= self.slots
+
+    def put(self, message):
+        """Returns False instead of blocking when the ring is full."""
+        data = dumps(message, HIGHEST_PROTOCOL)
+        if len(data) > self.slot_size - LENGTH.size:
+            raise ValueError(
+                f'{len(data)} byte message exceeds {self.slot_size} byte slots')
+        tail = self.index(TAIL)
+        if tail - self.index(HEAD) >= self.slots:
+            return False
+        offset = HEADER_SIZE + (tail % self.slots) * self.slot_size
+        LENGTH.pack_into(self.buffer, offset, len(data))
+        start = offset + LENGTH.size
+        memoryview(self.buffer).cast('B')[start:start + len(data)] = data
+        INDEX.pack_into(self.buffer, TAIL, tail + 1)
+        return True
+
+    def get(self):
+        """Returns the oldest message, None when the ring is empty."""
+        head = self.index(HEAD)
+        if head == self.index(TAIL):
+            return None
+        offset = HEADER_SIZE + (head % self.slots) * self.slot_size
+        length = LENGTH.unpack_from(self.buffer, offset)[0]
+        start = offset + LENGTH.size
+        message = loads(memoryview(self.buffer).cast('B')[start:start + length])
+        INDEX.pack_into(self.buffer, HEAD, head + 1)
+        return message
+
+    def reset(self):
+        INDEX.pack_into(self.buffer, HEAD, 0)
+        INDEX.pack_into(self.buffer, TAIL, 0)
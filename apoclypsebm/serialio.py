@@ -0,0 +1,219 @@
+"""
+One thread doing the serial I/O of every device.
+
+A device is written as a generator that yields what it wants done next: a
+Request writes a command and waits for the response, a Sleep waits. The
+generator is sent the response, or None after a timeout or sleep. The
+engine waits on every port at once with a selector and resumes a device as
+soon as its response is complete, so responses are picked up when they
+arrive rather than at the next poll, and more devices don't mean more
+threads.
+"""
+import os
+import selectors
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+import serial
+from serial.serialutil import SerialException
+
+from apoclypsebm.detect import WINDOWS
+from apoclypsebm.log import say_exception, say_line
+
+RESPONSE_TIMEOUT = 1
+REOPEN_DELAY = 1
+# Windows can't select on serial ports or pipes, ports are polled this often
+# instead.
+POLL_INTERVAL = 0.005
+
+
+def open_port(path):
+    return serial.Serial(path, 115200, serial.EIGHTBITS, serial.PARITY_NONE,
+                         serial.STOPBITS_ONE, timeout=0, write_timeout=5)
+
+
+class Request(object):
+    """Writes message and waits up to timeout for a response ending in end."""
+
+    def __init__(self, message, timeout=RESPONSE_TIMEOUT, end=b'\n'):
+        self.message = message
+        self.timeout = timeout
+        self.end = end
+
+
+class Sleep(object):
+    """Waits timeout seconds, or until the port is woken if wake is set."""
+
+    def __init__(self, timeout, wake=False):
+        self.timeout = timeout
+        self.wake = wake
+
+
+class Port(object):
+    """
+    :param session: generator function driving the device, started again
+        with a fresh connection whenever the port fails. The port is closed
+        once it returns.
+    """
+
+    def __init__(self, path, session, name=None):
+        self.path = path
+        self.session = session
+        self.name = name or path
+        self.engine = None
+        self.device = None
+        self.routine = None
+        self.step = None
+        self.deadline = None
+        self.buffer = b''
+        self.woken = False
+
+    def wake(self):
+        """Ends a Sleep(wake=True) early, safe to call from any thread."""
+        if self.engine:
+            self.engine.wake(self)
+
+
+class SerialEngine(object):
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.ports = []
+        self.lock = Lock()
+        self.added = []
+        self.woken = False
+        self.thread = None
+        if not WINDOWS:
+            self.wake_in, self.wake_out = os.pipe()
+            os.set_blocking(self.wake_in, False)
+            self.selector.register(self.wake_in, selectors.EVENT_READ)
+
+    def add(self, port):
+        with self.lock:
+            port.engine = self
+            port.deadline = monotonic()
+            self.added.append(port)
+            if not self.thread:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.interrupt()
+
+    def wake(self, port):
+        port.woken = True
+        with self.lock:
+            if self.woken:
+                return
+            self.woken = True
+        self.interrupt()
+
+    def interrupt(self):
+        if not WINDOWS:
+            os.write(self.wake_out, b'\0')
+
+    def run(self):
+        while True:
+            try:
+                self.iterate()
+            except Exception:
+                say_exception('serial engine error:')
+
+    def iterate(self):
+        with self.lock:
+            self.ports.extend(self.added)
+            self.added = []
+            self.woken = False
+
+        now = monotonic()
+        deadlines = [port.deadline for port in self.ports
+                     if port.deadline is not None]
+        timeout = max(min(deadlines) - now, 0) if deadlines else None
+        if WINDOWS:
+            sleep(POLL_INTERVAL if timeout is None else min(timeout, POLL_INTERVAL))
+            ready = [port for port in self.ports
+                     if port.device and port.device.in_waiting]
+        else:
+            ready = []
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        os.read(self.wake_in, 4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    ready.append(key.data)
+        for port in ready:
+            self.read(port)
+
+        now = monotonic()
+        for port in list(self.ports):
+            if port.woken:
+                port.woken = False
+                if isinstance(port.step, Sleep) and port.step.wake:
+                    self.resume(port, None)
+            if port.deadline is not None and now >= port.deadline:
+                if port.routine is None:
+                    self.open(port)
+                else:
+                    self.resume(port, None)
+
+    def open(self, port):
+        try:
+            port.device = open_port(port.path)
+            if not WINDOWS:
+                self.selector.register(port.device.fileno(),
+                                       selectors.EVENT_READ, port)
+        except (OSError, SerialException):
+            say_exception(f'{port.name}: failed to open {port.path}:')
+            self.fail(port)
+            return
+        port.routine = port.session()
+        self.resume(port, None)
+
+    def read(self, port):
+        try:
+            data = port.device.read(port.device.in_waiting or 1)
+        except (OSError, SerialException):
+            say_exception(f'{port.name}: read failed:')
+            self.fail(port)
+            return
+        port.buffer += data
+        if isinstance(port.step, Request) and port.buffer.endswith(port.step.end):
+            response, port.buffer = port.buffer, b''
+            self.resume(port, response)
+
+    def resume(self, port, response):
+        try:
+            step = port.routine.send(response)
+            port.step = step
+            port.deadline = monotonic() + step.timeout
+            if isinstance(step, Request):
+                port.buffer = b''
+                port.device.reset_input_buffer()
+                port.device.write(step.message)
+        except StopIteration:
+            self.close(port)
+            self.ports.remove(port)
+        except Exception:
+            say_exception(f'{port.name}:')
+            self.fail(port)
+
+    def fail(self, port):
+        """Drops the connection and reopens it after REOPEN_DELAY."""
+        if port.routine:
+            port.routine.close()
+        self.close(port)
+        say_line('%s: reopening %s in %ds', (port.name, port.path, REOPEN_DELAY))
+        port.deadline = monotonic() + REOPEN_DELAY
+
+    def close(self, port):
+        if port.device:
+            if not WINDOWS:
+                try:
+                    self.selector.unregister(port.device.fileno())
+                except (KeyError, ValueError):
+                    pass
+            port.device.close()
+        port.device = port.routine = port.step = None
+        port.deadline = None
+
+
+ENGINE = SerialEngine()
@@ -2,13 +2,14 @@ from binascii import hexlify, unhexlify
 from copy import copy
 from struct import pack, unpack
 from threading import RLock
-from time import sleep, time
+from time import monotonic, perf_counter, sleep, time
 
 import socks
 
-from apoclypsebm import log
+from apoclypsebm import log, metrics
 from apoclypsebm.log import say_exception, say_line, say_quiet
-from apoclypsebm.sha256 import STATE, hash, sha256
+from apoclypsebm.sha256 import hash
+from apoclypsebm.trace import ShareTrace, Tracer
 from apoclypsebm.util import Object, belowOrEquals, bytereverse, chunks, uint32
 from apoclypsebm.work_sources import stratum
 
@@ -27,7 +28,9 @@ class Switch(object):
         self.errors = 0
         self.failback_attempt_count = 0
         self.server_index = -1
+        self.requested_server_index = None
         self.last_server = None
+        self.started = monotonic()
         self.server_map = {}
 
         self.user_agent = 'apoclypsebm/' + options.version
@@ -35,8 +38,13 @@ class Switch(object):
         self.difficulty = 0
         self.true_target = None
         self.last_block = ''
+        # When the current block's first job arrived, until a hash is found.
+        self.block_received = None
 
         self.sent = {}
+        self.tracer = Tracer(options.trace_file, options.trace_sample)
+        # Serves the stratum session to other miners if set.
+        self.stratum_proxy = None
 
         if self.options.proxy:
             self.options.proxy = self.parse_server(self.options.proxy, False)
@@ -106,6 +114,8 @@ class Switch(object):
     def add_miner(self, miner):
         self.miners.append(miner)
         miner.switch = self
+        metrics.WORK_QUEUE_DEPTH.labels(miner.id()).set_function(
+            miner.work_queue.qsize)
 
     def updatable_miner(self):
         for miner in self.miners:
@@ -124,6 +134,18 @@ class Switch(object):
 
             sleep(1)
 
+            if self.requested_server_index is not None:
+                # Requested servers get top priority so that failback
+                # doesn't leave them again.
+                self.servers.insert(
+                    0, self.servers.pop(self.requested_server_index))
+                self.requested_server_index = None
+                self.errors = 0
+                self.backup_server_index = 1
+                self.last_server = None
+                self.set_server_index(0)
+                continue
+
             if failback:
                 say_line("Attempting to fail back to primary server")
                 self.last_server = self.server_index
@@ -155,6 +177,14 @@ class Switch(object):
                     self.backup_server_index += 1
                 self.set_server_index(new_server_index)
 
+    def switch_server(self, server_index):
+        """Asks the loop to move to servers[server_index] from any thread."""
+        if not 0 <= server_index < len(self.servers):
+            raise IndexError(server_index)
+        self.requested_server_index = server_index
+        if self.server_index != -1:
+            self.server_source().stop()
+
     def connection_ok(self):
         self.errors = 0
         if self.server_index == 0:
@@ -165,22 +195,25 @@ class Switch(object):
         self.should_stop = True
         if self.server_index != -1:
             self.server_source().stop()
+        self.tracer.close()
 
     # callers must provide hex encoded block header and target
     def decode(self, server, block_header, target, job_id=None,
-               extranonce2=None):
+               extranonce2=None, received=None):
         if block_header:
             job = Object()
+            job.received = received or monotonic()
 
             binary_data = unhexlify(block_header)
-            data0 = list(unpack('<16I', binary_data[:64])) + ([0] * 48)
 
             job.target = unpack('<8I', unhexlify(target))
             job.header = binary_data[:68]
             job.merkle_end = uint32(unpack('<I', binary_data[64:68])[0])
             job.time = uint32(unpack('<I', binary_data[68:72])[0])
             job.difficulty = uint32(unpack('<I', binary_data[72:76])[0])
-            job.state = sha256(STATE, data0)
+            # The midstate is left to JobMailbox.get, most jobs are
+            # superseded before a miner takes them.
+            job.state = None
             job.targetQ = 2 ** 256 // int(''.join(list(chunks(target, 2))[::-1]),
                                          16)
             job.job_id = job_id
@@ -201,24 +234,55 @@ class Switch(object):
         self.true_target = unpack('<8I', unhexlify(true_target))
 
     def send(self, result, send_callback):
-        for nonce in result.miner.nonce_generator(result.nonces):
-            h = hash(result.state, result.merkle_end, result.time,
-                     result.difficulty, nonce)
-            if h[7] != 0:
-                hash6 = hexlify(pack('<I', int(h[6])))
-                say_line('Verification failed, check hardware! (%s, %s)',
-                         (result.miner.id(), hash6))
-                return True  # consume this particular result
-            else:
-                self.diff1_found(bytereverse(h[6]), result.target[6])
-                if belowOrEquals(h[:7], result.target[:7]):
-                    is_block = belowOrEquals(h[:7], self.true_target[:7])
+        device = result.miner.id()
+        pool = self.server().name
+        verification_time = 0
+        started = perf_counter()
+        try:
+            for nonce in result.miner.nonce_generator(result.nonces):
+                h = hash(result.state, result.merkle_end, result.time,
+                         result.difficulty, nonce)
+                if h[7] & result.miner.verify_mask:
                     hash6 = hexlify(pack('<I', int(h[6])))
-                    hash5 = hexlify(pack('<I', int(h[5])))
-                    self.sent[nonce] = (is_block, hash6, hash5)
-                    if not send_callback(result, nonce):
-                        return False
-        return True
+                    say_line('Verification failed, check hardware! (%s, %s)',
+                             (device, hash6))
+                    metrics.HARDWARE_ERRORS.labels(device).inc()
+                    return True  # consume this particular result
+                else:
+                    if self.block_received is not None:
+                        self.block_restarted(result, pool)
+                    self.diff1_found(bytereverse(h[6]), result.target[6])
+                    if belowOrEquals(h[:7], result.target[:7]):
+                        is_block = not h[7] and belowOrEquals(
+                            h[:7], self.true_target[:7])
+                        hash6 = hexlify(pack('<I', int(h[6])))
+                        hash5 = hexlify(pack('<I', int(h[5])))
+                        trace = ShareTrace(result, nonce, pool)
+                        self.sent[nonce] = (is_block, hash6, hash5, trace)
+                        metrics.SHARES.labels(device, pool, 'found').inc()
+                        # Submission time is measured by the source.
+                        verification_time += perf_counter() - started
+                        trace.submitted = monotonic()
+                        submitted = send_callback(result, nonce)
+                        started = perf_counter()
+                        if not submitted:
+                            return False
+            return True
+        finally:
+            verification_time += perf_counter() - started
+            metrics.VERIFICATION_SECONDS.labels(device).observe(
+                verification_time)
+
+    def block_restarted(self, result, pool):
+        received = self.block_received
+        if received is None or result.header[25:29] != self.last_block:
+            return
+        self.block_received = None
+        found = getattr(result, 'found', None) or monotonic()
+        self.tracer.block_restarted(pool, found - received)
+        if self.options.verbose:
+            say_line('first hash on the new block after %.1f ms',
+                     (found - received) * 1000)
 
     def diff1_found(self, hash_, target):
         if self.options.verbose and target < 0xFFFF0000:
@@ -240,13 +304,16 @@ class Switch(object):
         float(rejected_shares) * 100 / total_shares_estimator))
 
     def report(self, miner, nonce, accepted):
-        is_block, hash6, hash5 = self.sent[nonce]
+        is_block, hash6, hash5, trace = self.sent[nonce]
+        self.tracer.record(trace, 'accepted' if accepted else 'rejected')
         miner.share_count[1 if accepted else 0] += 1
+        metrics.SHARES.labels(miner.id(), self.server().name,
+                              'accepted' if accepted else 'rejected').inc()
         hash_ = hash6 + hash5 if is_block else hash6
         if self.options.verbose or is_block:
             say_line('%s %s%s, %s', (
             miner.id(), 'block ' if is_block else '', hash_,
-            'accepted' if accepted else '_rejected_'))
+            'accepted' if accepted else '_rejected_'), limit=not is_block)
         del self.sent[nonce]
 
     def set_server_index(self, server_index):
@@ -274,25 +341,39 @@ class Switch(object):
         return False
 
     def queue_work(self, server, block_header, target=None, job_id=None,
-                   extranonce2=None, miner=None, transactions=None):
-        work = self.decode(server, block_header, target, job_id, extranonce2)
-        work.transactions = transactions
+                   extranonce2=None, miner=None, template=None,
+                   received=None):
+        work = self.decode(server, block_header, target, job_id, extranonce2,
+                           received)
+        work.template = template
         with self.lock:
             if not miner:
                 miner = self.miners[0]
                 for i in range(1, len(self.miners)):
                     self.miners[i].update = True
+            if work and self.last_block != work.header[25:29]:
+                self.last_block = work.header[25:29]
+                self.block_received = work.received
+                # Everything queued or running is for the old block now.
+                for m in self.miners:
+                    m.restart()
+                self.clear_result_queue(server)
             miner.work_queue.put(work)
             if work:
                 miner.update = False;
                 self.last_work = time()
-                if self.last_block != work.header[25:29]:
-                    self.last_block = work.header[25:29]
-                    self.clear_result_queue(server)
 
     def clear_result_queue(self, server):
         while not server.result_queue.empty():
-            server.result_queue.get(False)
+            result = server.result_queue.get(False)
+            metrics.SHARES.labels(result.miner.id(), self.server().name,
+                                  'stale').inc()
+
+    def share_stale(self, miner, nonce):
+        metrics.SHARES.labels(miner.id(), self.server().name, 'stale').inc()
+        sent = self.sent.pop(nonce, None)
+        if sent:
+            self.tracer.record(sent[3], 'stale')
 
     def server_source(self):
         if not hasattr(self.server(), 'source'):
@@ -338,4 +419,11 @@ class Switch(object):
         return self.servers[self.server_index]
 
     def put(self, result):
+        if result.header[25:29] != self.last_block:
+            # Found on a previous block after a restart.
+            metrics.SHARES.labels(result.miner.id(), self.server().name,
+                                  'stale').inc()
+            return
+        result.queued = monotonic()
         result.server.result_queue.put(result)
+        result.server.wake.set()
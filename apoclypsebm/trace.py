@@ -0,0 +1,102 @@
+"""
+Share lifecycle tracing.
+
+Results carry monotonic timestamps from the moment their job was received
+through kernel readback, the source's result queue and verification. Each
+share found in a result gets a ShareTrace that is completed when the pool
+answers (or the share turns out stale), at which point the time between
+every pair of consecutive stages is recorded per device and pool.
+"""
+from json import dumps
+from random import random
+from threading import Lock
+from time import monotonic, time
+
+from apoclypsebm import metrics
+
+# (stage name, start timestamp, end timestamp)
+STAGES = (
+    ('job', 'received', 'found'),
+    ('readback', 'found', 'queued'),
+    ('result_queue', 'queued', 'dequeued'),
+    ('verify', 'dequeued', 'verified'),
+    ('send', 'verified', 'submitted'),
+    ('acknowledge', 'submitted', 'acknowledged'),
+    ('total', 'found', 'acknowledged'),
+)
+
+TIMESTAMPS = ('received', 'found', 'queued', 'dequeued', 'verified',
+              'submitted', 'acknowledged')
+
+SHARE_STAGE_SECONDS = metrics.REGISTRY.histogram(
+    'apoclypse_share_stage_seconds',
+    'Time shares spend between consecutive lifecycle stages.',
+    ('stage', 'device', 'pool'),
+    buckets=metrics.LATENCY_BUCKETS + (30, 60, 120, 300)
+)
+
+
+class ShareTrace(object):
+    __slots__ = ('device', 'pool', 'nonce', 'outcome') + TIMESTAMPS
+
+    def __init__(self, result, nonce, pool):
+        self.device = result.miner.id()
+        self.pool = pool
+        self.nonce = nonce
+        self.outcome = None
+        self.received = getattr(result, 'received', None)
+        self.found = getattr(result, 'found', None)
+        self.queued = getattr(result, 'queued', None)
+        self.dequeued = getattr(result, 'dequeued', None)
+        self.verified = monotonic()
+        self.submitted = self.acknowledged = None
+
+    def latencies(self):
+        for stage, start, end in STAGES:
+            start, end = getattr(self, start), getattr(self, end)
+            if start is not None and end is not None:
+                yield stage, end - start
+
+
+class Tracer(object):
+    def __init__(self, path=None, sample_rate=1.0):
+        self.sample_rate = sample_rate
+        self.file = open(path, 'a', buffering=1) if path else None
+        self.file_lock = Lock()
+
+    def record(self, trace, outcome):
+        trace.outcome = outcome
+        if outcome != 'stale':
+            trace.acknowledged = monotonic()
+        for stage, latency in trace.latencies():
+            SHARE_STAGE_SECONDS.labels(
+                stage, trace.device, trace.pool).observe(latency)
+
+        if self.file and random() < self.sample_rate:
+            self.write(trace)
+
+    def block_restarted(self, pool, seconds):
+        metrics.BLOCK_RESTART_SECONDS.labels(pool).observe(seconds)
+
+    def write(self, trace):
+        origin = trace.found or trace.verified
+        record = {
+            'time': time(),
+            'device': trace.device,
+            'pool': trace.pool,
+            'nonce': '%08x' % trace.nonce,
+            'outcome': trace.outcome,
+            # Milliseconds relative to the kernel readback.
+            'stages': {
+                name: round((getattr(trace, name) - origin) * 1000, 3)
+                for name in TIMESTAMPS
+                if getattr(trace, name) is not None
+            }
+        }
+        with self.file_lock:
+            self.file.write(dumps(record) + '\n')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
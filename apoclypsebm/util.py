@@ -44,6 +44,9 @@ def chunks(l, n):
 
 
 def tokenize(option, name, default=[0], cast=int):
+    if isinstance(option, (list, tuple)):
+        # Already tokenized, e.g. options handed to a worker process.
+        return option or default
     if option:
         try:
             return [cast(x) for x in option.split(',')]
@@ -1,12 +1,19 @@
 from queue import Queue
+from threading import Event
 from time import monotonic
 
+from apoclypsebm import metrics
+
 
 class Source(object):
     def __init__(self, switch):
         self.switch = switch
         self.result_queue = Queue()
+        # Set when the loop has something to do, such as a result queued.
+        self.wake = Event()
         self.options = switch.options
+        metrics.RESULT_QUEUE_DEPTH.labels(self.server().name).set_function(
+            self.result_queue.qsize)
 
     def server(self):
         return self.switch.server()
@@ -23,6 +30,7 @@ class Source(object):
     def process_result_queue(self):
         while not self.result_queue.empty():
             result = self.result_queue.get(False)
+            result.dequeued = monotonic()
             with self.switch.lock:
                 if not self.switch.send(result, self.send_internal):
                     self.result_queue.put(result)
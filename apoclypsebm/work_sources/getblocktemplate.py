@@ -2,21 +2,30 @@ import http.client
 import socket
 from base64 import b64encode
 from binascii import hexlify, unhexlify
+from collections import OrderedDict
 from json import dumps, loads
 from struct import pack
-from threading import Event, Thread
+from threading import Event, Lock, RLock, Thread
 from time import monotonic, sleep
 from urllib.parse import urlsplit
+from weakref import WeakValueDictionary, finalize
 
 import socks
 
+from apoclypsebm import metrics, zmtp
 from apoclypsebm.bitcoin import tx_make_generation, tx_merkle_root, var_int
 from apoclypsebm.log import say_exception, say_line
-from apoclypsebm.util import chunks
+from apoclypsebm.util import Object, chunks
 from apoclypsebm.work_sources.base import Source
 
 gbt_count = 0
 
+# Previous blocks the race remembers, so that templates on them are known
+# to be late.
+BLOCK_HISTORY = 16
+# Seconds a raced node is left alone after failing to answer.
+NODE_RETRY_DELAY = 1
+
 
 class NotAuthorized(Exception):
     pass
@@ -26,6 +35,121 @@ class RPCError(Exception):
     pass
 
 
+class TemplateStore(object):
+    """
+    The transactions of the templates jobs are built on, each converted once
+    into one bytes blob of raw transactions, which is only hex encoded again
+    for the rare block found. Templates with the same transactions share the
+    blob. Jobs and results hold their template, which is freed with the last
+    of them, so memory follows the work in flight rather than the number of
+    templates fetched.
+    """
+
+    def __init__(self):
+        self.shared = WeakValueDictionary()
+        # Templates using each blob and its size, by the blob's id.
+        self.blobs = {}
+        self.size = 0
+        # Templates are released from whichever thread drops the last job.
+        self.lock = RLock()
+
+    def add(self, coinbase_tx, transactions, coinbase_only=False, node=None):
+        """Stores the coinbase and the template's transactions, returns the
+        template for jobs to hold.
+
+        :param coinbase_only: the node takes blocks of just the header and
+            coinbase (BIP 23 submit/coinbase), so that is all that's sent
+        :param node: the source the template came from
+        """
+        # Witness txids commit to all of the transaction data.
+        txids = tuple(tx.get('hash') or tx.get('txid') for tx in transactions)
+        if None in txids:
+            txids = None
+        with self.lock:
+            shared = self.shared.get(txids) if txids else None
+        template = Object()
+        template.node = node
+        template.coinbase = coinbase_tx
+        template.coinbase_only = coinbase_only
+        template.count = len(transactions)
+        if shared is not None:
+            template.blob = shared.blob
+        else:
+            template.blob = unhexlify(''.join(tx['data'] for tx in transactions))
+        blob_id = id(template.blob)
+        with self.lock:
+            if txids:
+                self.shared[txids] = template
+            users = self.blobs.get(blob_id)
+            if users:
+                users[0] += 1
+            else:
+                self.blobs[blob_id] = [1, len(template.blob)]
+                self.resize(len(template.blob))
+        finalize(template, self.release, blob_id)
+        return template
+
+    def release(self, blob_id):
+        with self.lock:
+            users = self.blobs[blob_id]
+            users[0] -= 1
+            if not users[0]:
+                del self.blobs[blob_id]
+                self.resize(-users[1])
+
+    def resize(self, change):
+        self.size += change
+        metrics.TEMPLATE_STORE_BYTES.labels().set(self.size)
+
+    def submission(self, template, header, node=None):
+        """The block of header and the template's transactions as pieces of
+        ASCII hex for node. Only the node the template came from can take
+        just the coinbase."""
+        pieces = [header, var_int(template.count + 1), template.coinbase]
+        if not template.coinbase_only or node is not template.node:
+            pieces.append(template.blob)
+        return [piece.hex().encode('ascii') for piece in pieces]
+
+
+class BlockRace(object):
+    """When each node first served a template on each new block, and which
+    source was first with the latest one."""
+
+    def __init__(self, size=BLOCK_HISTORY):
+        self.size = size
+        self.blocks = OrderedDict()
+        self.latest = None
+        self.leader = None
+        self.lock = Lock()
+
+    def superseded(self, prevhash):
+        """Whether some node has already served a block after prevhash."""
+        with self.lock:
+            return prevhash in self.blocks and prevhash != self.latest
+
+    def arrived(self, node, prevhash, source=None):
+        """Records node serving a template on prevhash, True if it is the
+        first node to."""
+        now = monotonic()
+        with self.lock:
+            block = self.blocks.get(prevhash)
+            if block is None:
+                block = self.blocks[prevhash] = (now, set())
+                self.latest = prevhash
+                self.leader = source
+                while len(self.blocks) > self.size:
+                    self.blocks.popitem(False)
+            first, nodes = block
+            if node in nodes:
+                return False
+            nodes.add(node)
+        metrics.TEMPLATE_LAG_SECONDS.labels(node).observe(now - first)
+        return len(nodes) == 1
+
+
+TEMPLATES = TemplateStore()
+
+
 class GetblocktemplateSource(Source):
     def __init__(self, switch):
         super().__init__(switch)
@@ -39,23 +163,47 @@ class GetblocktemplateSource(Source):
                             b'%b:%b' % (self.server().user_bytes, self.server().pwd_bytes)).decode('ascii'),
                         'X-Mining-Extensions': 'hostlist midstate rollntime'}
         self.long_poll_url = ''
+        self.long_poll_id = None
 
         self.long_poll_active = False
         self.long_poll_last_host = None
 
         self.authorization_failed = False
 
+        self.subscriber = None
+        self.block_notified = Event()
+        self.notified = None
+
+        self.race = BlockRace() if self.options.race_nodes else None
+        self.nodes = []
+
     def loop(self):
         if self.authorization_failed:
             return
         super().loop()
         long_poll_id_available = Event()
+        if self.long_poll_id:
+            # From the template detect_stratum queued.
+            long_poll_id_available.set()
         thread = Thread(
             target=self.long_poll_thread,
             args=(long_poll_id_available,),
             daemon=True
         )
         thread.start()
+        if self.options.block_notify:
+            self.subscriber = zmtp.Subscriber(
+                self.options.block_notify, (b'hashblock',),
+                self.block_notification).start()
+        self.nodes = []
+        for url in self.options.race_nodes:
+            try:
+                node = RaceNode(self, self.switch.parse_server(url))
+            except ValueError:
+                say_line('Ignored invalid node entry: %s', url)
+                continue
+            self.nodes.append(node)
+            node.start()
 
         while True:
             if self.should_stop:
@@ -70,7 +218,8 @@ class GetblocktemplateSource(Source):
                     while miner:
                         template = self.getblocktemplate()
                         if template:
-                            work = self.work_from_template(template)
+                            work = (self.work_from_template(template)
+                                    or self.leader_work())
                             self.queue_work(work, miner)
                             miner = self.switch.updatable_miner()
 
@@ -82,11 +231,38 @@ class GetblocktemplateSource(Source):
 
 
                 self.process_result_queue()
-                sleep(1)
+                if self.block_notified.wait(1):
+                    self.block_notified.clear()
+                    self.new_block_work()
             except Exception:
                 say_exception("Unexpected error:")
+                # The next loop starts its own nodes and subscriber.
+                self.stop()
                 break
 
+    def leader_work(self):
+        """Work from the node that was first with the current block, for
+        while this one still serves an earlier block."""
+        leader = self.race and self.race.leader
+        if leader and leader is not self:
+            return leader.work_from_template(leader.getblocktemplate())
+
+    def block_notification(self, message):
+        self.notified = monotonic()
+        self.block_notified.set()
+        if self.options.verbose and len(message) > 1:
+            say_line('block notification: %s', message[1].hex())
+
+    def new_block_work(self):
+        """Fetches a template for the block just notified and has every
+        miner switch to it."""
+        notified = self.notified
+        template = self.getblocktemplate()
+        if template:
+            self.queue_work(self.work_from_template(template))
+            metrics.BLOCK_NOTIFY_SECONDS.labels(self.server().name).observe(
+                monotonic() - notified)
+
     def ensure_connected(self, connection, proto, host):
         if connection != None and connection.sock != None:
             return connection, False
@@ -169,7 +345,7 @@ class GetblocktemplateSource(Source):
     def getblocktemplate(self, long_poll_id=None, timeout=None):
         param = {
             'capabilities': ('longpoll', 'coinbasetxn',
-                             'coinbasevalue', 'workid'),
+                             'coinbasevalue', 'workid', 'submit/coinbase'),
             'rules': ('segwit',)
         }
 
@@ -210,8 +386,12 @@ class GetblocktemplateSource(Source):
                 'id': 'json',
                 'params': (param,)
             }
+            started = monotonic()
             connection, result = self.request(connection, url, self.headers,
                                               dumps(postdata), timeout=timeout or 0)
+            if not long_poll_id:
+                metrics.WORK_FETCH_SECONDS.labels(self.server().name).observe(
+                    monotonic() - started)
             self.switch.connection_ok()
 
             return result['result']
@@ -228,25 +408,32 @@ class GetblocktemplateSource(Source):
         except Exception:
             say_exception()
 
-    def submitblock(self, block_data, work_id=None):
+    def submitblock(self, block_hex, work_id=None, own_connection=False):
+        """Submits the block in block_hex, a list of pieces of ASCII hex
+        which are sent one after the other rather than joined first. With
+        own_connection it goes on a new connection, closed once done."""
         try:
-            self.connection = \
-                self.ensure_connected(self.connection, self.server().proto,
-                                      self.server().host)[0]
-            if work_id:
-                params = (block_data, {'workid': work_id})
+            connection = self.ensure_connected(
+                None if own_connection else self.connection,
+                self.server().proto, self.server().host)[0]
+            if not own_connection:
+                self.connection = connection
+            options = ', ' + dumps({'workid': work_id}) if work_id else ''
+            body = ([b'{"method": "submitblock", "id": "json", "params": ["']
+                    + block_hex + [('"%s]}' % options).encode('ascii')])
+            headers = dict(self.headers)
+            headers['Content-Length'] = str(sum(len(piece) for piece in body))
+
+            started = monotonic()
+            (connection, result) = self.request(connection, '/', headers,
+                                                body)
+            if own_connection:
+                if connection:
+                    connection.close()
             else:
-                params = (block_data,)
-
-            postdata = {
-                'method': 'submitblock',
-                'id': 'json',
-                'params': params
-            }
-
-            (self.connection, result) = self.request(self.connection, '/',
-                                                     self.headers,
-                                                     dumps(postdata))
+                self.connection = connection
+            metrics.SUBMIT_SECONDS.labels(self.server().name).observe(
+                monotonic() - started)
 
             self.switch.connection_ok()
 
@@ -257,6 +444,7 @@ class GetblocktemplateSource(Source):
             self.stop()
         except Exception:
             say_exception()
+        return False
 
     def proposeblock(self, block_data, work_id=None):
         try:
@@ -306,25 +494,40 @@ class GetblocktemplateSource(Source):
 
     def block_hex_from_result(self, result, nonce):
         header = self.submittable_block_header(result, nonce)
+        return TEMPLATES.submission(result.template, header, self)
 
-        txes = result.transactions
-        block_hex = ''.join(
-            [header.hex(), var_int(len(txes)).hex()] +
-            [tx['data'] for tx in txes]
-        )
-        return block_hex
-
-    def send_internal(self, result, nonce):
+    def submit_result(self, result, nonce):
+        """Submits the block of result to this source's node, with the
+        workid only if the template came from it."""
         data = self.block_hex_from_result(result, nonce)
+        work_id = result.job_id if result.template.node is self else None
 
         # If want to debug the blocks that would otherwise be submitted:
-        #reject_reason = self.proposeblock(data, result.job_id)
+        #return self.proposeblock(b''.join(data).decode('ascii'), work_id)
 
-        reject_reason = self.submitblock(data, result.job_id)
+        return self.submitblock(data, work_id)
 
-        if reject_reason is None:
-            self.switch.report(result.miner, nonce, reject_reason is None)
-            return True
+    def send_internal(self, result, nonce):
+        for node in self.nodes:
+            Thread(target=node.send_block, args=(result, nonce),
+                   daemon=True).start()
+        reject_reason = self.submit_result(result, nonce)
+        if reject_reason is False:
+            # Not submitted, the result is retried after reconnecting.
+            return False
+        found = getattr(result, 'found', None)
+        if found:
+            seconds = monotonic() - found
+            metrics.BLOCK_SUBMIT_SECONDS.labels(self.server().name).observe(
+                seconds)
+            if self.options.verbose:
+                say_line('block submitted %.1f ms after it was found',
+                         seconds * 1000)
+
+        if reject_reason:
+            say_line('block rejected: %s', reject_reason, limit=False)
+        self.switch.report(result.miner, nonce, reject_reason is None)
+        return True
 
     def long_poll_thread(self, long_poll_id_available):
         long_poll_id_available.wait()
@@ -356,6 +559,11 @@ class GetblocktemplateSource(Source):
 
     def stop(self):
         self.should_stop = True
+        for node in self.nodes:
+            node.close()
+        if self.subscriber:
+            self.subscriber.stop()
+            self.subscriber = None
         self.close_lp_connection()
         self.close_connection()
 
@@ -440,17 +648,29 @@ class GetblocktemplateSource(Source):
     def work_from_template(self, template):
         if not template:
             return None
+        if self.race and self.race.superseded(template['previousblockhash']):
+            # Miners are on a later block already.
+            return None
         workable_header, coinbase_tx = self.workable_block_header(template)
         work = {
             'data': hexlify(workable_header),
-            'target': template['target'],
+            # Templates have big-endian targets, work uses little-endian.
+            'target': unhexlify(template['target'])[::-1].hex(),
         }
         if 'workid' in template:
             work['job_id'] = template['workid']
-        work['transactions'] = [{'data': coinbase_tx.hex()}] + template['transactions']
+        work['template'] = TEMPLATES.add(
+            coinbase_tx, template['transactions'],
+            'submit/coinbase' in template.get('mutable', ()), self)
+        if self.race:
+            work['new_block'] = self.race.arrived(
+                self.server().name, template['previousblockhash'], self)
         return work
 
     def queue_work(self, work, miner=None):
+        if work and miner is None and work.get('new_block') is False:
+            # Another node was first with the block, the miners have it.
+            return
         if work:
             if not 'target' in work:
                 work['target'] = ('000000000000'
@@ -463,7 +683,7 @@ class GetblocktemplateSource(Source):
             self.switch.queue_work(self, block_header=work['data'],
                                    target=work['target'],
                                    job_id=work.get('job_id'),
-                                   miner=miner, transactions=work['transactions'])
+                                   miner=miner, template=work['template'])
 
     def detect_stratum(self):
         template = self.getblocktemplate()
@@ -484,7 +704,91 @@ class GetblocktemplateSource(Source):
                 say_line('using getblocktemplate JSON-RPC (no stratum header)')
                 work = self.work_from_template(template)
                 self.queue_work(work)
+                if 'longpollid' in template:
+                    self.long_poll_id = template['longpollid']
+                    self.long_poll_url = template.get('longpolluri', '')
                 return False
 
         say_line('no response to getblocktemplate, using as stratum')
         return self.server().host
+
+
+class RaceNode(GetblocktemplateSource):
+    """
+    Another node raced against the source's own for templates. Its long
+    polls only hand work to the switch when they are first with a new
+    previous block, and found blocks are submitted to it as well.
+    """
+
+    def __init__(self, source, server):
+        self.node = server
+        super().__init__(source.switch)
+        self.source = source
+        self.race = source.race
+        self.closed = False
+        # The source fetches templates from it for its miners while it
+        # leads.
+        self.lock = Lock()
+
+    @property
+    def should_stop(self):
+        return self.closed or self.source.should_stop
+
+    def server(self):
+        return self.node
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        # Only drops the connections, a failing node is tried again.
+        self.close_lp_connection()
+        self.close_connection()
+
+    def close(self):
+        """Stops racing the node for good."""
+        self.closed = True
+        self.stop()
+
+    def run(self):
+        while not self.should_stop and not self.authorization_failed:
+            template = self.getblocktemplate()
+            if template:
+                self.queue_work(self.work_from_template(template))
+                if 'longpollid' in template:
+                    self.long_poll_id = template['longpollid']
+                    self.long_poll_url = template.get('longpolluri', '')
+                    available = Event()
+                    available.set()
+                    self.long_poll_thread(available)
+                    return
+            sleep(NODE_RETRY_DELAY)
+
+    def getblocktemplate(self, long_poll_id=None, timeout=None):
+        if long_poll_id:
+            template = super().getblocktemplate(long_poll_id, timeout)
+        else:
+            with self.lock:
+                template = super().getblocktemplate()
+        if template is None and not self.should_stop:
+            sleep(NODE_RETRY_DELAY)
+        return template
+
+    def submitblock(self, block_hex, work_id=None, own_connection=True):
+        # The source closes its nodes when it stops, as it does when its
+        # own node is down, which mustn't cut off a block on its way.
+        return super().submitblock(block_hex, work_id, own_connection)
+
+    def queue_work(self, work, miner=None):
+        if work and work.get('new_block'):
+            if self.options.verbose:
+                say_line('%s was first with block %s%s', (
+                    self.server().name, work['data'][56:64].decode('ascii'),
+                    work['data'][48:56].decode('ascii')))
+            self.source.queue_work(work)
+
+    def send_block(self, result, nonce):
+        reject_reason = self.submit_result(result, nonce)
+        if reject_reason:
+            say_line('%s rejected block: %s',
+                     (self.server().name, reject_reason), limit=False)
@@ -1,7 +1,6 @@
 import http
 import socket
 from base64 import b64encode
-from binascii import hexlify
 from json import dumps, loads
 from struct import pack
 from threading import Thread
@@ -10,6 +9,7 @@ from urllib.parse import urlsplit
 
 import socks
 
+from apoclypsebm import metrics
 from apoclypsebm.log import say_exception, say_line
 from apoclypsebm.work_sources.base import Source
 
@@ -159,9 +159,13 @@ class GetworkSource(Source):
             self.ensure_connected(self.connection, self.server().proto,
                                   self.server().host)[0]
             self.postdata['params'] = [data] if data else []
+            started = monotonic()
             (self.connection, result) = self.request(self.connection, '/',
                                                      self.headers,
                                                      dumps(self.postdata))
+            latency = (metrics.SUBMIT_SECONDS if data
+                       else metrics.WORK_FETCH_SECONDS)
+            latency.labels(self.server().name).observe(monotonic() - started)
 
             self.switch.connection_ok()
 
@@ -173,9 +177,9 @@ class GetworkSource(Source):
             say_exception()
 
     def send_internal(self, result, nonce):
-        data = ''.join([hexlify(result.header),
-                        hexlify(pack('<3I', int(result.time), int(result.difficulty),
-                             int(nonce))),
+        data = ''.join([result.header.hex(),
+                        pack('<3I', int(result.time), int(result.difficulty),
+                             int(nonce)).hex(),
                         '000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000'])
         accepted = self.getwork(data)
         if accepted is not None:
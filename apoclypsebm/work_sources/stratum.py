@@ -1,15 +1,16 @@
 import asynchat
 import asyncore
 import socket
-from binascii import hexlify, unhexlify
+from binascii import unhexlify
 from hashlib import sha256
 from json import dumps, loads
 from struct import pack
 from threading import Lock, Thread, Timer
-from time import sleep, time, monotonic
+from time import time, monotonic
 
 import socks
 
+from apoclypsebm import metrics
 from apoclypsebm.log import say_exception, say_line
 from apoclypsebm.util import Object, chunks
 from apoclypsebm.work_sources.base import Source
@@ -19,6 +20,10 @@ from apoclypsebm.work_sources.base import Source
 
 BASE_DIFFICULTY = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
 MIN_DIFFICULTY = 0x00000000FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF
+# Block version bits BIP 320 leaves free for miners to roll.
+VERSION_ROLLING_MASK = 0x1FFFE000
+# Seconds the pool gets to answer mining.subscribe and mining.authorize.
+HANDSHAKE_TIMEOUT = 10
 
 
 def detect_stratum_proxy(host):
@@ -63,6 +68,9 @@ class StratumSource(Source):
         self.channel_map = {}
         self.subscribed = False
         self.authorized = None
+        self.handshake_sent = None
+        # Subscription id of the last session, handed back to resume it.
+        self.session_id = None
         self.submits = {}
         self.last_submits_cleanup = monotonic()
         self.server_difficulty = BASE_DIFFICULTY
@@ -70,6 +78,9 @@ class StratumSource(Source):
         self.current_job = None
         self.extranonce = ''
         self.extranonce2_size = 4
+        # Leading extranonce2 bytes kept out of the local devices' share.
+        self.extranonce2_prefix = ''
+        self.version_mask = 0
         self.send_lock = Lock()
 
     def loop(self):
@@ -81,11 +92,7 @@ class StratumSource(Source):
             if self.should_stop: return
 
             if self.current_job:
-                miner = self.switch.updatable_miner()
-                while miner:
-                    self.current_job = self.refresh_job(self.current_job)
-                    self.queue_work(self.current_job, miner)
-                    miner = self.switch.updatable_miner()
+                self.queue_updatable_work()
 
             if self.check_failback():
                 return True
@@ -115,20 +122,35 @@ class StratumSource(Source):
                     thread.daemon = True
                     thread.start()
 
-                    if not self.subscribe():
-                        say_line('Failed to subscribe')
-                        self.stop()
-                    elif not self.authorize():
-                        self.stop()
+                    self.handshake()
 
                 except socket.error:
                     say_exception()
                     self.stop()
                     continue
 
-            with self.send_lock:
-                self.process_result_queue()
-            sleep(1)
+            elif not self.check_handshake():
+                self.stop()
+                continue
+
+            # Results wait for the session, the jobs they were found on are
+            # dropped if it isn't the one they came from.
+            if self.subscribed:
+                with self.send_lock:
+                    self.process_result_queue()
+            if self.wake.wait(1):
+                self.wake.clear()
+
+    def process_result_queue(self):
+        """Sends the queued results. A result the connection dropped under
+        waits for the next session rather than stopping the source."""
+        while self.handler and not self.result_queue.empty():
+            result = self.result_queue.get(False)
+            result.dequeued = monotonic()
+            with self.switch.lock:
+                if not self.switch.send(result, self.send_internal):
+                    self.result_queue.put(result)
+                    break
 
     def asyncore_thread(self):
         asyncore.loop(map=self.channel_map)
@@ -139,6 +161,12 @@ class StratumSource(Source):
             self.handler.close()
 
     def refresh_job(self, j):
+        """Moves j to its next block version, or to the next extranonce2 and
+        merkle root once the versions allowed are used up."""
+        j.rolls = getattr(j, 'rolls', 0) + 1
+        if j.rolls < self.version_rolls() and hasattr(j, 'merkle_root'):
+            return self.roll_version(j)
+        j.rolls = 0
         j.extranonce2 = self.increment_nonce(j.extranonce2)
         coinbase = j.coinbase1 + self.extranonce + j.extranonce2 + j.coinbase2
         merkle_root = sha256(sha256(unhexlify(coinbase)).digest()).digest()
@@ -149,13 +177,23 @@ class StratumSource(Source):
         merkle_root_reversed = b''
         for word in chunks(merkle_root, 4):
             merkle_root_reversed += word[::-1]
-        merkle_root = merkle_root_reversed.hex()
+        j.merkle_root = merkle_root_reversed.hex()
+        return self.roll_version(j)
 
+    def roll_version(self, j):
+        version = int(j.version, 16) ^ deposit(j.rolls, self.version_mask)
         j.block_header = ''.join(
-            [j.version, j.prevhash, merkle_root, j.ntime, j.nbits])
+            ['%08x' % version, j.prevhash, j.merkle_root, j.ntime, j.nbits])
         j.time = time()
         return j
 
+    def version_rolls(self):
+        """Block versions taken from each merkle root."""
+        if not self.version_mask:
+            return 1
+        return min(self.options.version_rolling,
+                   1 << bin(self.version_mask).count('1'))
+
     def increment_nonce(self, nonce):
         next_nonce = int(nonce, 16) + 1
         if len('%x' % next_nonce) > (self.extranonce2_size * 2):
@@ -173,6 +211,7 @@ class StratumSource(Source):
 
                 j = Object()
 
+                j.received = monotonic()
                 j.job_id = params[0]
                 j.prevhash = params[1]
                 j.coinbase1 = params[2]
@@ -182,29 +221,54 @@ class StratumSource(Source):
                 j.nbits = params[6]
                 j.ntime = params[7]
                 clear_jobs = params[8]
+                known = self.jobs.get(j.job_id)
+                # The first job of a new extranonce, devices wait for it.
+                first = self.current_job is None
                 if clear_jobs:
                     self.jobs.clear()
                 j.extranonce2 = self.extranonce2_size * '00'
+                if known and (known.coinbase1, known.coinbase2) == (
+                        j.coinbase1, j.coinbase2):
+                    # Sent again on a resumed session, carry on where it was.
+                    j.extranonce2 = known.extranonce2
 
                 j = self.refresh_job(j)
 
+                if self.switch.stratum_proxy:
+                    self.switch.stratum_proxy.upstream_notify(params)
                 self.jobs[j.job_id] = j
                 self.current_job = j
 
                 self.queue_work(j)
+                if clear_jobs or first:
+                    # Restart every device now rather than on the next loop.
+                    self.queue_updatable_work()
                 self.switch.connection_ok()
 
             # mining.get_version
-            if message['method'] == 'mining.get_version':
+            elif message['method'] == 'mining.get_version':
                 with self.send_lock:
                     self.send_message({"error": None, "id": message['id'],
-                                       "result": self.user_agent})
+                                       "result": self.switch.user_agent})
+
+            # mining.set_version_mask
+            elif message['method'] == 'mining.set_version_mask':
+                self.set_version_mask(message['params'][0])
+
+            # mining.set_extranonce
+            elif message['method'] == 'mining.set_extranonce':
+                say_line('%s changed extranonce to %s',
+                         (self.server().name, message['params'][0]))
+                self.set_extranonce(*message['params'][:2])
 
             # mining.set_difficulty
             elif message['method'] == 'mining.set_difficulty':
                 say_line("Setting new difficulty: %s", message['params'][0])
                 self.server_difficulty = min(MIN_DIFFICULTY, int(BASE_DIFFICULTY //
                                              message['params'][0]))
+                if self.switch.stratum_proxy:
+                    self.switch.stratum_proxy.upstream_difficulty(
+                        message['params'][0])
 
             # client.reconnect
             elif message['method'] == 'client.reconnect':
@@ -225,26 +289,46 @@ class StratumSource(Source):
                          message['params'][0]]
                 self.switch.add_servers(hosts)
 
+        # answers to shares of the miners behind the stratum proxy
+        elif self.switch.stratum_proxy and \
+                self.switch.stratum_proxy.upstream_response(message):
+            pass
+
         # responses to server API requests
         elif 'result' in message:
 
             # response to mining.subscribe
             # store extranonce and extranonce2_size
             if message['id'] == 's':
-                self.extranonce = message['result'][1]
-                self.extranonce2_size = message['result'][2]
-                self.subscribed = True
+                self.handle_subscribe(message)
+
+            # response to mining.configure
+            elif message['id'] == 'c':
+                result = message['result'] or {}
+                if result.get('version-rolling'):
+                    self.set_version_mask(result['version-rolling.mask'])
+                else:
+                    say_line('%s does not allow version rolling',
+                             self.server().name)
+
+            # response to mining.extranonce.subscribe
+            elif message['id'] == 'x':
+                if not message['result']:
+                    say_line('%s only changes extranonce on reconnect',
+                             self.server().name)
 
             # check if this is submit confirmation (message id should be in submits dictionary)
             # cleanup if necessary
             elif message['id'] in self.submits:
-                miner, nonce = self.submits[message['id']][:2]
+                miner, nonce, submitted = self.submits[message['id']]
                 accepted = message['result']
+                now = monotonic()
+                metrics.SUBMIT_SECONDS.labels(self.server().name).observe(
+                    now - submitted)
                 self.switch.report(miner, nonce, accepted)
                 del self.submits[message['id']]
-                if monotonic() - self.last_submits_cleanup > 3600:
-                    now = monotonic()
-                    for key, value in self.submits.items():
+                if now - self.last_submits_cleanup > 3600:
+                    for key, value in list(self.submits.items()):
                         if now - value[2] > 3600:
                             del self.submits[key]
                     self.last_submits_cleanup = now
@@ -258,40 +342,136 @@ class StratumSource(Source):
                 else:
                     self.authorized = True
 
+    def handle_subscribe(self, message):
+        result = message['result']
+        if not result:
+            say_line('%s refused subscription: %s',
+                     (self.server().name, message.get('error')))
+            # Maybe the session it was asked to resume, the next one is new.
+            self.session_id = None
+            self.subscribed = False
+            return
+        session_id = subscription_id(result[0])
+        resumed = self.set_extranonce(result[1], result[2]) and (
+            self.session_id is not None and session_id == self.session_id)
+        self.session_id = session_id
+        metrics.STRATUM_SESSIONS.labels(
+            self.server().name, 'resumed' if resumed else 'new').inc()
+        if resumed:
+            say_line('%s resumed session %s', (self.server().name, session_id))
+        self.subscribed = True
+        # Results held for the session can go.
+        self.wake.set()
+
+    def set_extranonce(self, extranonce, extranonce2_size):
+        """Takes the extranonce of the session. Jobs built on another one
+        are dropped, so results found on them go stale. Returns whether the
+        extranonce stayed the same."""
+        if self.switch.stratum_proxy:
+            shared = self.switch.stratum_proxy.upstream_subscribed(
+                self, extranonce, extranonce2_size)
+            if shared:
+                local_extranonce, extranonce2_size = shared
+                self.extranonce2_prefix = local_extranonce[len(extranonce):]
+                extranonce = local_extranonce
+            else:
+                self.extranonce2_prefix = ''
+        same = (extranonce == self.extranonce
+                and extranonce2_size == self.extranonce2_size)
+        if not same:
+            self.jobs.clear()
+            self.current_job = None
+            # What the devices hash now can't be submitted, they get the
+            # session's first job as soon as it comes.
+            for miner in self.switch.miners:
+                miner.restart()
+                miner.update = True
+        self.extranonce = extranonce
+        self.extranonce2_size = extranonce2_size
+        return same
+
     def reconnect(self):
         say_line("%s reconnecting to %s",
                  (self.server().name, self.server().host))
-        self.handler.close()
+        if self.handler:
+            # The loop connects again and asks to resume the session.
+            self.handler.handle_close()
+
+    def configure(self):
+        """Asks for version rolling (BIP 310). The answer is handled when it
+        comes, jobs use the mask from then on."""
+        self.version_mask = 0
+        if self.options.version_rolling < 2 and not self.switch.stratum_proxy:
+            return
+        self.send_message(
+            {'id': 'c', 'method': 'mining.configure',
+             'params': [['version-rolling'], {
+                 'version-rolling.mask': '%08x' % VERSION_ROLLING_MASK,
+                 'version-rolling.min-bit-count':
+                     max(self.options.version_rolling - 1, 0).bit_length()}]})
+
+    def set_version_mask(self, mask):
+        self.version_mask = int(mask, 16) & VERSION_ROLLING_MASK
+        if self.switch.stratum_proxy:
+            self.switch.stratum_proxy.upstream_version_mask(self.version_mask)
+        say_line('%s version rolling mask %08x',
+                 (self.server().name, self.version_mask))
+
+    def handshake(self):
+        """Sends configure, subscribe, extranonce.subscribe and authorize
+        at once, check_handshake follows the answers. Jobs of the last
+        session are mined on meanwhile."""
+        self.subscribed = None
+        self.authorized = None
+        self.handshake_sent = monotonic()
+        with self.send_lock:
+            self.configure()
+            self.subscribe()
+            self.send_message({'id': 'x', 'method': 'mining.extranonce.subscribe',
+                               'params': []})
+            self.authorize()
+
+    def check_handshake(self):
+        """False once the pool refused the session or let it time out."""
+        if self.subscribed is False or self.authorized is False:
+            return False
+        if self.subscribed and self.authorized:
+            return True
+        if monotonic() - self.handshake_sent < HANDSHAKE_TIMEOUT:
+            return True
+        say_line('Failed to subscribe' if not self.subscribed
+                 else 'Failed to authorize')
+        return False
 
     def subscribe(self):
+        params = [self.switch.user_agent]
+        if self.session_id:
+            params.append(self.session_id)
         self.send_message(
-            {'id': 's', 'method': 'mining.subscribe', 'params': []})
-        for i in range(10):
-            sleep(1)
-            if self.subscribed: break
-        return self.subscribed
+            {'id': 's', 'method': 'mining.subscribe', 'params': params})
 
     def authorize(self):
         self.send_message(
             {'id': self.server().user, 'method': 'mining.authorize',
              'params': [self.server().user, self.server().pwd]})
-        for i in range(10):
-            sleep(1)
-            if self.authorized != None: break
-        return self.authorized
 
     def send_internal(self, result, nonce):
         job_id = result.job_id
         if not job_id in self.jobs:
+            self.switch.share_stale(result.miner, nonce)
             return True
-        extranonce2 = result.extranonce2
-        ntime = hexlify(pack('<I', int(result.time)))
-        hex_nonce = hexlify(pack('<I', int(nonce)))
+        extranonce2 = self.extranonce2_prefix + result.extranonce2
+        ntime = pack('<I', int(result.time)).hex()
+        hex_nonce = pack('<I', int(nonce)).hex()
         id_ = job_id + hex_nonce
-        self.submits[id_] = (result.miner, nonce, time())
-        return self.send_message({'params': [self.server().user, job_id,
-                                             extranonce2, ntime, hex_nonce],
-                                  'id': id_, 'method': u'mining.submit'})
+        params = [self.server().user, job_id, extranonce2, ntime, hex_nonce]
+        if self.version_mask:
+            version = int(result.header[:4].hex(), 16)
+            params.append('%08x' % (version & self.version_mask))
+            id_ += params[5]
+        self.submits[id_] = (result.miner, nonce, monotonic())
+        return self.send_message({'params': params, 'id': id_,
+                                  'method': u'mining.submit'})
 
     def send_message(self, message):
         data = dumps(message) + '\n'
@@ -309,16 +489,52 @@ class StratumSource(Source):
                 data = data[sent:]
             return True
         except AttributeError:
-            self.stop()
+            # The connection dropped while sending.
+            return False
         except Exception:
             say_exception()
             self.stop()
 
+    def queue_updatable_work(self):
+        # A new session may drop the current job from another thread.
+        job = self.current_job
+        miner = job and self.switch.updatable_miner()
+        while miner:
+            job = self.current_job = self.refresh_job(job)
+            self.queue_work(job, miner)
+            miner = self.switch.updatable_miner()
+
     def queue_work(self, work, miner=None):
         target = ''.join(
             list(chunks('%064x' % self.server_difficulty, 2))[::-1])
         self.switch.queue_work(self, work.block_header, target, work.job_id,
-                               work.extranonce2, miner)
+                               work.extranonce2, miner,
+                               received=work.received)
+
+
+def subscription_id(subscriptions):
+    """The mining.notify subscription id in a mining.subscribe answer, which
+    pools take back to resume the session."""
+    if subscriptions and isinstance(subscriptions[0], str):
+        subscriptions = [subscriptions]
+    for subscription in subscriptions or ():
+        if len(subscription) > 1 and subscription[0] == 'mining.notify':
+            return subscription[1]
+    return None
+
+
+def deposit(value, mask):
+    """Spreads the low bits of value over the set bits of mask."""
+    bits = 0
+    bit = 1
+    while value and mask:
+        if mask & 1:
+            if value & 1:
+                bits |= bit
+            value >>= 1
+        mask >>= 1
+        bit <<= 1
+    return bits
 
 
 class Handler(asynchat.async_chat):
@@ -332,6 +548,8 @@ class Handler(asynchat.async_chat):
         self.close()
         self.parent.handler = None
         self.parent.socket = None
+        # Connected again at once.
+        self.parent.wake.set()
 
     #def handle_error(self):
     #    say_exception()
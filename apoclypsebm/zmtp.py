@@ -0,0 +1,147 @@
+"""
+Just enough of ZMTP 3.0, the ZeroMQ wire protocol, to subscribe to the
+block notifications bitcoind publishes with -zmqpubhashblock, without
+pyzmq. Only the NULL mechanism over tcp:// is spoken, which is what bitcoind
+offers.
+"""
+import socket
+from struct import pack, unpack
+from threading import Thread
+from time import sleep
+
+from apoclypsebm.log import say_line
+
+RECONNECT_DELAY = 1
+
+MORE = 0x01
+LONG = 0x02
+COMMAND = 0x04
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def greeting(as_server=False):
+    return b''.join((b'\xff' + b'\0' * 8 + b'\x7f', b'\x03\x00',
+                     b'NULL'.ljust(20, b'\0'), bytes((as_server,)),
+                     b'\0' * 31))
+
+
+def frame(body, flags=0):
+    if len(body) > 255:
+        return bytes((flags | LONG,)) + pack('>Q', len(body)) + body
+    return bytes((flags, len(body))) + body
+
+
+def parse_address(address):
+    """(host, port) of a tcp://host:port endpoint."""
+    if not address.startswith('tcp://'):
+        raise ValueError(f'only tcp:// endpoints are supported: {address}')
+    host, port = address[6:].rsplit(':', 1)
+    return host.strip('[]'), int(port)
+
+
+class Connection(object):
+    """Frames over a connected socket."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def receive(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionResetError('connection closed')
+            data += chunk
+        return bytes(data)
+
+    def handshake(self, socket_type, as_server=False):
+        self.sock.sendall(greeting(as_server))
+        peer = self.receive(64)
+        if peer[0] != 0xff or peer[9] != 0x7f or peer[10] < 3:
+            raise ProtocolError('not a ZMTP 3 peer')
+        if peer[12:32].rstrip(b'\0') != b'NULL':
+            raise ProtocolError('unsupported security mechanism')
+        name = b'Socket-Type'
+        self.sock.sendall(frame(
+            b'\x05READY' + bytes((len(name),)) + name
+            + pack('>I', len(socket_type)) + socket_type, COMMAND))
+        flags, body = self.read_frame()
+        if not flags & COMMAND or body[1:1 + body[0]] != b'READY':
+            raise ProtocolError('expected READY')
+
+    def read_frame(self):
+        flags = self.receive(1)[0]
+        if flags & LONG:
+            size, = unpack('>Q', self.receive(8))
+        else:
+            size = self.receive(1)[0]
+        return flags, self.receive(size)
+
+    def read_message(self):
+        """The frames of the next message, commands skipped."""
+        frames = []
+        while True:
+            flags, body = self.read_frame()
+            if flags & COMMAND:
+                continue
+            frames.append(body)
+            if not flags & MORE:
+                return frames
+
+    def send_message(self, frames):
+        self.sock.sendall(b''.join(
+            frame(body, MORE if i < len(frames) - 1 else 0)
+            for i, body in enumerate(frames)))
+
+
+class Subscriber(object):
+    """
+    Calls callback with the frames of every message published on one of
+    topics at address, from its own thread. Connections that fail are made
+    again after RECONNECT_DELAY.
+    """
+
+    def __init__(self, address, topics, callback):
+        self.address = address
+        self.topics = topics
+        self.callback = callback
+        self.sock = None
+        self.should_stop = False
+
+    def start(self):
+        Thread(target=self.run, name='zmtp subscriber', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.should_stop = True
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self):
+        while not self.should_stop:
+            try:
+                self.sock = socket.create_connection(
+                    parse_address(self.address), 10)
+                self.sock.settimeout(None)
+                connection = Connection(self.sock)
+                connection.handshake(b'SUB')
+                for topic in self.topics:
+                    connection.send_message([b'\x01' + topic])
+                say_line('subscribed to %s', self.address)
+                while not self.should_stop:
+                    self.callback(connection.read_message())
+            except (OSError, ProtocolError) as e:
+                if not self.should_stop:
+                    say_line('%s: %s, reconnecting', (self.address, e))
+            finally:
+                if self.sock:
+                    self.sock.close()
+                    self.sock = None
+            if not self.should_stop:
+                sleep(RECONNECT_DELAY)
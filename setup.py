@@ -22,6 +22,7 @@ args = {
     'entry_points': {
         'console_scripts': (
             'apoclypse = apoclypsebm.command:main',
+            'apoclypse-bench = apoclypsebm.bench.driver:main',
         ),
     },
     'packages': find_packages(include=('apoclypsebm', 'apoclypsebm.*',)),
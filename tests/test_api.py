@@ -0,0 +1,22 @@
+from time import monotonic
+
+from apoclypsebm.api import API
+from apoclypsebm.command import parse_options
+from apoclypsebm.mining import virtual
+from apoclypsebm.switch import Switch
+
+
+def test_average_hash_rate():
+    options = parse_options(['--no-ocl', '--no-bfl', '--virtual', '1',
+                             'stratum+tcp://x:y@127.0.0.1:3333'])
+    switch = Switch(options, 'utf-8')
+    miner, = virtual.initialize(options)
+    switch.add_miner(miner)
+    switch.started = miner.start_time = monotonic() - 10
+    miner.hashes = 50 * 1000000 * 10
+
+    api = API(switch)
+    assert 49 < api.execute('devs')['DEVS'][0]['MHS av'] <= 50
+    summary = api.execute('summary')['SUMMARY'][0]
+    assert 49 < summary['MHS av'] <= 50
+    assert summary['Elapsed'] == 10
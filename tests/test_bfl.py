@@ -0,0 +1,91 @@
+from struct import pack
+from threading import Event
+
+import pytest
+
+from apoclypsebm import metrics
+from apoclypsebm.bench.bitforce import BitForceSimulator
+from apoclypsebm.command import parse_options
+from apoclypsebm.mining import bfl
+from apoclypsebm.sha256 import hash
+from apoclypsebm.util import Object
+
+STATE = (0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+         0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
+
+
+class FakeSwitch(object):
+    update_time = False
+
+    def __init__(self):
+        self.results = []
+        self.found = Event()
+
+    def put(self, result):
+        self.results.append(result)
+        self.found.set()
+
+    def status_updated(self, miner):
+        pass
+
+
+def job():
+    j = Object()
+    j.state = STATE
+    j.merkle_end, j.time, j.difficulty = 1, 2, 3
+    j.header = pack('<8I3I', *STATE, 1, 2, 3)
+    j.target = j.job_id = j.extranonce2 = j.template = j.server = None
+    j.received = None
+    j.targetQ = 1
+    return j
+
+
+# Single jobs, queued jobs, and a queue that won't take the jobs sent.
+@pytest.mark.parametrize('queue, bulk_queue',
+                         [(False, False), (True, True), (True, False)])
+def test_mines_on_simulator(queue, bulk_queue):
+    simulator = BitForceSimulator(job_time=0.05, queue=queue,
+                                  bulk_queue=bulk_queue)
+    simulator.start()
+    options = parse_options(['--no-ocl', '--bfl-port', simulator.port,
+                             'stratum+tcp://x:y@127.0.0.1:3333'])
+    miner, = bfl.initialize(options)
+    miner.switch = FakeSwitch()
+    miner.start()
+    try:
+        miner.work_queue.put(job())
+        assert miner.switch.found.wait(5)
+    finally:
+        miner.stop()
+        simulator.stop()
+
+    result = miner.switch.results[0]
+    nonces = list(miner.nonce_generator(result.nonces))
+    assert nonces
+    for nonce in nonces:
+        h = hash(result.state, result.merkle_end, result.time,
+                 result.difficulty, nonce)
+        assert not h[7] & simulator.verify_mask
+
+
+def test_temperature_cutoff():
+    simulator = BitForceSimulator(job_time=0.05, temperature=99)
+    simulator.start()
+    options = parse_options(['--no-ocl', '--bfl-port', simulator.port,
+                             'stratum+tcp://x:y@127.0.0.1:3333'])
+    miner, = bfl.initialize(options)
+    miner.switch = FakeSwitch()
+    miner.start()
+    try:
+        miner.work_queue.put(job())
+        assert not miner.switch.found.wait(0.5)
+        assert miner.temperature == 99
+        assert metrics.TEMPERATURE.value(miner.id()) == 99
+
+        simulator.temperature = 60
+        miner.next_sample = 0
+        assert miner.switch.found.wait(5)
+        assert miner.temperature == 60
+    finally:
+        miner.stop()
+        simulator.stop()
@@ -0,0 +1,166 @@
+import os
+from time import monotonic, sleep
+
+from apoclypsebm.bench.servers import MockBitcoind
+from apoclypsebm.bitcoin import var_int
+from apoclypsebm.command import parse_options
+from apoclypsebm.switch import Switch
+from apoclypsebm.util import Object
+from apoclypsebm.work_sources.getblocktemplate import (
+    TEMPLATES, BlockRace, GetblocktemplateSource, RaceNode, TemplateStore)
+
+
+def block(store, template, header):
+    pieces = store.submission(template, header)
+    return bytes.fromhex(b''.join(pieces).decode('ascii'))
+
+
+def transactions(count, size=200):
+    return [{'data': os.urandom(size).hex(), 'txid': os.urandom(32).hex()}
+            for _ in range(count)]
+
+
+def test_template_store():
+    store = TemplateStore()
+    coinbase = os.urandom(120)
+    txs = transactions(3)
+    template = store.add(coinbase, txs)
+    header = os.urandom(80)
+
+    assert block(store, template, header).hex() == ''.join(
+        [header.hex(), var_int(4).hex(), coinbase.hex()] +
+        [tx['data'] for tx in txs])
+
+    # However many miners fetched templates, the transactions are kept once.
+    jobs = [store.add(coinbase, txs) for _ in range(100)]
+    assert block(store, jobs[-1], header) == block(store, template, header)
+    assert all(job.blob is template.blob for job in jobs)
+    assert store.size == 600
+    del jobs, template
+    assert store.size == 0
+
+
+def test_template_store_refreshes():
+    """Refreshes on one block with changing transactions only keep those
+    some job or result still holds."""
+    store = TemplateStore()
+    coinbase = os.urandom(120)
+    held = []
+    for refresh in range(120):
+        template = store.add(coinbase, transactions(10 + refresh))
+        if refresh % 40 == 0:
+            held.append(template)
+    # Those of refreshes 0, 40 and 80 and the last one.
+    assert store.size == 200 * (10 + 50 + 90 + 129)
+    header = os.urandom(80)
+    assert len(block(store, held[0], header)) == 80 + 1 + 120 + 200 * 10
+    del held[:]
+    assert store.size == 200 * 129
+    del template
+    assert store.size == 0 and not store.blobs
+
+
+def test_submit_coinbase():
+    store = TemplateStore()
+    coinbase = os.urandom(120)
+    txs = [{'data': os.urandom(300).hex()} for _ in range(300)]
+    node = object()
+    template = store.add(coinbase, txs, coinbase_only=True, node=node)
+    header = os.urandom(80)
+
+    pieces = store.submission(template, header, node)
+    assert bytes.fromhex(b''.join(pieces).decode('ascii')) == (
+        header + var_int(301) + coinbase)
+    # Other nodes don't know the transactions.
+    assert len(block(store, template, header)) == 80 + 3 + 120 + 300 * 300
+
+
+def test_block_race():
+    race = BlockRace()
+    assert race.arrived('a', 'block 1')
+    assert not race.arrived('b', 'block 1')
+    assert not race.arrived('a', 'block 1')
+    assert race.arrived('b', 'block 2', 'source b')
+    assert race.leader == 'source b'
+    # A node still on block 1 doesn't take the miners back to it.
+    assert race.superseded('block 1')
+    assert not race.superseded('block 2')
+    assert not race.arrived('a', 'block 1')
+    assert race.leader == 'source b'
+
+
+def test_race_nodes_stop_with_source():
+    options = parse_options(['--no-ocl', '--no-bfl', '--race-node',
+                             'http://x:y@127.0.0.1:2', 'http://x:y@127.0.0.1:1'])
+    switch = Switch(options, 'utf-8')
+    source = GetblocktemplateSource(switch)
+    node = RaceNode(source, switch.parse_server(options.race_nodes[0]))
+    source.nodes = [node]
+    source.should_stop = False
+    assert not node.should_stop
+    source.stop()
+    # Not even when the source loops again.
+    source.should_stop = False
+    assert node.should_stop
+
+
+def test_block_reaches_race_node_with_primary_down():
+    """The source stopping when its own node refuses the block doesn't cut
+    off the submission to the node raced against it."""
+    bitcoind = MockBitcoind(transactions=10).start()
+    try:
+        options = parse_options(['--no-ocl', '--no-bfl', '--race-node',
+                                 'http://x:y@' + bitcoind.address,
+                                 'http://x:y@127.0.0.1:1'])
+        switch = Switch(options, 'utf-8')
+        source = GetblocktemplateSource(switch)
+        node = RaceNode(source, switch.parse_server(options.race_nodes[0]))
+        source.nodes = [node]
+        source.should_stop = False
+
+        def timeout_response(connection, timeout,
+                             timeout_response=node.timeout_response):
+            # The source stops while the block is on its way to the node.
+            source.stop()
+            return timeout_response(connection, timeout)
+        node.timeout_response = timeout_response
+        submitted = []
+        node.submitblock = lambda *args, submitblock=node.submitblock: (
+            submitted.append(submitblock(*args)))
+
+        header = bytes(4) + bitcoind.prevhash + os.urandom(32)
+        result = Object()
+        result.header = b''.join(header[i:i + 4][::-1]
+                                 for i in range(0, 68, 4))
+        result.time = result.difficulty = 0
+        result.job_id = None
+        result.template = TEMPLATES.add(os.urandom(100), [], node=node)
+        # Not submitted to the source's own node, retried later.
+        assert source.send_internal(result, 1) is False
+        assert source.should_stop and node.should_stop
+
+        deadline = monotonic() + 5
+        while not submitted and monotonic() < deadline:
+            sleep(0.01)
+        assert submitted == [None]
+        assert bitcoind.stats.accepted == 1
+    finally:
+        bitcoind.stop()
+
+
+def test_loop_error_closes_race_nodes():
+    options = parse_options(['--no-ocl', '--no-bfl', '--race-node',
+                             'http://x:y@127.0.0.1:2', 'http://x:y@127.0.0.1:1'])
+    switch = Switch(options, 'utf-8')
+    source = GetblocktemplateSource(switch)
+
+    def updatable_miner():
+        raise RuntimeError('unexpected')
+    switch.updatable_miner = updatable_miner
+    source.loop()
+    nodes = source.nodes
+    assert nodes and all(node.should_stop for node in nodes)
+    # The next loop doesn't race the same node twice.
+    source.loop()
+    assert all(node.closed for node in nodes)
+    assert len(source.nodes) == 1 and source.nodes[0] not in nodes
@@ -0,0 +1,95 @@
+import os
+
+from apoclypsebm import hwmon, metrics
+
+PCI_ADDRESS = '0000:03:00.0'
+
+
+class FakeMiner(object):
+    def __init__(self, name):
+        self.name = name
+        self.hashes = 0
+        self.temperature = 0
+        self.duty = 1.0
+
+    def id(self):
+        return self.name
+
+
+def fake_sysfs(root, temperature=70000, fan=1500, power=150000000):
+    """Lays out a GPU's hwmon directory the way amdgpu does."""
+    device = root / 'devices/pci0000:00/0000:00:01.0' / PCI_ADDRESS
+    sensors = device / 'hwmon/hwmon2'
+    sensors.mkdir(parents=True)
+    for name, value in (('name', 'amdgpu'), ('temp1_input', temperature),
+                        ('fan1_input', fan), ('power1_average', power)):
+        (sensors / name).write_text(f'{value}\n')
+
+    card = root / 'class/drm/card0'
+    card.mkdir(parents=True)
+    os.symlink(device, card / 'device')
+    os.symlink(device, sensors / 'device')
+    (root / 'class/hwmon').mkdir(parents=True)
+    os.symlink(sensors, root / 'class/hwmon/hwmon2')
+    return sensors
+
+
+def test_find_sensor(tmp_path):
+    sensors = fake_sysfs(tmp_path)
+    sensor = hwmon.find_sensor(PCI_ADDRESS.upper(), str(tmp_path))
+    assert os.path.realpath(sensor.path) == str(sensors)
+    assert sensor.temperature() == 70
+    assert sensor.fan() == 1500
+    assert sensor.power() == 150
+
+    assert hwmon.find_sensor('0000:04:00.0', str(tmp_path)) is None
+    assert hwmon.find_sensor(None, str(tmp_path)) is None
+
+
+def test_power_input_fallback(tmp_path):
+    sensors = fake_sysfs(tmp_path)
+    (sensors / 'power1_average').unlink()
+    (sensors / 'power1_input').write_text('90000000\n')
+    assert hwmon.Sensor(str(sensors)).power() == 90
+    (sensors / 'power1_input').unlink()
+    assert hwmon.Sensor(str(sensors)).power() is None
+
+
+def test_temperature_throttle():
+    throttle = hwmon.Throttle(80, 90)
+    assert throttle.update(70) == 1
+    assert throttle.update(85) == 0.5
+    assert throttle.update(88) == 0.2
+    assert throttle.update(95) == 0
+    assert throttle.update(None) == 1
+
+
+def test_power_throttle():
+    throttle = hwmon.Throttle(80, 90, target_power=100)
+    assert throttle.update(60, 200) == 0.5
+    assert throttle.update(60, 100) == 0.5
+    assert throttle.update(60, 50) == 1
+    assert throttle.update(85, 100) == 0.5
+
+
+def test_sampler(tmp_path):
+    sensors = fake_sysfs(tmp_path, temperature=85000, power=100000000)
+    sampler = hwmon.Sampler()
+    miner = FakeMiner('hwmon test')
+    sampler.watches.append(hwmon.Watch(
+        miner, hwmon.Sensor(str(sensors)), hwmon.Throttle(80, 90)))
+
+    sampler.sample(100)
+    assert miner.temperature == 85
+    assert miner.duty == 0.5
+    assert metrics.FAN_SPEED.value(miner.id()) == 1500
+    assert metrics.POWER.value(miner.id()) == 100
+
+    miner.hashes = 2000000000
+    sampler.sample(110)
+    # 2 GH over 10 s at 100 W
+    assert metrics.HASHES_PER_JOULE.value(miner.id()) == 2000000
+
+    (sensors / 'temp1_input').write_text('60000\n')
+    sampler.sample(111)
+    assert miner.duty == 1
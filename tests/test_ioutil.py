@@ -0,0 +1,39 @@
+from time import monotonic, sleep
+
+from apoclypsebm import ioutil
+
+
+def test_probe_runs_checks_at_once():
+    def check(port):
+        sleep(0.3)
+        return port != 'b'
+
+    started = monotonic()
+    assert ioutil.probe(check, ['a', 'b', 'c', 'd', 'e']) == ['a', 'c', 'd', 'e']
+    assert monotonic() - started < 1
+
+
+def test_probe_deadline():
+    def check(port):
+        if port == 'hung':
+            sleep(3)
+        return True
+
+    started = monotonic()
+    assert ioutil.probe(check, ['hung', 'ok'], timeout=0.1) == ['ok']
+    assert monotonic() - started < 2
+
+
+def test_port_cache(tmp_path):
+    port = tmp_path / 'ttyUSB0'
+    port.touch()
+    cache = ioutil.PortCache(str(tmp_path / 'devices.json'))
+    assert cache.known() == []
+
+    cache.add(str(port))
+    cache.add(str(port))
+    cache.add(str(tmp_path / 'ttyUSB1'))
+    assert cache.known() == [str(port)]
+
+    cache.remove(str(port))
+    assert cache.load() == [str(tmp_path / 'ttyUSB1')]
@@ -0,0 +1,21 @@
+from collections import deque
+
+from apoclypsebm import log
+
+
+def test_block_reports_are_not_rate_limited(monkeypatch):
+    monkeypatch.setattr(log, 'quiet', False)
+    monkeypatch.setattr(log, 'pending', deque())
+    monkeypatch.setattr(log, 'ensure_writer', lambda: None)
+    for i in range(log.RATE_LIMIT + 10):
+        log.say_line('%s %s%s, %s', ('0:0:gpu', '', '%08x' % i, 'accepted'))
+    log.say_line('%s %s%s, %s', ('0:0:gpu', 'block ', '0' * 16, 'accepted'),
+                 limit=False)
+
+    writer = log.Writer()
+    text = []
+    while log.pending:
+        writer.handle(log.pending.popleft(), text, [])
+    assert len(text) == log.RATE_LIMIT + 1
+    assert text[-1].endswith('0:0:gpu block 0000000000000000, accepted\n')
+    assert writer.suppressed == {'%s %s%s, %s': 10}
@@ -0,0 +1,52 @@
+from apoclypsebm import pacing
+
+UNIT = 256 * 256
+
+
+def launch_time(size, rate=500000000, overhead=0.002):
+    """A device hashing at rate whose launches also cost overhead."""
+    return size / rate + overhead
+
+
+def test_converges_to_frame_time():
+    sizer = pacing.LaunchSizer(UNIT, 2 ** 32, 1 / 30)
+    for _ in range(40):
+        sizer.update(launch_time(sizer.size))
+    assert abs(launch_time(sizer.size) * 30 - 1) < 0.05
+    assert sizer.settled
+
+
+def test_follows_a_slower_device():
+    sizer = pacing.LaunchSizer(UNIT, 2 ** 32, 1 / 30)
+    for _ in range(40):
+        sizer.update(launch_time(sizer.size))
+    fast = sizer.size
+    for _ in range(40):
+        sizer.update(launch_time(sizer.size, rate=250000000))
+    assert abs(sizer.size / fast - 0.5) < 0.05
+
+
+def test_clamps_to_limits():
+    sizer = pacing.LaunchSizer(UNIT, 64 * UNIT, 1 / 30)
+    for _ in range(40):
+        sizer.update(0.0001)
+    assert sizer.size == 64 * UNIT
+    for _ in range(40):
+        sizer.update(10)
+    assert sizer.size == UNIT
+    assert sizer.size % UNIT == 0
+
+
+def test_step_is_bounded():
+    sizer = pacing.LaunchSizer(UNIT, 2 ** 32, 1 / 30, size=100 * UNIT)
+    assert sizer.update(100) >= 50 * UNIT
+
+
+def test_launch_sizes_file(tmp_path):
+    path = str(tmp_path / 'launch-sizes.json')
+    sizes = pacing.LaunchSizes(path)
+    assert sizes.get('gpu') is None
+    sizes.set('gpu', 3 * UNIT)
+    pacing.LaunchSizes(path).set('other gpu', UNIT)
+    assert sizes.get('gpu') == 3 * UNIT
+    assert sizes.get('other gpu') == UNIT
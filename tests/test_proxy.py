@@ -0,0 +1,83 @@
+import socket
+from json import dumps, loads
+from threading import Thread
+from time import monotonic, sleep
+
+from apoclypsebm.bench.servers import MockStratumPool
+from apoclypsebm.command import parse_options
+from apoclypsebm.mining import virtual
+from apoclypsebm.proxy import StratumProxy
+from apoclypsebm.switch import Switch
+
+
+def wait_for(condition, timeout=5):
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline
+        sleep(0.01)
+
+
+class Client(object):
+    def __init__(self, address):
+        host, port = address.rsplit(':', 1)
+        self.sock = socket.create_connection((host, int(port)), 5)
+        self.lines = self.sock.makefile('r')
+
+    def send(self, id_, method, params):
+        self.sock.sendall((dumps(
+            {'id': id_, 'method': method, 'params': params}) + '\n').encode())
+
+    def receive(self, match):
+        while True:
+            message = loads(self.lines.readline())
+            if match(message):
+                return message
+
+
+def test_splits_extranonce_between_miners():
+    pool = MockStratumPool(block_interval=0).start()
+    options = parse_options(['--no-ocl', '--no-bfl', '--virtual', '1',
+                             '--virtual-rate', '5',
+                             'stratum+tcp://user:x@' + pool.address])
+    switch = Switch(options, 'utf-8')
+    for miner in virtual.initialize(options):
+        switch.add_miner(miner)
+    switch.stratum_proxy = proxy = StratumProxy('127.0.0.1', 0).start()
+    for miner in switch.miners:
+        miner.start()
+    Thread(target=switch.loop, daemon=True).start()
+    try:
+        wait_for(lambda: proxy.extranonce1)
+        upstream = proxy.extranonce1
+        assert switch.server().source.extranonce == upstream + '0000'
+        assert switch.server().source.extranonce2_size == 2
+
+        clients = [Client(proxy.address) for _ in range(2)]
+        subscriptions = []
+        for client in clients:
+            client.send(1, 'mining.subscribe', [])
+            client.send(2, 'mining.authorize', ['rig', 'x'])
+            subscriptions.append(
+                client.receive(lambda m: m.get('id') == 1)['result'])
+        assert [s[1:] for s in subscriptions] == [
+            [upstream + '0001', 2], [upstream + '0002', 2]]
+
+        client = clients[0]
+        notify = client.receive(lambda m: m.get('method') == 'mining.notify')
+        accepted = pool.stats.accepted
+        client.send(3, 'mining.submit',
+                    ['rig', notify['params'][0], 'abcd', notify['params'][7],
+                     '00000000'])
+        assert client.receive(lambda m: m.get('id') == 3)['result'] is True
+        assert pool.stats.accepted > accepted
+        client.send(4, 'mining.submit',
+                    ['rig', notify['params'][0], 'abcdef', notify['params'][7],
+                     '00000000'])
+        assert client.receive(lambda m: m.get('id') == 4)['error']
+        assert pool.stats.invalid == 0
+    finally:
+        for miner in switch.miners:
+            miner.stop()
+        switch.stop()
+        proxy.stop()
+        pool.stop()
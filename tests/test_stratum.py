@@ -0,0 +1,104 @@
+from threading import Thread
+from time import monotonic, sleep
+
+from apoclypsebm.bench.servers import MockStratumPool
+from apoclypsebm.command import parse_options
+from apoclypsebm.switch import Switch
+from apoclypsebm.util import Object
+from apoclypsebm.work_sources import stratum
+
+
+def stratum_source(*arguments):
+    options = parse_options(
+        ['--no-ocl', '--no-bfl'] + list(arguments) + ['stratum+tcp://x:y@127.0.0.1:3333'])
+    return stratum.StratumSource(Switch(options, 'utf-8'))
+
+
+def wait_for(condition, timeout=5):
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline
+        sleep(0.01)
+
+
+def notified_job():
+    j = Object()
+    j.job_id = '1'
+    j.prevhash = '00' * 32
+    j.coinbase1 = '01'
+    j.coinbase2 = '02'
+    j.merkle_branch = []
+    j.version = '20000000'
+    j.nbits = '1d00ffff'
+    j.ntime = '5f5e1000'
+    j.extranonce2 = '00000000'
+    return j
+
+
+def test_deposit():
+    assert stratum.deposit(0, 0x1FFFE000) == 0
+    assert stratum.deposit(1, 0x1FFFE000) == 0x2000
+    assert stratum.deposit(5, 0b101100) == 0b100100
+    assert stratum.deposit(8, 0b101100) == 0
+
+
+def test_version_rolling():
+    source = stratum_source('--version-rolling', '4')
+    source.set_version_mask('1fffe000')
+    j = source.refresh_job(notified_job())
+    headers = [j.block_header]
+    for _ in range(4):
+        headers.append(source.refresh_job(j).block_header)
+
+    # Four versions of the first merkle root, then the next extranonce2.
+    assert [header[:8] for header in headers] == [
+        '20000000', '20002000', '20004000', '20006000', '20000000']
+    assert len({header[72:136] for header in headers[:4]}) == 1
+    assert headers[4][72:136] != headers[0][72:136]
+    assert j.extranonce2 == '00000002'
+
+
+def test_no_version_rolling():
+    source = stratum_source('--version-rolling', '4')
+    j = source.refresh_job(notified_job())
+    header = j.block_header
+    assert source.refresh_job(j).block_header[:8] == header[:8]
+    assert j.extranonce2 == '00000002'
+
+
+def test_subscription_id():
+    assert stratum.subscription_id(
+        [['mining.set_difficulty', 'a'], ['mining.notify', 'b']]) == 'b'
+    assert stratum.subscription_id(['mining.notify', 'c']) == 'c'
+    assert stratum.subscription_id([]) is None
+
+
+def test_session_resumption():
+    pool = MockStratumPool(block_interval=0).start()
+    options = parse_options(['--no-ocl', '--no-bfl',
+                             'stratum+tcp://user:x@' + pool.address])
+    switch = Switch(options, 'utf-8')
+    Thread(target=switch.loop, daemon=True).start()
+    try:
+        wait_for(lambda: getattr(switch.server(), 'source', None))
+        source = switch.server().source
+        wait_for(lambda: source.subscribed and source.authorized
+                 and source.current_job)
+        extranonce = source.extranonce
+        job = source.current_job
+
+        for client in list(pool.clients):
+            client.connection.shutdown(2)
+        wait_for(lambda: pool.stats.resumed == 1 and source.subscribed
+                 and source.authorized)
+        assert pool.stats.connections == 2
+        assert source.extranonce == extranonce
+        assert job.job_id in source.jobs
+
+        source.handle_message({'id': None, 'method': 'mining.set_extranonce',
+                               'params': ['0badcafe', 4]})
+        assert source.extranonce == '0badcafe'
+        assert not source.jobs and source.current_job is None
+    finally:
+        switch.stop()
+        pool.stop()
@@ -0,0 +1,32 @@
+import os
+from queue import Queue
+from time import monotonic, sleep
+
+from apoclypsebm import zmtp
+from apoclypsebm.bench.servers import MockBlockPublisher
+
+
+def test_subscribes_to_hashblock():
+    publisher = MockBlockPublisher().start()
+    messages = Queue()
+    subscriber = zmtp.Subscriber(publisher.address, (b'hashblock',),
+                                 messages.put).start()
+    try:
+        deadline = monotonic() + 5
+        while not any(s.topics for s in list(publisher.subscribers)):
+            assert monotonic() < deadline
+            sleep(0.01)
+        block_hash = os.urandom(32)
+        publisher.publish(b'rawtx', os.urandom(300))
+        publisher.publish(b'hashblock', block_hash)
+        assert messages.get(timeout=5) == [
+            b'hashblock', block_hash, b'\x01\x00\x00\x00']
+    finally:
+        subscriber.stop()
+        publisher.stop()
+    assert messages.empty()
+
+
+def test_long_frames():
+    assert zmtp.frame(b'x' * 300)[:9] == b'\x02' + (300).to_bytes(8, 'big')
+    assert zmtp.frame(b'x', zmtp.MORE)[:2] == b'\x01\x01'